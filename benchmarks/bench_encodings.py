@@ -0,0 +1,82 @@
+"""
+Benchmark for the response encodings of a large event list: the time to
+encode the Mason document and the bytes sent for every media type and
+content coding. MessagePack and brotli are measured when the msgpack and
+brotli packages are installed.
+
+Run from the repository root:
+    python benchmarks/bench_encodings.py
+"""
+import os
+import random
+import sys
+import timeit
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eventhub import app
+from eventhub.encoding import MASON, MASON_MSGPACK, CODINGS, encode_mason, msgpack
+from eventhub.resources.EventCollection import EventCollection
+from eventhub.utils import InventoryBuilder
+
+EVENTS = 20000
+REPEAT = 5
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 5, 11)}
+WORDS = ("karaoke", "concert", "meetup", "lecture", "workshop", "party", "sauna", "games")
+
+Row = namedtuple("Row", "id name time description location organization follower_count")
+
+
+def build():
+    """
+    Returns the document of a page of EVENTS events with random text
+    """
+    rand = random.Random(EVENTS)
+    start = datetime(2020, 1, 1)
+    body = InventoryBuilder(event_list=[])
+    for id in range(1, EVENTS + 1):
+        row = Row(id, " ".join(rand.sample(WORDS, 2)).title(),
+                  start + timedelta(minutes=rand.randrange(365 * 24 * 60)),
+                  " ".join(rand.choice(WORDS) for i in range(12)),
+                  rand.choice(("Oulu", "Helsinki", "Tampere", None)),
+                  rand.randint(1, 100), rand.randint(0, 500))
+        body["event_list"].append(EventCollection.serialize_item(row))
+    body.add_namespace("eventhub", "/eventhub/link-relations/")
+    body.add_control_all_events()
+    body.add_control_add_event()
+    return body
+
+
+def measure(func):
+    """
+    Returns the best time of func in milliseconds
+    """
+    return min(timeit.repeat(func, number=1, repeat=REPEAT)) * 1000
+
+
+def main():
+    mimetypes = [MASON] + ([MASON_MSGPACK] if msgpack is not None else [])
+    with app.test_request_context("/api/events/"):
+        body = build()
+        print("{} events".format(EVENTS))
+        print("  {:<32} {:>12} {:>12}".format("encoding", "encode ms", "bytes"))
+        for mimetype in mimetypes:
+            encoded = encode_mason(body, mimetype)
+            if isinstance(encoded, str):
+                encoded = encoded.encode("utf-8")
+            encode = measure(lambda: encode_mason(body, mimetype))
+            print("  {:<32} {:>12.1f} {:>12}".format(mimetype, encode, len(encoded)))
+            for coding, compressor in CODINGS.items():
+                for level in LEVELS[coding]:
+                    def compress():
+                        encoder = compressor(level)
+                        return encoder.compress(encoded) + encoder.finish()
+                    print("  {:<32} {:>12.1f} {:>12}".format(
+                        "  + {} {}".format(coding, level), encode + measure(compress),
+                        len(compress())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmark for the six main GET endpoints (the event, user and organization
+collections and items) with every JSON encoder in eventhub.encoding. The
+collections are read in one page of all their items. The response cache is
+off, so every request queries the database and encodes the document, and
+the encoders are checked to produce the same bytes. Besides the time of
+the whole request, the time of encoding the document alone is shown.
+
+Run from the repository root:
+    python benchmarks/bench_endpoints.py [events]
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eventhub import app, db
+from eventhub.encoding import JSON_ENCODERS
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+USERS = 5000
+ORGANIZATIONS = 1000
+REPEAT = 5
+STORED_TIME = "%Y-%m-%d %H:%M:%S.%f"
+
+ENDPOINTS = (
+    "/api/events/?limit={}".format(EVENTS),
+    "/api/events/1/",
+    "/api/users/?limit={}".format(USERS),
+    "/api/users/1/",
+    "/api/orgs/",
+    "/api/orgs/1/",
+)
+
+
+def build():
+    """
+    Fills the database of the app with events, users and organizations
+    """
+    db.create_all()
+    raw = db.engine.raw_connection()
+    rand = random.Random(EVENTS)
+    start = datetime(2020, 1, 1)
+    raw.executemany("INSERT INTO organization (id, name) VALUES (?, ?)",
+                    ((i, "Organization {}".format(i)) for i in range(1, ORGANIZATIONS + 1)))
+    raw.executemany(
+        "INSERT INTO user (id, name, email, pwdhash, location, notifications) "
+        "VALUES (?, ?, ?, 'x', 'Oulu', 0)",
+        ((i, "User {}".format(i), "user{}@example.com".format(i)) for i in range(1, USERS + 1)))
+    raw.executemany(
+        "INSERT INTO event (id, name, time, description, location, organization) "
+        "VALUES (?, ?, ?, ?, 'Oulu', ?)",
+        ((i, "Event {}".format(i),
+          (start + timedelta(minutes=rand.randrange(365 * 24 * 60))).strftime(STORED_TIME),
+          "Description of event {}".format(i), rand.randint(1, ORGANIZATIONS))
+         for i in range(1, EVENTS + 1)))
+    raw.commit()
+    raw.close()
+
+
+def measure(func):
+    """
+    Returns the best time of func in milliseconds
+    """
+    return min(timeit.repeat(func, number=1, repeat=REPEAT)) * 1000
+
+
+def main():
+    fd, path = tempfile.mkstemp()
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI="sqlite:///" + path,
+        RESPONSE_CACHE_BYTES=0,
+        MAX_PAGE_SIZE=max(EVENTS, USERS),
+    )
+    try:
+        build()
+        client = app.test_client()
+        print("{} events, {} users, {} organizations".format(EVENTS, USERS, ORGANIZATIONS))
+        print("  {:<28} {:>10}".format("endpoint", "bytes") +
+              "".join("{:>14}".format(name + " ms") for name in JSON_ENCODERS) +
+              "".join("{:>14}".format(name + " enc ms") for name in JSON_ENCODERS))
+        for url in ENDPOINTS:
+            requests = []
+            encodes = []
+            bodies = set()
+            for name, encode in JSON_ENCODERS.items():
+                app.config["JSON_ENCODER"] = name
+                response = client.get(url)
+                assert response.status_code == 200
+                bodies.add(response.data)
+                requests.append(measure(lambda: client.get(url)))
+                document = json.loads(response.data)
+                encodes.append(measure(lambda: encode(document)))
+            assert len(bodies) == 1, "the encoders differ for " + url
+            print("  {:<28} {:>10}".format(url, len(bodies.pop())) +
+                  "".join("{:>14.2f}".format(ms) for ms in requests + encodes))
+    finally:
+        app.config["JSON_ENCODER"] = None
+        db.session.remove()
+        os.close(fd)
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
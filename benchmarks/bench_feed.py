@@ -0,0 +1,92 @@
+"""
+Benchmark for the feed of a user: the next page of upcoming events a user
+follows or that belong to the user's organizations. Compares reading the
+feed table kept by the triggers (one range scan of the user's rows) with
+building the same page from following, associations and event on every
+request. The work of the join grows with the number of followed events,
+the feed table only reads the page.
+
+Run from the repository root:
+    python benchmarks/bench_feed.py
+"""
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from eventhub import db
+
+EVENTS = 100000
+ORGANIZATIONS = 1000
+FOLLOWED = (10, 100, 1000, 10000)
+MEMBERSHIPS = 5
+LIMIT = 20
+REPEAT = 20
+NOW = "2021-01-01 00:00:00.000000"
+STORED_TIME = "%Y-%m-%d %H:%M:%S.%f"
+
+FEED = (
+    "SELECT event.* FROM feed JOIN event ON event.id = feed.event_id "
+    "WHERE feed.user_id = ? AND feed.time >= ? ORDER BY feed.time, feed.event_id LIMIT {}"
+).format(LIMIT)
+JOIN = (
+    "SELECT * FROM event WHERE time >= :now AND ("
+    "id IN (SELECT event_id FROM following WHERE user_id = :user) OR "
+    "organization IN (SELECT org_id FROM associations WHERE user_id = :user)) "
+    "ORDER BY time, id LIMIT {}"
+).format(LIMIT)
+
+
+def build():
+    """
+    Creates an in-memory database with events over two years and one user
+    per entry of FOLLOWED following that many events, each a member of a
+    few organizations. The triggers fill the feed.
+    """
+    engine = create_engine("sqlite://")
+    db.Model.metadata.create_all(engine)
+    raw = engine.raw_connection()
+    rand = random.Random(EVENTS)
+    start = datetime(2020, 1, 1)
+    raw.executemany("INSERT INTO organization (id, name) VALUES (?, ?)",
+                    ((i, "org{}".format(i)) for i in range(1, ORGANIZATIONS + 1)))
+    raw.executemany(
+        "INSERT INTO event (id, name, time, description, organization) VALUES (?, 'e', ?, 'd', ?)",
+        ((i, (start + timedelta(minutes=rand.randrange(2 * 365 * 24 * 60))).strftime(STORED_TIME),
+          rand.randint(1, ORGANIZATIONS)) for i in range(1, EVENTS + 1)))
+    for user, followed in enumerate(FOLLOWED, 1):
+        raw.execute("INSERT INTO user (id, name, email, pwdhash, notifications) "
+                    "VALUES (?, 'u', ?, 'x', 0)", (user, "user{}".format(user)))
+        raw.executemany("INSERT INTO following (user_id, event_id) VALUES (?, ?)",
+                        ((user, event) for event in rand.sample(range(1, EVENTS + 1), followed)))
+        raw.executemany("INSERT INTO associations (user_id, org_id) VALUES (?, ?)",
+                        ((user, org) for org in rand.sample(range(1, ORGANIZATIONS + 1), MEMBERSHIPS)))
+    raw.commit()
+    raw.execute("ANALYZE")
+    return raw
+
+
+def main():
+    raw = build()
+    print("{} events, {} per page".format(EVENTS, LIMIT))
+    print("  {:>8} {:>12} {:>12}".format("followed", "join ms", "feed ms"))
+    for user, followed in enumerate(FOLLOWED, 1):
+        join = min(timeit.repeat(
+            lambda: raw.execute(JOIN, {"now": NOW, "user": user}).fetchall(),
+            number=1, repeat=REPEAT))
+        feed = min(timeit.repeat(lambda: raw.execute(FEED, (user, NOW)).fetchall(),
+                                 number=1, repeat=REPEAT))
+        assert raw.execute(JOIN, {"now": NOW, "user": user}).fetchall() == \
+            raw.execute(FEED, (user, NOW)).fetchall()
+        print("  {:>8} {:>12.3f} {:>12.3f}".format(followed, join * 1e3, feed * 1e3))
+    print("  plan: {}".format("; ".join(
+        row[-1] for row in raw.execute("EXPLAIN QUERY PLAN " + FEED, (1, NOW)))))
+    raw.close()
+
+
+if __name__ == "__main__":
+    main()
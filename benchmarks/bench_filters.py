@@ -0,0 +1,109 @@
+"""
+Benchmark for the filters and the time order of the event collection. Builds
+the SQL of a page the same way EventCollection does for combinations of the
+organization, location, from/to and sort parameters and times it on a table
+of events with and without the filter indexes (event.time,
+(organization, time) and (location, time)). Without them a filter scans the
+table or sorts all matching events; with them it reads only the page.
+
+Run from the repository root:
+    python benchmarks/bench_filters.py [events]
+"""
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+from eventhub import app, db
+from eventhub.resources.EventCollection import EventCollection
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+ORGANIZATIONS = 1000
+LOCATIONS = 200
+LIMIT = 100
+REPEAT = 10
+# how the DateTime column of the event time is stored in SQLite
+STORED_TIME = "%Y-%m-%d %H:%M:%S.%f"
+FILTER_INDEXES = ("ix_event_time", "ix_event_organization_time", "ix_event_location_time")
+
+QUERIES = (
+    "organization=7",
+    "location=City+7",
+    "from=2021-03-01&to=2021-03-08",
+    "organization=7&from=2021-01-01&to=2021-07-01",
+    "sort=time",
+    "sort=time&from=2021-03-01",
+    "organization=7&sort=time",
+    "location=City+7&from=2021-03-01&sort=time",
+)
+
+
+def build(events, indexed):
+    """
+    Creates an in-memory database with the tables of the models and the
+    given number of events spread over two years, organizations and
+    locations
+    """
+    engine = create_engine("sqlite://")
+    db.Model.metadata.create_all(engine)
+    raw = engine.raw_connection()
+    if not indexed:
+        for index in FILTER_INDEXES:
+            raw.execute("DROP INDEX {}".format(index))
+    rand = random.Random(events)
+    start = datetime(2020, 1, 1)
+    raw.executemany(
+        "INSERT INTO organization (id, name) VALUES (?, ?)",
+        ((i, "org{}".format(i)) for i in range(1, ORGANIZATIONS + 1))
+    )
+    raw.executemany(
+        "INSERT INTO event (id, name, time, description, location, organization) "
+        "VALUES (?, 'e', ?, 'd', ?, ?)",
+        ((i, (start + timedelta(minutes=rand.randrange(2 * 365 * 24 * 60))).strftime(STORED_TIME),
+          "City {}".format(rand.randint(1, LOCATIONS)), rand.randint(1, ORGANIZATIONS))
+         for i in range(1, events + 1))
+    )
+    raw.commit()
+    raw.execute("ANALYZE")
+    return raw
+
+
+def page_sql(query_string):
+    """
+    Returns the SQL of the first page of the event collection for a query
+    string, as built by EventCollection
+    """
+    with app.test_request_context("/api/events/?" + query_string):
+        query, columns = EventCollection.filter_query()
+        statement = query.order_by(*columns).limit(LIMIT + 1).statement
+    return str(statement.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def main():
+    print("{} events, {} per page".format(EVENTS, LIMIT))
+    times = {}
+    plans = {}
+    for indexed in (False, True):
+        raw = build(EVENTS, indexed)
+        for query_string in QUERIES:
+            sql = page_sql(query_string)
+            seconds = min(timeit.repeat(lambda: raw.execute(sql).fetchall(),
+                                        number=1, repeat=REPEAT))
+            times.setdefault(query_string, []).append(seconds * 1e3)
+            if indexed:
+                plans[query_string] = "; ".join(
+                    row[-1] for row in raw.execute("EXPLAIN QUERY PLAN " + sql))
+        raw.close()
+    print("  {:<45} {:>10} {:>10}".format("query", "scan ms", "index ms"))
+    for query_string in QUERIES:
+        print("  {:<45} {:>10.2f} {:>10.2f}".format(query_string, *times[query_string]))
+        print("      {}".format(plans[query_string]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Microbenchmark for building item hrefs. Compares the old way of creating an
+Api for the app and calling url_for with the cached href templates in
+eventhub.utils.
+
+Run from the repository root:
+    python benchmarks/bench_hrefs.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_restful import Api
+from eventhub import app
+from eventhub.resources.EventItem import EventItem
+from eventhub.utils import event_href
+
+ROUNDS = 20000
+
+
+def url_for_per_item(id):
+    api = Api(app)
+    return api.url_for(EventItem, id=id)
+
+
+def main():
+    with app.test_request_context("/api/events/"):
+        assert url_for_per_item(42) == event_href(42)
+        for name, func in (("Api(app).url_for", url_for_per_item),
+                           ("event_href", event_href)):
+            seconds = min(timeit.repeat(lambda: func(42), number=ROUNDS, repeat=3))
+            print("{:<20} {:8.2f} us/item".format(name, seconds / ROUNDS * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark for the reverse lookups of the association tables: the users of an
+event (following.event_id), the users of an organization (associations.org_id)
+and the events of an organization (event.organization). Every lookup is timed
+on tables of growing size with and without the secondary indexes. Without
+them the time grows with the table (full scan), with them it stays nearly
+flat (B-tree search, logarithmic in the table size).
+
+Run from the repository root:
+    python benchmarks/bench_indexes.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from eventhub import db
+from eventhub.migrations import create_missing_indexes
+
+SIZES = (1000, 10000, 100000)
+LOOKUPS = 200
+
+QUERIES = {
+    "following.event_id": "SELECT user_id FROM following WHERE event_id = ?",
+    "associations.org_id": "SELECT user_id FROM associations WHERE org_id = ?",
+    "event.organization": "SELECT id FROM event WHERE organization = ?",
+}
+
+
+def build(rows, indexed):
+    """
+    Creates an in-memory database with the tables of the models and fills the
+    association tables and the events with about the given number of rows
+    """
+    engine = create_engine("sqlite://")
+    db.Model.metadata.create_all(engine)
+    raw = engine.raw_connection()
+    if not indexed:
+        for index in ("ix_following_event_id", "ix_associations_org_id", "ix_event_organization"):
+            raw.execute("DROP INDEX {}".format(index))
+    users = rows // 10
+    targets = rows // 10
+    rand = random.Random(rows)
+    raw.executemany(
+        "INSERT INTO organization (id, name) VALUES (?, ?)",
+        ((i, "org{}".format(i)) for i in range(1, targets + 1))
+    )
+    raw.executemany(
+        "INSERT INTO event (id, name, time, description, organization) VALUES (?, 'e', 't', 'd', ?)",
+        ((i, rand.randint(1, targets)) for i in range(1, rows + 1))
+    )
+    pairs = {(rand.randint(1, users), rand.randint(1, targets)) for _ in range(rows)}
+    raw.executemany("INSERT INTO following (user_id, event_id) VALUES (?, ?)", pairs)
+    raw.executemany("INSERT INTO associations (user_id, org_id) VALUES (?, ?)", pairs)
+    raw.commit()
+    raw.execute("ANALYZE")
+    return raw, targets
+
+
+def main():
+    for name, query in QUERIES.items():
+        print(name)
+        print("  {:>8} {:>12} {:>12}".format("rows", "scan us", "index us"))
+        for rows in SIZES:
+            times = []
+            for indexed in (False, True):
+                raw, targets = build(rows, indexed)
+                keys = [random.randint(1, targets) for _ in range(LOOKUPS)]
+                lookup = lambda: [raw.execute(query, (key,)).fetchall() for key in keys]
+                seconds = min(timeit.repeat(lookup, number=1, repeat=3))
+                times.append(seconds / LOOKUPS * 1e6)
+                if indexed and rows == SIZES[-1]:
+                    plan = raw.execute("EXPLAIN QUERY PLAN " + query, (1,)).fetchall()
+                raw.close()
+            print("  {:>8} {:>12.2f} {:>12.2f}".format(rows, *times))
+        print("  plan: {}".format(plan[0][-1]))
+
+
+if __name__ == "__main__":
+    main()
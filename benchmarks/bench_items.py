@@ -0,0 +1,110 @@
+"""
+Benchmark for the list items of the event collection. Compares building a
+MasonBuilder per event, as the collections did, with the MasonItems of
+EVENT_ITEM that keep the row and are turned into documents by the JSON
+encoder. Shows the objects allocated and kept per item while the list is
+built, the peak memory of building and encoding the list and the time of
+both, for every JSON encoder.
+
+Run from the repository root:
+    python benchmarks/bench_items.py [events]
+"""
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from eventhub import app
+from eventhub.encoding import JSON_ENCODERS
+from eventhub.resources.EventCollection import EVENT_ITEM
+from eventhub.utils import MasonBuilder, InventoryBuilder, event_href, format_time
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+REPEAT = 5
+
+Row = namedtuple("Row", "id name time description location organization follower_count")
+
+
+def builder_items(rows):
+    """
+    The list items of events as MasonBuilders
+    """
+    return [builder_item(row) for row in rows]
+
+
+def builder_item(item):
+    """
+    The list item of an event as a MasonBuilder
+    """
+    event = MasonBuilder(
+        name=item.name,
+        time=format_time(item.time),
+        description=item.description,
+        location=item.location,
+        organization=item.organization,
+        follower_count=item.follower_count
+    )
+    event.add_control("self", event_href(item.id))
+    event.add_control("profile", "/profiles/event/")
+    return event
+
+
+def layout_items(rows):
+    """
+    The list items of events as MasonItems
+    """
+    return list(EVENT_ITEM.items(rows))
+
+
+def build(rows, serialize):
+    body = InventoryBuilder(event_list=serialize(rows))
+    body.add_control_all_events()
+    return body
+
+
+def allocations(rows, serialize):
+    """
+    Returns the memory blocks allocated while building the list and still
+    held by it, per item, and the peak bytes of building and encoding it
+    """
+    gc.collect()
+    tracemalloc.start()
+    body = build(rows, serialize)
+    kept = tracemalloc.take_snapshot().statistics("filename")
+    for encode in JSON_ENCODERS.values():
+        encode(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count for stat in kept if not stat.traceback[0].filename.endswith(
+        "tracemalloc.py"))
+    return blocks / len(rows), peak
+
+
+def main():
+    start = datetime(2020, 1, 1)
+    rows = [Row(i, "Event {}".format(i), start + timedelta(minutes=i), "Description", "Oulu",
+                i % 100 + 1, i % 7) for i in range(1, EVENTS + 1)]
+    with app.test_request_context("/api/events/"):
+        for encode in JSON_ENCODERS.values():
+            assert encode(build(rows, builder_items)) == encode(build(rows, layout_items))
+        print("{} events".format(EVENTS))
+        print("  {:<14} {:>12} {:>10} {:>10}".format("item", "blocks/item", "peak MB", "build ms") +
+              "".join("{:>14}".format(name + " ms") for name in JSON_ENCODERS))
+        for name, serialize in (("MasonBuilder", builder_items), ("MasonItem", layout_items)):
+            blocks, peak = allocations(rows, serialize)
+            body = build(rows, serialize)
+            times = [min(timeit.repeat(lambda: build(rows, serialize), number=1, repeat=REPEAT))]
+            times += [min(timeit.repeat(lambda: encode(body), number=1, repeat=REPEAT))
+                      for encode in JSON_ENCODERS.values()]
+            print("  {:<14} {:>12.1f} {:>10.1f}".format(name, blocks, peak / 2 ** 20) +
+                  "{:>10.1f}".format(times[0] * 1000) +
+                  "".join("{:>14.1f}".format(seconds * 1000) for seconds in times[1:]))
+
+
+if __name__ == "__main__":
+    main()
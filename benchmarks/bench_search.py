@@ -0,0 +1,125 @@
+"""
+Benchmark for the full text search of events. Fills an in-memory database
+with synthetic events, lets the triggers build the FTS5 index and times
+ranked searches for rare, common and multi-word queries, first page and a
+page deep in the results. bm25 scores every match it ranks, so a common
+word is slow when all matches are ranked; ranking only the newest
+SEARCH_CANDIDATES matches keeps it fast. Also compares with the LIKE scan
+the search replaces.
+
+Run from the repository root (the default is a million events, which takes
+a few minutes to build):
+    python benchmarks/bench_search.py [events]
+"""
+import itertools
+import os
+import random
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from eventhub import db
+
+EVENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+LIMIT = 20
+REPEAT = 20
+
+# word frequencies follow roughly Zipf's law, like in real text
+WORDS = ["word{}".format(i) for i in range(20000)]
+CUM_WEIGHTS = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(WORDS))))
+
+CANDIDATES = 2000
+
+WINDOW = (
+    "SELECT min(rowid), max(rowid) FROM (SELECT rowid FROM event_fts "
+    "WHERE event_fts MATCH ? ORDER BY rowid DESC LIMIT ?)"
+)
+SEARCH = (
+    "SELECT event.*, event_fts.rank FROM event_fts JOIN event ON event.id = event_fts.rowid "
+    "WHERE event_fts MATCH ? AND event_fts.rowid BETWEEN ? AND ? "
+    "ORDER BY event_fts.rank, event_fts.rowid LIMIT ?"
+)
+SEEK = (
+    "SELECT event.*, event_fts.rank FROM event_fts JOIN event ON event.id = event_fts.rowid "
+    "WHERE event_fts MATCH ? AND event_fts.rowid BETWEEN ? AND ? "
+    "AND (event_fts.rank > ? OR (event_fts.rank = ? AND event_fts.rowid > ?)) "
+    "ORDER BY event_fts.rank, event_fts.rowid LIMIT ?"
+)
+LIKE = "SELECT * FROM event WHERE name LIKE ? OR description LIKE ? LIMIT {}".format(LIMIT)
+
+QUERIES = {
+    "rare word": '"word15000"',
+    "medium word": '"word500"',
+    "common word": '"word5"',
+    "two words": '"word50" "word60"',
+}
+
+
+def build(events):
+    """
+    Creates an in-memory database with the tables of the models and the
+    given number of events
+    """
+    engine = create_engine("sqlite://")
+    db.Model.metadata.create_all(engine)
+    raw = engine.raw_connection()
+    rand = random.Random(events)
+
+    def text(words):
+        return " ".join(rand.choices(WORDS, cum_weights=CUM_WEIGHTS, k=words))
+
+    raw.executemany(
+        "INSERT INTO event (id, name, time, description, location) VALUES (?, ?, 't', ?, ?)",
+        ((i, text(3), text(20), text(2)) for i in range(1, events + 1))
+    )
+    raw.commit()
+    return raw
+
+
+def search(raw, query, candidates):
+    """
+    Times the first and the tenth page of a search like the search endpoint
+    does it, ranking the given number of newest matches (-1 for all)
+    """
+    def first_page():
+        low, high = raw.execute(WINDOW, (query, candidates)).fetchone()
+        return raw.execute(SEARCH, (query, low, high, LIMIT)).fetchall()
+
+    first = min(timeit.repeat(first_page, number=1, repeat=REPEAT))
+    # the cursor of the tenth page, like a client following "next" links
+    low, high = raw.execute(WINDOW, (query, candidates)).fetchone()
+    rows = raw.execute(SEARCH, (query, low, high, LIMIT * 9)).fetchall()
+    if len(rows) < LIMIT * 9:
+        return first, None
+    rank, id = rows[-1][-1], rows[-1][0]
+    deep = min(timeit.repeat(
+        lambda: raw.execute(SEEK, (query, low, high, rank, rank, id, LIMIT)).fetchall(),
+        number=1, repeat=REPEAT))
+    return first, deep
+
+
+def main():
+    raw = build(EVENTS)
+    print("{} events, {} per page, first page / tenth page in ms".format(EVENTS, LIMIT))
+    print("  {:<12} {:>8} {:>18} {:>18} {:>10}".format(
+        "query", "matches", "rank all", "rank {}".format(CANDIDATES), "LIKE"))
+    for name, query in QUERIES.items():
+        matches = raw.execute("SELECT count(*) FROM event_fts WHERE event_fts MATCH ?",
+                              (query,)).fetchone()[0]
+        times = []
+        for candidates in (-1, CANDIDATES):
+            first, deep = search(raw, query, candidates)
+            times.append("{:.2f} / {}".format(
+                first * 1e3, "-" if deep is None else "{:.2f}".format(deep * 1e3)))
+        pattern = "%{}%".format(query.split('"')[1])
+        like = min(timeit.repeat(lambda: raw.execute(LIKE, (pattern, pattern)).fetchall(),
+                                 number=1, repeat=3))
+        print("  {:<12} {:>8} {:>18} {:>18} {:>10.2f}".format(
+            name, matches, times[0], times[1], like * 1e3))
+    raw.close()
+
+
+if __name__ == "__main__":
+    main()
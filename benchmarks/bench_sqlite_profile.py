@@ -0,0 +1,110 @@
+"""
+Benchmark for concurrent reads and writes on SQLite with the default settings
+and with the profile of create_app (SQLITE_PRAGMAS) and a connection pool.
+Writer threads insert events one per transaction, like POST /api/events/,
+while reader threads fetch single events and pages of events. Reports the
+throughput of both and the number of "database is locked" errors.
+
+Run from the repository root:
+    python benchmarks/bench_sqlite_profile.py
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool, QueuePool
+from eventhub import app, db
+from eventhub.utils import apply_sqlite_profile
+
+DURATION = 3
+WRITERS = 4
+READERS = 4
+ROWS = 10000
+
+INSERT = text("INSERT INTO event (name, time, description, location, organization) "
+              "VALUES ('Karaoke', '2020-05-05T18:00:00', 'Something', 'Oulu', NULL)")
+READ_ONE = text("SELECT * FROM event WHERE id = :id")
+READ_PAGE = text("SELECT * FROM event WHERE id > :id ORDER BY id LIMIT 100")
+
+
+def make_engine(path, profile):
+    if not profile:
+        # what the app had before: a new connection per checkout and the
+        # rollback journal with full fsync
+        return create_engine("sqlite:///" + path, poolclass=NullPool,
+                             connect_args={"check_same_thread": False})
+    options = dict(app.config["SQLALCHEMY_ENGINE_OPTIONS"])
+    engine = create_engine("sqlite:///" + path, poolclass=QueuePool,
+                           pool_size=WRITERS + READERS, **options)
+    apply_sqlite_profile(engine, app.config["SQLITE_PRAGMAS"])
+    return engine
+
+
+def run(engine):
+    db.Model.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for _ in range(ROWS):
+            connection.execute(INSERT)
+    counts = {"writes": 0, "reads": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + DURATION
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def writer():
+        while time.monotonic() < deadline:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(INSERT)
+                count("writes")
+            except OperationalError:
+                count("locked")
+
+    def reader(number):
+        n = 0
+        while time.monotonic() < deadline:
+            n += 1
+            try:
+                with engine.connect() as connection:
+                    if n % 2:
+                        connection.execute(READ_ONE, id=(n * 7919 + number) % ROWS + 1).fetchall()
+                    else:
+                        connection.execute(READ_PAGE, id=(n * 7919 + number) % ROWS).fetchall()
+                count("reads")
+            except OperationalError:
+                count("locked")
+
+    threads = [threading.Thread(target=writer) for _ in range(WRITERS)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(READERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    return counts
+
+
+def main():
+    print("{:<10} {:>12} {:>12} {:>8}".format("settings", "writes/s", "reads/s", "locked"))
+    for name, profile in (("default", False), ("profile", True)):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "bench.db")
+        counts = run(make_engine(path, profile))
+        print("{:<10} {:>12.0f} {:>12.0f} {:>8}".format(
+            name, counts["writes"] / DURATION, counts["reads"] / DURATION, counts["locked"]))
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+        os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
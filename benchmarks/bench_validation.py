@@ -0,0 +1,41 @@
+"""
+Microbenchmark for validating request documents. Compares jsonschema.validate
+with a freshly built schema (the old way) with the validators compiled once
+in eventhub.utils.
+
+Run from the repository root:
+    python benchmarks/bench_validation.py
+"""
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jsonschema import validate
+from eventhub.utils import EVENT_VALIDATOR, compile_validator, InventoryBuilder
+
+ROUNDS = 2000
+
+DOCUMENT = {
+    "name": "Karaoke",
+    "time": "2020-05-05T18:00:00",
+    "description": "Something",
+    "location": "Routa, Oulu",
+    "organization": 1
+}
+
+
+def main():
+    schema = json.loads(json.dumps(InventoryBuilder.event_schema()))
+    full = compile_validator(schema, fast=False)
+    for name, func in (("jsonschema.validate", lambda: validate(DOCUMENT, schema)),
+                       ("compiled validator", lambda: full.validate(DOCUMENT)),
+                       ("fast path", lambda: EVENT_VALIDATOR.validate(DOCUMENT))):
+        seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+        print("{:<20} {:8.2f} us/document".format(name, seconds / ROUNDS * 1e6))
+
+
+if __name__ == "__main__":
+    main()
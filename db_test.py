@@ -5,11 +5,13 @@ import time
 import sys
 from datetime import datetime
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, create_engine
 from sqlalchemy.exc import IntegrityError, StatementError
 
 from eventhub import  db,app
 from eventhub.models import Event, User, Organization, OrgsAndUsers, EventsAndUsers
+from eventhub.migrations import upgrade, MIGRATIONS, add_event_search, convert_event_times, add_feed, \
+    add_counters, MigrationError, parse_legacy_time
 
 sys.path.append('../')
 
@@ -54,7 +56,7 @@ def _get_org():
 def _get_event():
     return Event(
         name="Test event",
-        time = "05.05.2020",
+        time = datetime(2020, 5, 5),
         description="Something",
         location="Oulu",
         organization="1"
@@ -154,7 +156,7 @@ def test_event_values(db_handle):
     """
     
     event = _get_event()
-    event.time = "12:05"
+    event.time = datetime(2020, 5, 5, 12, 5)
     event.organization = "something"
     db_handle.session.add(event)
     with pytest.raises(StatementError):
@@ -251,6 +253,209 @@ def test_associations_ondelete_org(db_handle):
     assert association_1 is None
 
 
+def test_reverse_lookup_indexes(db_handle):
+    """
+    Finding the users of an event or an organization and the events of an
+    organization uses an index, also on databases created before the indexes
+    existed once they are upgraded.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    db_handle.Model.metadata.create_all(engine)
+    for index in ("ix_following_event_id", "ix_associations_org_id", "ix_event_organization"):
+        engine.execute("DROP INDEX {}".format(index))
+    assert upgrade(engine) == len(MIGRATIONS)
+    assert upgrade(engine) == 0
+    for query in ("SELECT user_id FROM following WHERE event_id = 1",
+                  "SELECT user_id FROM associations WHERE org_id = 1",
+                  "SELECT id FROM event WHERE organization = 1"):
+        plan = engine.execute("EXPLAIN QUERY PLAN " + query).fetchall()
+        assert "USING" in plan[0][-1] and "INDEX ix_" in plan[0][-1]
+    engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_event_search_migration(db_handle):
+    """
+    Upgrading a database from before the full text index indexes the events
+    already in it and the triggers keep the index up to date.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    db_handle.Model.metadata.create_all(engine)
+    for trigger in ("event_fts_inserted", "event_fts_deleted", "event_fts_updated"):
+        engine.execute("DROP TRIGGER {}".format(trigger))
+    engine.execute("DROP TABLE event_fts")
+    engine.execute("INSERT INTO event (name, time, description) VALUES ('Karaoke', '2020-02-02', 'Sing')")
+    step = MIGRATIONS.index(add_event_search)
+    engine.execute("PRAGMA user_version = {:d}".format(step))
+    assert upgrade(engine) == len(MIGRATIONS) - step
+    query = "SELECT rowid FROM event_fts WHERE event_fts MATCH ? ORDER BY rank"
+    assert engine.execute(query, "karaoke").fetchall() == [(1,)]
+    engine.execute("UPDATE event SET name = 'Disco' WHERE id = 1")
+    assert engine.execute(query, "karaoke").fetchall() == []
+    assert engine.execute(query, "disco").fetchall() == [(1,)]
+    engine.execute("DELETE FROM event")
+    assert engine.execute(query, "disco").fetchall() == []
+    engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_convert_event_times(db_handle):
+    """
+    Upgrading a database from before the typed event times turns the free
+    text times into datetimes, or fails if one of them isn't a time.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    db_handle.Model.metadata.create_all(engine)
+    times = ["2020-02-02", "05.05.2020", "05.05.2020 18:30", "2020-05-05T18:30:00+03:00",
+             "9:23", "sometime", "2020-02-02 00:00:00.000000"]
+    for time in times:
+        engine.execute("INSERT INTO event (name, time, description) VALUES ('e', ?, 'd')", time)
+    step = MIGRATIONS.index(convert_event_times)
+    engine.execute("PRAGMA user_version = {:d}".format(step))
+
+    # a time that can't be parsed, or has no date, stops the upgrade and
+    # nothing changes
+    with pytest.raises(ValueError):
+        parse_legacy_time("9:23")
+    with pytest.raises(MigrationError) as error:
+        upgrade(engine)
+    assert "event 5: '9:23'" in str(error.value)
+    assert "event 6: 'sometime'" in str(error.value)
+    assert engine.execute("PRAGMA user_version").scalar() == step
+    assert [row[0] for row in engine.execute("SELECT time FROM event ORDER BY id")] == times
+
+    engine.execute("UPDATE event SET time = '01.01.2020 9:23' WHERE id = 5")
+    engine.execute("UPDATE event SET time = '06.05.2020' WHERE id = 6")
+    assert upgrade(engine) == len(MIGRATIONS) - step
+    table = Event.__table__
+    rows = engine.execute(table.select().order_by(table.c.id)).fetchall()
+    assert [row.time for row in rows] == [
+        datetime(2020, 2, 2), datetime(2020, 5, 5), datetime(2020, 5, 5, 18, 30),
+        datetime(2020, 5, 5, 15, 30), datetime(2020, 1, 1, 9, 23), datetime(2020, 5, 6),
+        datetime(2020, 2, 2)
+    ]
+    # the stored form sorts in time order
+    ordered = engine.execute("SELECT id FROM event ORDER BY time, id").fetchall()
+    assert [row[0] for row in ordered] == [5, 1, 7, 2, 4, 3, 6]
+    engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_feed(db_handle):
+    """
+    Upgrading a database from before the feed fills it from the followed
+    events and the memberships, and the triggers keep it up to date when
+    an event changes organization.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    db_handle.Model.metadata.create_all(engine)
+    for trigger in engine.execute("SELECT name FROM sqlite_master "
+                                  "WHERE type = 'trigger' AND name LIKE 'feed%'").fetchall():
+        engine.execute("DROP TRIGGER {}".format(trigger[0]))
+    engine.execute("DROP TABLE feed")
+    engine.execute("INSERT INTO user (id, name, email, pwdhash, notifications) "
+                   "VALUES (1, 'a', 'a', 'x', 0), (2, 'b', 'b', 'x', 0)")
+    engine.execute("INSERT INTO organization (id, name) VALUES (1, 'org1'), (2, 'org2')")
+    for id, organization in ((1, 1), (2, 2), (3, 2)):
+        engine.execute("INSERT INTO event (id, name, time, description, organization) "
+                       "VALUES (?, 'e', ?, 'd', ?)", id, "2100-01-0{} 00:00:00.000000".format(4 - id),
+                       organization)
+    engine.execute("INSERT INTO following (user_id, event_id) VALUES (1, 2)")
+    engine.execute("INSERT INTO associations (user_id, org_id) VALUES (1, 1), (2, 2)")
+    step = MIGRATIONS.index(add_feed)
+    engine.execute("PRAGMA user_version = {:d}".format(step))
+    assert upgrade(engine) == len(MIGRATIONS) - step
+
+    def feed():
+        return engine.execute("SELECT user_id, event_id FROM feed ORDER BY user_id, time").fetchall()
+
+    assert feed() == [(1, 2), (1, 1), (2, 3), (2, 2)]
+    engine.execute("UPDATE event SET organization = 1 WHERE id = 2")
+    assert feed() == [(1, 2), (1, 1), (2, 3)]
+    engine.execute("UPDATE event SET organization = 2 WHERE id = 1")
+    assert feed() == [(1, 2), (2, 3), (2, 1)]
+
+    plan = engine.execute("EXPLAIN QUERY PLAN SELECT event_id FROM feed WHERE user_id = 1 "
+                          "AND time >= '2000' ORDER BY time, event_id").fetchall()
+    assert [row[-1] for row in plan] == ["SEARCH feed USING PRIMARY KEY (user_id=? AND time>?)"]
+    engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_counters(db_handle):
+    """
+    Upgrading a database from before the counters counts the existing
+    followers and members, and the triggers keep the counts.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    db_handle.Model.metadata.create_all(engine)
+    for trigger in ("following_counted", "following_uncounted", "following_recounted",
+                    "associations_counted", "associations_uncounted", "associations_recounted"):
+        engine.execute("DROP TRIGGER {}".format(trigger))
+    engine.execute("INSERT INTO user (id, name, email, pwdhash, notifications) "
+                   "VALUES (1, 'a', 'a', 'x', 0), (2, 'b', 'b', 'x', 0)")
+    engine.execute("INSERT INTO organization (id, name) VALUES (1, 'org1'), (2, 'org2')")
+    engine.execute("INSERT INTO event (id, name, time, description, organization) "
+                   "VALUES (1, 'e', '2020-01-01 00:00:00.000000', 'd', 1), "
+                   "(2, 'e', '2020-01-01 00:00:00.000000', 'd', 1)")
+    engine.execute("INSERT INTO following (user_id, event_id) VALUES (1, 1), (2, 1), (1, 2)")
+    engine.execute("INSERT INTO associations (user_id, org_id) VALUES (1, 1), (2, 1)")
+    step = MIGRATIONS.index(add_counters)
+    engine.execute("PRAGMA user_version = {:d}".format(step))
+    assert upgrade(engine) == len(MIGRATIONS) - step
+
+    def counts():
+        return (engine.execute("SELECT follower_count FROM event ORDER BY id").fetchall(),
+                engine.execute("SELECT member_count FROM organization ORDER BY id").fetchall())
+
+    assert counts() == ([(2,), (1,)], [(2,), (0,)])
+    engine.execute("UPDATE following SET event_id = 2 WHERE user_id = 2")
+    engine.execute("UPDATE associations SET org_id = 2 WHERE user_id = 2")
+    assert counts() == ([(1,), (2,)], [(1,), (1,)])
+    engine.execute("DELETE FROM following WHERE user_id = 1")
+    assert counts() == ([(0,), (1,)], [(1,), (1,)])
+    engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_sqlite_profile(db_handle):
+    """
+    Every connection of the app gets the pragmas of SQLITE_PRAGMAS, and
+    only those of the app.
+    """
+    connection = db_handle.engine.raw_connection()
+    try:
+        for name, value in app.config["SQLITE_PRAGMAS"].items():
+            result = connection.execute("PRAGMA {}".format(name)).fetchone()[0]
+            if name == "journal_mode":
+                assert result == value.lower()
+            elif name in ("synchronous", "foreign_keys"):
+                assert result == {"OFF": 0, "NORMAL": 1, "ON": 1}[value]
+            else:
+                assert result == value
+    finally:
+        connection.close()
+
+    # other engines in the process keep the SQLite defaults
+    db_fd, db_fname = tempfile.mkstemp()
+    engine = create_engine("sqlite:///" + db_fname)
+    assert engine.execute("PRAGMA journal_mode").scalar() == "delete"
+    assert engine.execute("PRAGMA mmap_size").scalar() == 0
+    engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
 User.query.delete()
 Organization.query.delete()
 Event.query.delete()
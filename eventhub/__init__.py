@@ -6,9 +6,26 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_restful import Api
 from sqlalchemy import event
 from sqlalchemy.engine import Engine
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-db = SQLAlchemy()
-import json
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, SCHEMAS
+from eventhub.utils import apply_sqlite_profile
+from eventhub.encoding import negotiate_coding, compress_response, dump_json, JSON_ENCODERS
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy that applies the SQLITE_PRAGMAS of the app to the engines it
+    creates. Flask-SQLAlchemy creates a new engine when
+    SQLALCHEMY_DATABASE_URI changes, and other engines in the process are
+    left alone.
+    """
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(ProfiledSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        apply_sqlite_profile(engine, self.get_app().config["SQLITE_PRAGMAS"])
+        return engine
+
+
+db = ProfiledSQLAlchemy()
 
 
 
@@ -21,12 +38,62 @@ def create_app(test_config=None):
         SECRET_KEY='dev',
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "test.db"),
         DATABASE=os.path.join(app.instance_path, 'eventhub.sqlite'),
-        SQLALCHEMY_TRACK_MODIFICATIONS = False
+        SQLALCHEMY_TRACK_MODIFICATIONS = False,
+        # default and maximum number of items on a page of a collection
+        PAGE_SIZE=100,
+        MAX_PAGE_SIZE=1000,
+        # streamed collections: rows fetched per query round trip and the
+        # approximate size of the chunks sent to the client
+        STREAM_BATCH_SIZE=500,
+        STREAM_CHUNK_SIZE=64 * 1024,
+        # password hashing pool: worker processes (None for one per CPU, 0
+        # to hash in the request thread), passwords that can wait for the
+        # pool (None for 4 per worker) and seconds to wait for a free slot
+        HASH_POOL_SIZE=None,
+        HASH_MAX_PENDING=None,
+        HASH_QUEUE_TIMEOUT=5,
+        # batch endpoints: items inserted per transaction
+        BATCH_CHUNK_SIZE=1000,
+        # full text search: matches ranked at most, newest first (None ranks
+        # them all). bm25 scores every ranked match, so a number bounds the
+        # time of a search for a common word, but the older matches are left
+        # out and the results are marked truncated
+        SEARCH_CANDIDATES=None,
+        # cache of serialized GET responses: total size in bytes (0 turns it
+        # off), seconds an entry is served at most and where it is kept:
+        # "memory" in each process or "sqlite" shared by the workers in the
+        # RESPONSE_CACHE_PATH file (None for instance/response-cache.sqlite)
+        RESPONSE_CACHE_BYTES=32 * 1024 * 1024,
+        RESPONSE_CACHE_TTL=60,
+        RESPONSE_CACHE_BACKEND="memory",
+        RESPONSE_CACHE_PATH=None,
+        # compression: responses of at least COMPRESS_MIN_SIZE bytes (None
+        # turns it off) are sent gzip or brotli compressed to clients that
+        # accept it, at the level of each coding
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_LEVELS={"gzip": 6, "br": 5},
+        # JSON encoder of the responses, a name in JSON_ENCODERS of
+        # eventhub.encoding (None for orjson when it is installed)
+        JSON_ENCODER=None,
+        SQLALCHEMY_ENGINE_OPTIONS={
+            "connect_args": {"check_same_thread": False}
+        },
+        # pragmas run on every new SQLite connection, in this order: wait up
+        # to 5 s for locks, write-ahead log so readers don't block the writer,
+        # fsync only at checkpoints, 256 MB memory map, 16 MB page cache
+        SQLITE_PRAGMAS={
+            "busy_timeout": 5000,
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -16000,
+            "foreign_keys": "ON"
+        }
     )
 
     # app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///test.db"
     
-    db = SQLAlchemy(app)
+    db = ProfiledSQLAlchemy(app)
 
     if test_config is None:
         # load the instance config, if it exists, when not testing
@@ -41,6 +108,16 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    # orjson is only in JSON_ENCODERS when it is installed
+    encoder = app.config["JSON_ENCODER"]
+    if encoder is not None and encoder not in JSON_ENCODERS:
+        raise ValueError("JSON_ENCODER {!r} is not available, use one of {}".format(
+            encoder, ", ".join(JSON_ENCODERS)))
+
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, negotiate_coding())
 
     @app.route('/profiles/<resource>/')
     def send_profile(resource):
@@ -50,6 +127,23 @@ def create_app(test_config=None):
     def something():
         return 'link-relations'
 
+    @app.route('/metrics/')
+    def send_metrics():
+        from eventhub.hashing import get_password_hasher
+        from eventhub.cache import get_response_cache
+        body = {
+            "password_hashing": get_password_hasher().stats(),
+            "response_cache": get_response_cache().stats()
+        }
+        return app.response_class(dump_json(body), mimetype="application/json")
+
+    @app.route('/schemas/<name>/')
+    def send_schema(name):
+        if name not in SCHEMAS:
+            return create_error_response(404, "Not found",
+                                         "No schema was found with the name {}".format(name))
+        return app.response_class(dump_json(SCHEMAS[name]), mimetype="application/schema+json")
+
     @app.route('/api/')
     def EntryPoint():
         body = {
@@ -68,7 +162,7 @@ def create_app(test_config=None):
                     }
                 }
             }
-        return json.dumps(body)
+        return dump_json(body)
 
     # client
     @app.route('/client/', methods=['GET', 'POST', 'PUT', 'DELETE'])
@@ -90,20 +184,29 @@ app.app_context().push()
 
 from eventhub.resources.EventCollection import EventCollection
 from eventhub.resources.EventItem import EventItem
+from eventhub.resources.EventBatch import EventBatch
+from eventhub.resources.EventSearch import EventSearch
 from eventhub.resources.OrgCollection import OrgCollection
 from eventhub.resources.OrgItem import OrgItem
 from eventhub.resources.UserCollection import UserCollection
 from eventhub.resources.UserItem import UserItem
+from eventhub.resources.UserImport import UserImport, import_users_command
+from eventhub.resources.UserFeed import UserFeed
 
 from eventhub.resources.UserEvent import EventsByUser, UsersByEvent
 from eventhub.resources.UserOrg import OrgsByUser, UsersOfOrg
 
 api = Api(app)
 
+app.cli.add_command(import_users_command)
+
 
 #     Add resource path
 api.add_resource(EventCollection, "/api/events/")
+api.add_resource(EventBatch, "/api/events/batch/")
+api.add_resource(EventSearch, "/api/events/search/")
 api.add_resource(UserCollection, "/api/users/")
+api.add_resource(UserImport, "/api/users/import/")
 api.add_resource(OrgCollection, "/api/orgs/")
 api.add_resource(EventItem, "/api/events/<id>/")
 api.add_resource(UserItem, "/api/users/<id>/")
@@ -112,4 +215,5 @@ api.add_resource(OrgItem, "/api/orgs/<id>/")
 api.add_resource(EventsByUser, "/api/users/<user_id>/events/")
 api.add_resource(UsersByEvent, "/api/events/<event_id>/users/")
 api.add_resource(OrgsByUser, "/api/users/<user_id>/orgs/")
+api.add_resource(UserFeed, "/api/users/<user_id>/feed/")
 api.add_resource(UsersOfOrg,"/api/orgs/<org_id>/users/")
\ No newline at end of file
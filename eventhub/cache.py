@@ -0,0 +1,459 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import request, current_app, has_app_context, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from eventhub.encoding import negotiate_coding, compress_response
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CacheBackend(object):
+    """
+    Storage of the response cache. Entries are (status, headers, body)
+    tuples under a key, tagged with the tables the response was built from.
+    Committing a change to one of those tables invalidates the tag and
+    drops the entries. Backends are chosen with RESPONSE_CACHE_BACKEND,
+    the name of a class in BACKENDS.
+    """
+
+    # rough size of an entry besides the body and headers
+    ENTRY_OVERHEAD = 256
+
+    @classmethod
+    def from_app(cls, app):
+        """
+        Creates the backend from the settings of an app
+        """
+        return cls(app.config["RESPONSE_CACHE_BYTES"], app.config["RESPONSE_CACHE_TTL"])
+
+    def generation(self, tags):
+        """
+        Returns a token that changes whenever one of the tags is
+        invalidated. Taken before building a response and passed to put(),
+        so a response built while a write committed is not stored.
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        Returns the cached (status, headers, body) for a key or None
+        """
+        raise NotImplementedError
+
+    def put(self, key, tags, generation, value):
+        """
+        Stores (status, headers, body) for a key unless one of the tags was
+        invalidated after the generation was taken or the value doesn't fit
+        in the budget. Evicts the least recently used entries to make room.
+        """
+        raise NotImplementedError
+
+    def invalidate(self, tags):
+        """
+        Drops the entries tagged with any of the tags. Called after every
+        commit that changed one of the tables.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Drops all entries
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Returns the metrics of the cache as a dict
+        """
+        raise NotImplementedError
+
+    def entry_size(self, value):
+        status, headers, body = value
+        return len(body) + sum(len(k) + len(v) for k, v in headers) + self.ENTRY_OVERHEAD
+
+
+class MemoryBackend(CacheBackend):
+    """
+    LRU cache of serialized responses in the memory of the process, with a
+    time to live and a memory budget. Each worker process has its own copy
+    and only sees the commits made in that process.
+    Parameters:
+    max_bytes: Integer, total size of the cached responses
+    ttl: Float, seconds an entry is served at most
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def generation(self, tags):
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[3]
+
+    def put(self, key, tags, generation, value):
+        size = self.entry_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if tuple(self._generations.get(tag, 0) for tag in tags) != generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, frozenset(tags), size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def invalidate(self, tags):
+        tags = set(tags)
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            stale = [key for key, entry in self._entries.items() if entry[1] & tags]
+            for key in stale:
+                self._remove(key)
+            self._invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Response cache shared by all the worker processes of a host, kept in a
+    SQLite database file that every worker memory-maps. Put the file on a
+    tmpfs such as /dev/shm to keep it in shared memory. A commit in any
+    worker drops the entries for all of them. Recency is recorded with a
+    resolution of one second, so eviction is approximately LRU.
+    Parameters:
+    path: String, the database file
+    max_bytes: Integer, total size of the cached responses
+    ttl: Float, seconds an entry is served at most
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, expires REAL NOT NULL, "
+        "used REAL NOT NULL, size INTEGER NOT NULL, status INTEGER NOT NULL, "
+        "headers TEXT NOT NULL, body BLOB NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)",
+        "CREATE TABLE IF NOT EXISTS entry_tags (tag TEXT NOT NULL, key TEXT NOT NULL, "
+        "PRIMARY KEY (tag, key)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS entry_tags_key ON entry_tags (key)",
+        "CREATE TABLE IF NOT EXISTS generations (tag TEXT PRIMARY KEY, generation INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO counters VALUES ('bytes', 0), ('evictions', 0), ('invalidations', 0)",
+        "CREATE TRIGGER IF NOT EXISTS entry_added AFTER INSERT ON entries BEGIN "
+        "UPDATE counters SET value = value + NEW.size WHERE name = 'bytes'; END",
+        "CREATE TRIGGER IF NOT EXISTS entry_removed AFTER DELETE ON entries BEGIN "
+        "UPDATE counters SET value = value - OLD.size WHERE name = 'bytes'; "
+        "DELETE FROM entry_tags WHERE key = OLD.key; END",
+    )
+
+    def __init__(self, path, max_bytes, ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        with self._transaction() as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+    @classmethod
+    def from_app(cls, app):
+        path = app.config["RESPONSE_CACHE_PATH"] or \
+            os.path.join(app.instance_path, "response-cache.sqlite")
+        return cls(path, app.config["RESPONSE_CACHE_BYTES"], app.config["RESPONSE_CACHE_TTL"])
+
+    def _connection(self):
+        # one connection per thread, opened again in a forked worker
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("PRAGMA mmap_size = {:d}".format(self.max_bytes * 2))
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _generation(self, connection, tags):
+        rows = dict(connection.execute(
+            "SELECT tag, generation FROM generations WHERE tag IN ({})".format(
+                ", ".join("?" * len(tags))), tuple(tags)))
+        return tuple(rows.get(tag, 0) for tag in tags)
+
+    def generation(self, tags):
+        return self._generation(self._connection(), tags)
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT expires, used, status, headers, body FROM entries WHERE key = ?",
+            (key,)).fetchone()
+        now = time.time()
+        if row is None or row[0] < now:
+            with self._lock:
+                self._misses += 1
+            return None
+        if now - row[1] >= 1:
+            connection.execute("UPDATE entries SET used = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self._hits += 1
+        return row[2], [tuple(header) for header in json.loads(row[3])], row[4]
+
+    def put(self, key, tags, generation, value):
+        size = self.entry_size(value)
+        if size > self.max_bytes:
+            return
+        status, headers, body = value
+        now = time.time()
+        with self._transaction() as connection:
+            if self._generation(connection, tags) != generation:
+                return
+            # a REPLACE would not fire the delete trigger
+            connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+            connection.execute(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, now + self.ttl, now, size, status, json.dumps(headers), body))
+            connection.executemany("INSERT INTO entry_tags VALUES (?, ?)",
+                                   ((tag, key) for tag in set(tags)))
+            evicted = 0
+            while connection.execute(
+                    "SELECT value FROM counters WHERE name = 'bytes'").fetchone()[0] > self.max_bytes:
+                connection.execute(
+                    "DELETE FROM entries WHERE key = (SELECT key FROM entries ORDER BY used LIMIT 1)")
+                evicted += 1
+            if evicted:
+                connection.execute(
+                    "UPDATE counters SET value = value + ? WHERE name = 'evictions'", (evicted,))
+
+    def invalidate(self, tags):
+        tags = tuple(set(tags))
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT INTO generations VALUES (?, 1) "
+                "ON CONFLICT (tag) DO UPDATE SET generation = generation + 1",
+                ((tag,) for tag in tags))
+            removed = connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entry_tags WHERE tag IN ({}))".format(
+                    ", ".join("?" * len(tags))), tags).rowcount
+            connection.execute(
+                "UPDATE counters SET value = value + ? WHERE name = 'invalidations'", (removed,))
+
+    def clear(self):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM entries")
+
+    def stats(self):
+        connection = self._connection()
+        counters = dict(connection.execute("SELECT name, value FROM counters"))
+        entries = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": entries,
+                "bytes": counters["bytes"],
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": round(self._hits / lookups, 4) if lookups else 0,
+                "evictions": counters["evictions"],
+                "invalidations": counters["invalidations"],
+            }
+
+
+# backends selectable with RESPONSE_CACHE_BACKEND
+BACKENDS = {
+    "memory": MemoryBackend,
+    "sqlite": SQLiteBackend,
+}
+
+
+def get_response_cache():
+    """
+    Returns the cache backend of the current app, created on first use from
+    the RESPONSE_CACHE_* settings
+    """
+    cache = current_app.extensions.get("response_cache")
+    if cache is None:
+        backend = BACKENDS[current_app.config["RESPONSE_CACHE_BACKEND"]]
+        cache = current_app.extensions.setdefault("response_cache", backend.from_app(current_app))
+    return cache
+
+
+def cached(*tables):
+    """
+    Decorator for GET methods of resources. Serves the response from the
+    response cache when possible, answering If-None-Match and
+    If-Modified-Since from the cached headers. Only complete 200 responses
+    are stored, compressed with the content coding negotiated with the
+    client so that a hit sends the compressed bytes again. The key is the
+    path, the query string, the Accept header and the content coding.
+    Parameters:
+    tables: the names of the tables the response is built from
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not current_app.config["RESPONSE_CACHE_BYTES"]:
+                return func(*args, **kwargs)
+            cache = get_response_cache()
+            coding = negotiate_coding()
+            key = "\n".join((request.path, request.query_string.decode("latin-1"),
+                             request.headers.get("Accept", ""), coding or ""))
+            value = cache.get(key)
+            if value is not None:
+                status, headers, body = value
+                response = Response(body, status, headers)
+                return response.make_conditional(request.environ)
+            generation = cache.generation(tables)
+            response = func(*args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200 \
+                    and not response.is_streamed:
+                response = compress_response(response, coding)
+                cache.put(key, tables, generation,
+                          (200, list(response.headers.items()), response.get_data()))
+            return response
+        return wrapper
+    return decorator
+
+
+# tables that triggers write to when a table changes, filled by the models
+# with writes_through
+TRIGGERED_WRITES = {}
+
+
+def writes_through(table, *targets):
+    """
+    Records that the triggers of a table write to other tables, so that a
+    change to it also invalidates the responses built from those
+    """
+    TRIGGERED_WRITES.setdefault(table, set()).update(targets)
+
+
+def _dependent_tables(metadata, table):
+    """
+    Returns the table and the tables whose rows the database changes through
+    ON DELETE / ON UPDATE actions of foreign keys to it or through triggers
+    recorded with writes_through
+    """
+    found = {table}
+    pending = [table]
+    while pending:
+        name = pending.pop()
+        for other in TRIGGERED_WRITES.get(name, ()):
+            if other not in found:
+                found.add(other)
+                pending.append(other)
+        for other in metadata.tables.values():
+            for fk in other.foreign_keys:
+                if fk.column.table.name == name and (fk.ondelete or fk.onupdate) \
+                        and other.name not in found:
+                    found.add(other.name)
+                    pending.append(other.name)
+    return found
+
+
+def mark_changed(session, *tables):
+    """
+    Records that the current transaction of a session writes to the tables,
+    for writes the ORM doesn't see such as raw SQL statements
+    """
+    session.info.setdefault("changed_tables", set()).update(tables)
+
+
+@event.listens_for(Session, "after_flush")
+def _record_flush(session, flush_context):
+    tables = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, "__table__", None)
+        if table is not None:
+            tables.add(table.name)
+    if tables:
+        mark_changed(session, *tables)
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _record_bulk(context):
+    mark_changed(context.session, context.mapper.local_table.name)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate(session):
+    tables = session.info.pop("changed_tables", None)
+    if not tables or not has_app_context() or not current_app.config["RESPONSE_CACHE_BYTES"]:
+        return
+    # created here if this worker hasn't served a cached GET yet, the
+    # sqlite backend is shared with the workers that have
+    cache = get_response_cache()
+    from eventhub import db
+    changed = set()
+    for table in tables:
+        changed |= _dependent_tables(db.Model.metadata, table)
+    cache.invalidate(changed)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget(session):
+    session.info.pop("changed_tables", None)
@@ -0,0 +1,261 @@
+"""
+Encodings of the responses: the media type a Mason document is sent in and
+the content coding the body is compressed with. Both are negotiated from
+the request headers. MessagePack needs the msgpack package and brotli the
+brotli package, without them only JSON and gzip are offered. JSON is written
+by one of JSON_ENCODERS, orjson when it is installed.
+"""
+from flask import request, current_app, Response
+from werkzeug.http import parse_options_header
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MASON = "application/vnd.mason+json"
+MASON_MSGPACK = "application/vnd.mason+msgpack"
+
+
+def encode_default(obj):
+    """
+    Returns the document of an object the encoders don't know: the list
+    items of collections (MasonItem in eventhub.utils) build theirs with
+    mason_document
+    """
+    document = getattr(obj, "mason_document", None)
+    if document is None:
+        raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+    return document()
+
+
+def dumps_stdlib(obj):
+    """
+    Encodes a document as compact UTF-8 JSON with the json module
+    """
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"),
+                      default=encode_default).encode("utf-8")
+
+
+def dumps_orjson(obj):
+    """
+    Encodes a document as compact UTF-8 JSON with orjson. orjson writes
+    dicts, lists and their subclasses like the json module does. Types the
+    json module can't encode (datetimes, dataclasses) are refused here as
+    well, the documents format their times themselves.
+    """
+    return orjson.dumps(obj, default=encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME |
+                        orjson.OPT_PASSTHROUGH_DATACLASS)
+
+
+# JSON encoders by name, chosen with JSON_ENCODER (None for the first one
+# available). They produce the same bytes for every document the resources
+# build; only floats in exponent notation (orjson writes 1e16 for 1e+16)
+# would differ and the documents have none.
+JSON_ENCODERS = {"json": dumps_stdlib}
+if orjson is not None:
+    JSON_ENCODERS = {"orjson": dumps_orjson, "json": dumps_stdlib}
+DEFAULT_JSON_ENCODER = next(iter(JSON_ENCODERS))
+
+
+def json_encoder():
+    """
+    Returns the JSON encoder of the current app, a function from a document
+    to bytes
+    """
+    return JSON_ENCODERS[current_app.config["JSON_ENCODER"] or DEFAULT_JSON_ENCODER]
+
+
+def dump_json(obj):
+    """
+    Encodes a document as JSON bytes with the configured encoder
+    """
+    return json_encoder()(obj)
+
+
+# media types worth compressing besides text/*
+COMPRESSIBLE = {
+    MASON,
+    MASON_MSGPACK,
+    "application/json",
+    "application/schema+json",
+    "application/javascript",
+}
+
+
+class GzipCompressor(object):
+    """
+    Incremental gzip compressor
+    Parameters:
+    level: Integer, zlib compression level 1-9
+    """
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor(object):
+    """
+    Incremental brotli compressor
+    Parameters:
+    level: Integer, brotli quality 0-11
+    """
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+# content codings in the order the server prefers them, the level of each
+# comes from COMPRESS_LEVELS
+CODINGS = {"gzip": GzipCompressor}
+if brotli is not None:
+    CODINGS = {"br": BrotliCompressor, "gzip": GzipCompressor}
+
+
+def negotiate_media_type():
+    """
+    Returns the media type to encode a Mason document in: MessagePack if the
+    client prefers it to JSON and msgpack is installed, JSON otherwise
+    """
+    if msgpack is not None and request.accept_mimetypes.best_match(
+            (MASON, MASON_MSGPACK)) == MASON_MSGPACK:
+        return MASON_MSGPACK
+    return MASON
+
+
+def json_accepted():
+    """
+    Checks if the client accepts Mason JSON, with or without parameters on
+    the media type. Streamed collections are only sent in JSON.
+    """
+    if not request.accept_mimetypes:
+        return True
+    for value, quality in request.accept_mimetypes:
+        mimetype = parse_options_header(value)[0]
+        if quality > 0 and mimetype in (MASON, "application/*", "*/*"):
+            return True
+    return False
+
+
+def negotiate_coding():
+    """
+    Returns the content coding to compress the response with according to
+    Accept-Encoding, or None to send it as is
+    """
+    if current_app.config["COMPRESS_MIN_SIZE"] is None:
+        return None
+    return request.accept_encodings.best_match(list(CODINGS))
+
+
+def encode_mason(body, mimetype=MASON):
+    """
+    Encodes a Mason document in one of the Mason media types
+    """
+    if mimetype == MASON_MSGPACK:
+        return msgpack.packb(body, use_bin_type=True, default=encode_default)
+    return dump_json(body)
+
+
+def mason_response(body, status=200):
+    """
+    Returns a response with a Mason document in the media type negotiated
+    with the client
+    """
+    mimetype = negotiate_media_type()
+    response = Response(encode_mason(body, mimetype), status, mimetype=mimetype)
+    response.vary.add("Accept")
+    return response
+
+
+def compressor(coding):
+    """
+    Returns a new compressor for a content coding at the configured level
+    """
+    return CODINGS[coding](current_app.config["COMPRESS_LEVELS"][coding])
+
+
+def _compress_stream(chunks, encoder):
+    """
+    Compresses the chunks of a streamed response one by one, flushing after
+    each so that the client can decode what it has received. Runs after the
+    request, so the compressor is created beforehand.
+    """
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield encoder.compress(chunk) + encoder.flush()
+        yield encoder.finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(response, coding):
+    """
+    Compresses the body of a 200 response with a content coding if its media
+    type is compressible and it is at least COMPRESS_MIN_SIZE bytes long.
+    Streamed responses are always compressed, chunk by chunk. A strong ETag
+    becomes weak, as the compressed bytes differ from the identity ones.
+    Responses that already have a Content-Encoding are returned as they are,
+    so it is safe to call this again on a compressed response.
+    Parameters:
+    response: the Response
+    coding: String, a key of CODINGS, or None for a client that doesn't
+            accept any
+    """
+    min_size = current_app.config["COMPRESS_MIN_SIZE"]
+    if min_size is None or response.status_code != 200 or response.direct_passthrough \
+            or "Content-Encoding" in response.headers:
+        return response
+    mimetype = response.mimetype or ""
+    if mimetype not in COMPRESSIBLE and not mimetype.startswith("text/"):
+        return response
+    if not response.is_streamed and len(response.get_data()) < min_size:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, compressor(coding))
+        response.headers.pop("Content-Length", None)
+    else:
+        encoder = compressor(coding)
+        response.set_data(encoder.compress(response.get_data()) + encoder.finish())
+    response.headers["Content-Encoding"] = coding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
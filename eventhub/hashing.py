@@ -0,0 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor, Future
+from collections import deque
+from flask import current_app
+import threading
+import time
+import os
+
+from eventhub.utils import hash_password, verify_password
+
+
+class HashingBusy(Exception):
+    """
+    Raised when there are too many passwords waiting to be hashed
+    """
+
+
+class PasswordHasher(object):
+    """
+    Hashes passwords in a pool of worker processes so that the 100k rounds of
+    PBKDF2 don't block the request threads and can use all the cores. The
+    number of passwords waiting for the pool is limited: hash() waits for a
+    free slot for a while and then raises HashingBusy.
+    Parameters:
+    pool_size: Integer, number of worker processes, 0 hashes in the caller
+    max_pending: Integer, number of passwords that can be queued or hashing
+    timeout: Float, seconds hash() waits for a free slot
+    """
+
+    def __init__(self, pool_size, max_pending, timeout):
+        self.pool_size = pool_size
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def _submit(self, timeout, func, *args):
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self._rejected += 1
+            raise HashingBusy("{} passwords are already waiting to be hashed".format(
+                self.max_pending))
+        with self._lock:
+            self._pending += 1
+        started = time.monotonic()
+        try:
+            if self.pool_size:
+                with self._lock:
+                    if self._executor is None:
+                        self._executor = ProcessPoolExecutor(self.pool_size)
+                future = self._executor.submit(func, *args)
+            else:
+                future = Future()
+                future.set_result(func(*args))
+        except Exception:
+            self._slots.release()
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(lambda f: self._done(started))
+        return future
+
+    def _done(self, started):
+        latency = time.monotonic() - started
+        self._slots.release()
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+
+    def hash(self, password):
+        """
+        Hashes one password, waiting for a free slot for at most the timeout.
+        Raises HashingBusy if there is no room in the queue.
+        """
+        return self._submit(self.timeout, hash_password, password).result()
+
+    def verify(self, stored, password):
+        """
+        Checks a password against a stored hash in the pool. Costs as much as
+        hashing, waits for a free slot the same way as hash().
+        """
+        return self._submit(self.timeout, verify_password, stored, password).result()
+
+    def hash_many(self, passwords):
+        """
+        Hashes passwords in parallel on all the workers and yields the hashes
+        in the same order. Waits for free slots instead of raising
+        HashingBusy, a bulk import just goes as fast as the pool allows.
+        """
+        window = deque()
+        for password in passwords:
+            if len(window) >= max(self.pool_size, 1) * 2:
+                yield window.popleft().result()
+            window.append(self._submit(None, hash_password, password))
+        while window:
+            yield window.popleft().result()
+
+    def stats(self):
+        """
+        Returns the metrics of the hasher as a dict
+        """
+        with self._lock:
+            return {
+                "pool_size": self.pool_size,
+                "queue_depth": self._pending,
+                "max_pending": self.max_pending,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "latency_avg_ms": round(
+                    self._latency_total / self._completed * 1000, 2) if self._completed else 0,
+                "latency_max_ms": round(self._latency_max * 1000, 2),
+            }
+
+
+def get_password_hasher():
+    """
+    Returns the PasswordHasher of the current app, created on first use from
+    the HASH_POOL_SIZE, HASH_MAX_PENDING and HASH_QUEUE_TIMEOUT settings
+    """
+    hasher = current_app.extensions.get("password_hasher")
+    if hasher is None:
+        pool_size = current_app.config["HASH_POOL_SIZE"]
+        if pool_size is None:
+            pool_size = os.cpu_count() or 1
+        hasher = PasswordHasher(
+            pool_size,
+            current_app.config["HASH_MAX_PENDING"] or max(pool_size, 1) * 4,
+            current_app.config["HASH_QUEUE_TIMEOUT"]
+        )
+        hasher = current_app.extensions.setdefault("password_hasher", hasher)
+    return hasher
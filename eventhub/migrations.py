@@ -0,0 +1,210 @@
+"""
+Brings existing SQLite databases up to date with the models. db.create_all()
+only creates missing tables, so every change to an existing table is a step
+here. The number of steps already applied is kept in PRAGMA user_version and
+every step is written so that running it on an up to date database does
+nothing, because create_all() builds new databases with the final schema.
+"""
+from datetime import datetime
+from sqlalchemy import inspect, text
+
+MIGRATIONS = []
+
+
+class MigrationError(Exception):
+    """
+    Raised when a migration step can't convert the data in the database.
+    The upgrade is rolled back, the data has to be fixed by hand before it
+    is run again.
+    """
+
+
+# free text event times that convert_event_times understands besides
+# ISO-8601: dates, with or without a time
+LEGACY_DATE_FORMATS = ("%d.%m.%Y %H:%M", "%d.%m.%Y", "%d/%m/%Y %H:%M", "%d/%m/%Y")
+
+
+def migration(step):
+    """
+    Registers a function taking a connection as the next migration step
+    """
+    MIGRATIONS.append(step)
+    return step
+
+
+def create_missing_indexes(connection, metadata):
+    """
+    Creates the indexes declared on the models that are missing from the
+    database and returns their names
+    """
+    inspector = inspect(connection)
+    created = []
+    for table in metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(connection)
+                created.append(index.name)
+    return created
+
+
+@migration
+def add_reverse_lookup_indexes(connection):
+    """
+    Indexes following.event_id, associations.org_id and event.organization.
+    The composite primary keys start with user_id, so finding the users of an
+    event or an organization and the events of an organization scanned the
+    whole table.
+    """
+    from eventhub import db
+    create_missing_indexes(connection, db.Model.metadata)
+
+
+@migration
+def add_change_tracking(connection):
+    """
+    Adds the version and modified columns to events, users and organizations
+    and the triggers that keep them and the table_versions counters up to
+    date.
+    """
+    from eventhub.models import TableVersion, VERSIONED_MODELS, NOW, change_triggers
+    TableVersion.__table__.create(connection, checkfirst=True)
+    inspector = inspect(connection)
+    for model in VERSIONED_MODELS:
+        table = model.__tablename__
+        columns = {column["name"] for column in inspector.get_columns(table)}
+        if "version" not in columns:
+            connection.execute(
+                'ALTER TABLE "{}" ADD COLUMN version INTEGER NOT NULL DEFAULT 1'.format(table))
+        if "modified" not in columns:
+            connection.execute(
+                'ALTER TABLE "{}" ADD COLUMN modified FLOAT NOT NULL DEFAULT 0'.format(table))
+            connection.execute('UPDATE "{}" SET modified = {}'.format(table, NOW))
+        for statement in change_triggers(table):
+            connection.execute(statement)
+
+
+@migration
+def add_event_search(connection):
+    """
+    Creates the full text index of the events and its triggers and indexes
+    the events that are already in the database.
+    """
+    from eventhub.models import search_index_statements
+    for statement in search_index_statements():
+        connection.execute(statement)
+    connection.execute("INSERT INTO event_fts (event_fts) VALUES ('rebuild')")
+
+
+@migration
+def add_event_filter_indexes(connection):
+    """
+    Indexes event.time, (organization, time) and (location, time) for the
+    filters and the time order of the event collection.
+    """
+    from eventhub import db
+    create_missing_indexes(connection, db.Model.metadata)
+
+
+def parse_legacy_time(value):
+    """
+    Parses an event time stored as free text. Raises ValueError for text
+    that isn't a date, a time of day without a date included.
+    """
+    from eventhub.utils import parse_time
+    value = str(value).strip()
+    try:
+        return parse_time(value)
+    except ValueError:
+        pass
+    for time_format in LEGACY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError("unknown time format: {!r}".format(value))
+
+
+@migration
+def convert_event_times(connection):
+    """
+    Turns the free text times of the events into UTC datetimes in the form
+    the DateTime column stores them, so that they sort and compare in time
+    order. SQLite doesn't enforce column types, the existing column keeps
+    its declared type. Raises MigrationError listing the events whose time
+    can't be parsed instead of making one up.
+    """
+    from eventhub.models import Event
+    dialect = connection.dialect
+    store = Event.__table__.c.time.type.dialect_impl(dialect).bind_processor(dialect)
+    updates = []
+    invalid = []
+    for id, value in connection.execute("SELECT id, time FROM event").fetchall():
+        try:
+            stored = store(parse_legacy_time(value))
+        except ValueError:
+            invalid.append("event {}: {!r}".format(id, value))
+            continue
+        if stored != value:
+            updates.append({"id": id, "time": stored})
+    if invalid:
+        raise MigrationError("event times that aren't times, fix them and upgrade again: " +
+                             ", ".join(invalid))
+    if updates:
+        connection.execute(text("UPDATE event SET time = :time WHERE id = :id"), updates)
+
+
+@migration
+def add_feed(connection):
+    """
+    Creates the feed table and its triggers and fills it with the events
+    the users follow and the events of their organizations.
+    """
+    from eventhub.models import FeedEntry, feed_triggers
+    FeedEntry.__table__.create(connection, checkfirst=True)
+    for statement in feed_triggers():
+        connection.execute(statement)
+    connection.execute(
+        "INSERT OR IGNORE INTO feed (user_id, time, event_id) "
+        "SELECT following.user_id, event.time, event.id FROM following "
+        "JOIN event ON event.id = following.event_id")
+    connection.execute(
+        "INSERT OR IGNORE INTO feed (user_id, time, event_id) "
+        "SELECT associations.user_id, event.time, event.id FROM associations "
+        "JOIN event ON event.organization = associations.org_id")
+
+
+@migration
+def add_counters(connection):
+    """
+    Adds follower_count to events and member_count to organizations, counts
+    the existing followers and members and creates the triggers that keep
+    the counts.
+    """
+    from eventhub.models import COUNTERS, counter_triggers
+    inspector = inspect(connection)
+    for model, column, table, counter in COUNTERS:
+        columns = {existing["name"] for existing in inspector.get_columns(table)}
+        if counter not in columns:
+            connection.execute(
+                'ALTER TABLE "{}" ADD COLUMN {} INTEGER NOT NULL DEFAULT 0'.format(table, counter))
+        connection.execute(
+            'UPDATE "{table}" SET {counter} = (SELECT count(*) FROM "{association}" '
+            'WHERE {column} = "{table}".id) WHERE {counter} != (SELECT count(*) '
+            'FROM "{association}" WHERE {column} = "{table}".id)'.format(
+                table=table, counter=counter, association=model.__tablename__, column=column))
+        for statement in counter_triggers(model, column, table, counter):
+            connection.execute(statement)
+
+
+def upgrade(engine):
+    """
+    Applies the migration steps the database hasn't seen yet. Returns the
+    number of steps applied.
+    """
+    with engine.begin() as connection:
+        version = connection.execute("PRAGMA user_version").scalar()
+        for number, step in enumerate(MIGRATIONS[version:], version + 1):
+            step(connection)
+            connection.execute("PRAGMA user_version = {:d}".format(number))
+    return max(len(MIGRATIONS) - version, 0)
@@ -4,9 +4,12 @@ from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
 from sqlalchemy.exc import IntegrityError
 import binascii, hashlib, os
-from sqlalchemy import CheckConstraint
+from time import time as current_time
+from sqlalchemy import CheckConstraint, DDL, event, text
 
 from eventhub import db
+from eventhub.cache import writes_through
+from eventhub.migrations import upgrade
 """
 # Users associated to organizations
 associations = db.Table("associations",
@@ -23,7 +26,7 @@ following = db.Table("following",
 class EventsAndUsers(db.Model):
     __tablename__ = "following"
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
-    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"),primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"),primary_key=True, index=True)
 
     user1 = db.relationship("User", back_populates="events")
     event = db.relationship("Event", back_populates="users1")
@@ -31,12 +34,51 @@ class EventsAndUsers(db.Model):
 class OrgsAndUsers(db.Model):
     __tablename__ = "associations"
     user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
-    org_id = db.Column(db.Integer, db.ForeignKey("organization.id", ondelete="CASCADE"),primary_key=True)
+    org_id = db.Column(db.Integer, db.ForeignKey("organization.id", ondelete="CASCADE"),primary_key=True, index=True)
 
     user2 = db.relationship("User", back_populates="orgs")
     org = db.relationship("Organization", back_populates="users2")
 
 
+def missing_users(user_ids):
+    """
+    Returns the ids of the list that don't belong to any user
+    """
+    rows = db.session.execute(
+        'SELECT DISTINCT value FROM json_each(:ids) WHERE value NOT IN (SELECT id FROM "user") '
+        'ORDER BY value', {"ids": json.dumps(user_ids)})
+    return [row[0] for row in rows]
+
+def add_users(model, column, owner_id, user_ids):
+    """
+    Links users to an event or organization with one INSERT OR IGNORE, users
+    that are already linked are skipped. Returns the number of new links.
+    Parameters:
+    model: EventsAndUsers or OrgsAndUsers
+    column: String, the column of the event or organization id
+    owner_id: Integer, id of the event or organization
+    user_ids: list of user ids
+    """
+    result = db.session.execute(
+        'INSERT OR IGNORE INTO "{table}" (user_id, {column}) '
+        'SELECT DISTINCT value, :owner FROM json_each(:ids)'.format(
+            table=model.__tablename__, column=column),
+        {"owner": owner_id, "ids": json.dumps(user_ids)})
+    return result.rowcount
+
+def remove_users(model, column, owner_id, user_ids):
+    """
+    Unlinks users from an event or organization with one DELETE. Returns the
+    number of removed links. Parameters are the same as for add_users.
+    """
+    result = db.session.execute(
+        'DELETE FROM "{table}" WHERE {column} = :owner '
+        'AND user_id IN (SELECT value FROM json_each(:ids))'.format(
+            table=model.__tablename__, column=column),
+        {"owner": owner_id, "ids": json.dumps(user_ids)})
+    return result.rowcount
+
+
 # User model
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -45,6 +87,8 @@ class User(db.Model):
     pwdhash = db.Column(db.String(128), nullable=False)
     location = db.Column(db.String(128))
     notifications = db.Column(db.Integer,CheckConstraint('notifications IN (0, 1)'), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    modified = db.Column(db.Float, nullable=False, default=current_time, server_default="0")
 
     #followed_events = db.relationship('Event', secondary=following)#,back_populates='users1')
     """
@@ -59,12 +103,24 @@ class User(db.Model):
         
 # Event model
 class Event(db.Model):
+    # the filters of the event collection: an index for each filter
+    # followed by the time, for the time order and time windows. SQLite
+    # adds the id to every index, which gives the order by id.
+    __table_args__ = (
+        db.Index("ix_event_organization_time", "organization", "time"),
+        db.Index("ix_event_location_time", "location", "time"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128),nullable=False)
-    time = db.Column(db.String(128), nullable=False)
+    # UTC, SQLite keeps it as ISO-8601 text that sorts chronologically
+    time = db.Column(db.DateTime, nullable=False, index=True)
     description = db.Column(db.String(255), nullable=False)
     location = db.Column(db.String(128))
-    organization = db.Column(db.Integer, db.ForeignKey("organization.id", ondelete="CASCADE"))
+    organization = db.Column(db.Integer, db.ForeignKey("organization.id", ondelete="CASCADE"), index=True)
+    # number of rows in following, kept by counter_triggers
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    modified = db.Column(db.Float, nullable=False, default=current_time, server_default="0")
     
     org = db.relationship("Organization", back_populates="event")
 
@@ -77,6 +133,10 @@ class Event(db.Model):
 class Organization(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True,nullable=False)
+    # number of rows in associations, kept by counter_triggers
+    member_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    modified = db.Column(db.Float, nullable=False, default=current_time, server_default="0")
     
     event = db.relationship("Event", back_populates="org")
 
@@ -85,4 +145,253 @@ class Organization(db.Model):
     #users2 = db.relationship('User',secondary=associations)#back_populates='related_orgs')
     users2 = db.relationship("OrgsAndUsers", back_populates="org", cascade="all,delete-orphan")
 
-db.create_all()
\ No newline at end of file
+
+# Timeline of the users: the events each user follows or that belong to the
+# organizations of the user, kept by feed_triggers and clustered by user and
+# time so that the upcoming events of a user are one range of the table
+class FeedEntry(db.Model):
+    __tablename__ = "feed"
+    __table_args__ = {"sqlite_with_rowid": False}
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+    time = db.Column(db.DateTime, primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"),
+                         primary_key=True, index=True)
+
+# Change counters of the tables, for the ETags of the collections
+class TableVersion(db.Model):
+    __tablename__ = "table_versions"
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    modified = db.Column(db.Float, nullable=False)
+
+    @staticmethod
+    def current(name):
+        """
+        Returns the version and the modification time (seconds since the
+        epoch) of a table, (0, 0.0) if it has never been written to
+        """
+        row = db.session.query(TableVersion.version, TableVersion.modified) \
+            .filter_by(name=name).first()
+        return tuple(row) if row else (0, 0.0)
+
+
+# current time in seconds since the epoch in SQLite
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+def change_triggers(table):
+    """
+    Returns the statements creating the triggers that keep the version and
+    modified columns of the rows of a table and its counter in table_versions
+    up to date. Triggers also see bulk and cascaded changes that never go
+    through the ORM.
+    """
+    bump = (
+        "INSERT INTO table_versions (name, version, modified) VALUES ('{table}', 1, {now}) "
+        "ON CONFLICT (name) DO UPDATE SET version = version + 1, modified = excluded.modified;"
+    ).format(table=table, now=NOW)
+    return [
+        'CREATE TRIGGER IF NOT EXISTS "{table}_inserted" AFTER INSERT ON "{table}" '
+        'BEGIN {bump} END'.format(table=table, bump=bump),
+        'CREATE TRIGGER IF NOT EXISTS "{table}_deleted" AFTER DELETE ON "{table}" '
+        'BEGIN {bump} END'.format(table=table, bump=bump),
+        # the WHEN clause skips the update made by the trigger itself
+        'CREATE TRIGGER IF NOT EXISTS "{table}_updated" AFTER UPDATE ON "{table}" '
+        'WHEN NEW.version = OLD.version BEGIN '
+        'UPDATE "{table}" SET version = OLD.version + 1, modified = {now} WHERE id = NEW.id; '
+        '{bump} END'.format(table=table, now=NOW, bump=bump),
+    ]
+
+VERSIONED_MODELS = (Event, User, Organization)
+
+for model in VERSIONED_MODELS:
+    for statement in change_triggers(model.__tablename__):
+        event.listen(model.__table__, "after_create", DDL(statement))
+
+
+# bm25 weights of the name, description and location columns in searches
+SEARCH_RANK = "bm25(10.0, 1.0, 5.0)"
+
+def search_index_statements():
+    """
+    Returns the statements creating event_fts, an FTS5 index of the name,
+    description and location of the events, and the triggers that keep it in
+    step with the event table. The index is external content: it stores only
+    the tokens and reads the text from the event table, so the events aren't
+    kept twice.
+    """
+    columns = "name, description, location"
+    new = "NEW.name, NEW.description, NEW.location"
+    old = "OLD.name, OLD.description, OLD.location"
+    delete = ("INSERT INTO event_fts (event_fts, rowid, {columns}) "
+              "VALUES ('delete', OLD.id, {old});").format(columns=columns, old=old)
+    insert = ("INSERT INTO event_fts (rowid, {columns}) "
+              "VALUES (NEW.id, {new});").format(columns=columns, new=new)
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS event_fts USING fts5("
+        "{columns}, content='event', content_rowid='id')".format(columns=columns),
+        "INSERT INTO event_fts (event_fts, rank) VALUES ('rank', '{}')".format(SEARCH_RANK),
+        'CREATE TRIGGER IF NOT EXISTS event_fts_inserted AFTER INSERT ON "event" '
+        'BEGIN {insert} END'.format(insert=insert),
+        'CREATE TRIGGER IF NOT EXISTS event_fts_deleted AFTER DELETE ON "event" '
+        'BEGIN {delete} END'.format(delete=delete),
+        # version and modified aren't indexed, so the update made by the
+        # change tracking trigger doesn't touch the index
+        'CREATE TRIGGER IF NOT EXISTS event_fts_updated AFTER UPDATE OF {columns} ON "event" '
+        'BEGIN {delete} {insert} END'.format(columns=columns, delete=delete, insert=insert),
+    ]
+
+def match_expression(terms):
+    """
+    Returns the FTS5 query matching the events that contain all of the
+    words. Each word is quoted as a phrase so that FTS5 operators in the
+    query string are plain text.
+    Parameters:
+    terms: list of words
+    """
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+def search_window(query, candidates):
+    """
+    Returns the smallest and largest id of the newest matches of a query,
+    (low, high), or None if nothing matches. bm25 scores every match it
+    ranks, so ranking only the matches in this window keeps a search for a
+    common word from scoring a large part of the table. Reading the ids of
+    the matches is cheap, FTS5 keeps them sorted.
+    Parameters:
+    query: String, FTS5 query from match_expression
+    candidates: Integer, number of newest matches in the window, None for
+    all matches
+    """
+    row = db.session.execute(
+        "SELECT min(rowid), max(rowid) FROM (SELECT rowid FROM event_fts "
+        "WHERE event_fts MATCH :query ORDER BY rowid DESC LIMIT :candidates)",
+        {"query": query, "candidates": -1 if candidates is None else candidates}).fetchone()
+    return None if row[0] is None else (row[0], row[1])
+
+def matches_before(query, id):
+    """
+    Returns True if an event older than the id matches the query, that is
+    if a window from search_window leaves matches out
+    Parameters:
+    query: String, FTS5 query from match_expression
+    id: Integer, the low end of the window
+    """
+    return db.session.execute(
+        "SELECT 1 FROM event_fts WHERE event_fts MATCH :query AND rowid < :id LIMIT 1",
+        {"query": query, "id": id}).fetchone() is not None
+
+def search_events(query, window, limit, after=None):
+    """
+    Returns the events in the window matching the query, best match first,
+    as rows with the columns of the event and its rank. Ties are broken by
+    id so that the order is stable for pagination.
+    Parameters:
+    query: String, FTS5 query from match_expression
+    window: (low, high) from search_window
+    limit: Integer, the maximum number of rows
+    after: (rank, id) of the last row of the previous page or None
+    """
+    seek = ""
+    parameters = {"query": query, "low": window[0], "high": window[1], "limit": limit}
+    if after is not None:
+        seek = "AND (event_fts.rank > :rank OR (event_fts.rank = :rank AND event_fts.rowid > :id)) "
+        parameters.update(rank=after[0], id=after[1])
+    # the type of the time column turns the stored text into a datetime
+    statement = text(
+        "SELECT event.*, event_fts.rank AS rank FROM event_fts "
+        "JOIN event ON event.id = event_fts.rowid "
+        "WHERE event_fts MATCH :query AND event_fts.rowid BETWEEN :low AND :high " + seek +
+        "ORDER BY event_fts.rank, event_fts.rowid LIMIT :limit").columns(time=db.DateTime)
+    return db.session.execute(statement, parameters).fetchall()
+
+for statement in search_index_statements():
+    event.listen(Event.__table__, "after_create", DDL(statement))
+
+# the association tables and the counters of the rows they point to:
+# (association model, its column, counted table, counter column)
+COUNTERS = (
+    (EventsAndUsers, "event_id", "event", "follower_count"),
+    (OrgsAndUsers, "org_id", "organization", "member_count"),
+)
+
+def counter_triggers(model, column, table, counter):
+    """
+    Returns the statements creating the triggers that keep a counter of
+    the links to a row in step with an association table, in the same
+    transaction as the change of the links. Updating the counter goes
+    through the change tracking triggers of the counted table, so its
+    ETags change too.
+    """
+    association = model.__tablename__
+    increment = 'UPDATE "{table}" SET {counter} = {counter} + 1 WHERE id = NEW.{column};'.format(
+        table=table, counter=counter, column=column)
+    decrement = 'UPDATE "{table}" SET {counter} = {counter} - 1 WHERE id = OLD.{column};'.format(
+        table=table, counter=counter, column=column)
+    return [
+        'CREATE TRIGGER IF NOT EXISTS "{association}_counted" AFTER INSERT ON "{association}" '
+        'BEGIN {increment} END'.format(association=association, increment=increment),
+        'CREATE TRIGGER IF NOT EXISTS "{association}_uncounted" AFTER DELETE ON "{association}" '
+        'BEGIN {decrement} END'.format(association=association, decrement=decrement),
+        'CREATE TRIGGER IF NOT EXISTS "{association}_recounted" AFTER UPDATE OF {column} '
+        'ON "{association}" WHEN NEW.{column} IS NOT OLD.{column} '
+        'BEGIN {decrement} {increment} END'.format(association=association, column=column,
+                                                  decrement=decrement, increment=increment),
+    ]
+
+for model, column, table, counter in COUNTERS:
+    for statement in counter_triggers(model, column, table, counter):
+        event.listen(model.__table__, "after_create", DDL(statement))
+    writes_through(model.__tablename__, table)
+
+def feed_triggers():
+    """
+    Returns the statements creating the triggers that keep the feed table
+    up to date. A user has an event in the feed while they follow it or
+    are a member of its organization, so a row is removed only when
+    neither is true anymore. The time of a row is a copy of the time of the
+    event.
+    """
+    # the user still reaches the event through its organization
+    member = ("EXISTS (SELECT 1 FROM event JOIN associations ON associations.org_id = "
+              "event.organization WHERE event.id = {event} AND associations.user_id = {user})")
+    # the user still follows the event
+    follower = ("EXISTS (SELECT 1 FROM following WHERE following.event_id = {event} "
+                "AND following.user_id = {user})")
+    return [
+        "CREATE TRIGGER IF NOT EXISTS feed_followed AFTER INSERT ON following BEGIN "
+        "INSERT OR IGNORE INTO feed (user_id, time, event_id) "
+        "SELECT NEW.user_id, time, id FROM event WHERE id = NEW.event_id; END",
+        "CREATE TRIGGER IF NOT EXISTS feed_unfollowed AFTER DELETE ON following BEGIN "
+        "DELETE FROM feed WHERE user_id = OLD.user_id AND event_id = OLD.event_id "
+        "AND NOT {}; END".format(member.format(event="OLD.event_id", user="OLD.user_id")),
+        "CREATE TRIGGER IF NOT EXISTS feed_joined AFTER INSERT ON associations BEGIN "
+        "INSERT OR IGNORE INTO feed (user_id, time, event_id) "
+        "SELECT NEW.user_id, time, id FROM event WHERE organization = NEW.org_id; END",
+        "CREATE TRIGGER IF NOT EXISTS feed_left AFTER DELETE ON associations BEGIN "
+        "DELETE FROM feed WHERE user_id = OLD.user_id "
+        "AND event_id IN (SELECT id FROM event WHERE organization = OLD.org_id) "
+        "AND NOT {}; END".format(follower.format(event="feed.event_id", user="OLD.user_id")),
+        'CREATE TRIGGER IF NOT EXISTS feed_event_created AFTER INSERT ON "event" BEGIN '
+        "INSERT OR IGNORE INTO feed (user_id, time, event_id) "
+        "SELECT user_id, NEW.time, NEW.id FROM associations WHERE org_id = NEW.organization; END",
+        'CREATE TRIGGER IF NOT EXISTS feed_event_deleted AFTER DELETE ON "event" BEGIN '
+        "DELETE FROM feed WHERE event_id = OLD.id; END",
+        'CREATE TRIGGER IF NOT EXISTS feed_event_moved AFTER UPDATE OF time ON "event" '
+        "WHEN NEW.time IS NOT OLD.time BEGIN "
+        "UPDATE feed SET time = NEW.time WHERE event_id = NEW.id; END",
+        'CREATE TRIGGER IF NOT EXISTS feed_event_reorganized AFTER UPDATE OF organization ON "event" '
+        "WHEN NEW.organization IS NOT OLD.organization BEGIN "
+        "DELETE FROM feed WHERE event_id = NEW.id "
+        "AND user_id IN (SELECT user_id FROM associations WHERE org_id = OLD.organization) "
+        "AND NOT {}; ".format(follower.format(event="NEW.id", user="feed.user_id")) +
+        "INSERT OR IGNORE INTO feed (user_id, time, event_id) "
+        "SELECT user_id, NEW.time, NEW.id FROM associations WHERE org_id = NEW.organization; END",
+    ]
+
+# the triggers are on the tables the feed is built from, so they are created
+# once all tables exist
+for statement in feed_triggers():
+    event.listen(db.Model.metadata, "after_create", DDL(statement))
+
+db.create_all()
+upgrade(db.engine)
\ No newline at end of file
@@ -0,0 +1,137 @@
+from flask_restful import Resource
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from flask import request, Response, current_app
+from eventhub import db
+from eventhub.cache import mark_changed
+from eventhub.models import Event, Organization
+from eventhub.utils import MasonBuilder, create_error_response, EVENT_VALIDATOR, event_href, \
+    read_ndjson, NDJSON, parse_time
+from eventhub.encoding import mason_response
+from jsonschema import ValidationError
+
+LINK_RELATIONS_URL = "/eventhub/link-relations/"
+
+MASON = "application/vnd.mason+json"
+
+
+class EventBatch(Resource):
+    """
+    Resource class for creating many events in one request
+    """
+    def post(self):
+        """
+        create events in bulk. The body is either a JSON array of events or an
+        NDJSON stream with one event per line. Each event is validated against
+        the event schema; the valid ones are inserted in transactions of
+        BATCH_CHUNK_SIZE events. A chunk that has been committed stays even if
+        a later one fails.
+        Response:
+            - 415: create_error_response and alert "Unsupported media type"
+            - 400: create_error_response and alert "Invalid JSON document" if
+              a JSON body isn't an array
+            - 200: a Mason document with the number of created and failed
+              events and one result per event, in order: status 201 and the
+              location of the event or the status and message of the error
+        """
+        if request.mimetype in NDJSON:
+            documents = read_ndjson(request.stream)
+        elif request.is_json:
+            documents = request.get_json(silent=True)
+            if not isinstance(documents, list):
+                return create_error_response(400, "Invalid JSON document",
+                                             "The body must be an array of events")
+        else:
+            return create_error_response(415, "Unsupported media type",
+                                         "Requests must be JSON or NDJSON")
+
+        results = []
+        chunk = []
+        chunk_size = current_app.config["BATCH_CHUNK_SIZE"]
+        for document in documents:
+            result = {"index": len(results)}
+            results.append(result)
+            error = self.check(document)
+            if error is not None:
+                result.update(status=400, message=error)
+                continue
+            chunk.append((result, document))
+            if len(chunk) >= chunk_size:
+                self.insert(chunk)
+                chunk = []
+        if chunk:
+            self.insert(chunk)
+
+        body = MasonBuilder(
+            created=sum(1 for result in results if result["status"] == 201),
+            failed=sum(1 for result in results if result["status"] != 201),
+            items=results
+        )
+        body.add_namespace("eventhub", LINK_RELATIONS_URL)
+        body.add_control("self", request.path)
+        body.add_control("eventhub:events-all", "/api/events/", title="All events")
+        return mason_response(body)
+
+    @staticmethod
+    def check(document):
+        """
+        Returns the error message for a document that isn't a valid event, or
+        None
+        """
+        if isinstance(document, ValueError):
+            return str(document)
+        try:
+            EVENT_VALIDATOR.validate(document)
+        except ValidationError as e:
+            return e.message
+        try:
+            parse_time(document["time"])
+        except ValueError as e:
+            return str(e)
+        return None
+
+    @staticmethod
+    def insert(chunk):
+        """
+        Inserts a chunk of valid events with one executemany in one
+        transaction and fills in their results. Events of organizations that
+        don't exist get a 409 instead.
+        Parameters:
+            - chunk: list of (result, document) pairs
+        """
+        wanted = {document["organization"] for result, document in chunk}
+        existing = {row.id for row in db.session.query(Organization.id).filter(
+            Organization.id.in_(wanted))}
+        rows = []
+        inserted = []
+        for result, document in chunk:
+            if document["organization"] not in existing:
+                result.update(status=409, message="Organization {} was not found".format(
+                    document["organization"]))
+                continue
+            rows.append({
+                "name": document["name"],
+                "time": parse_time(document["time"]),
+                "description": document["description"],
+                "location": document.get("location"),
+                "organization": document["organization"],
+            })
+            inserted.append(result)
+        if not rows:
+            return
+
+        # the insert holds the write lock until the commit and SQLite gives
+        # new rows the largest id + 1, so the chunk got consecutive ids
+        # ending with the largest one
+        try:
+            db.session.execute(Event.__table__.insert(), rows)
+            last = db.session.query(func.max(Event.id)).scalar()
+            mark_changed(db.session, Event.__tablename__)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            for result in inserted:
+                result.update(status=409, message=str(e.orig))
+            return
+        for id, result in enumerate(inserted, last - len(inserted) + 1):
+            result.update(status=201, location=event_href(id))
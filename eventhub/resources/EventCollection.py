@@ -1,14 +1,17 @@
-from flask_restful import Resource, Api
+from flask_restful import Resource
+from sqlalchemy import tuple_
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
-from flask import Flask, request, abort, Response, current_app
+from flask import Flask, request, abort, Response, current_app, stream_with_context
 
-from .EventItem import EventItem
-from eventhub.models import Event, User
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-import json
+from eventhub.models import Event, User, TableVersion
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, EVENT_VALIDATOR, event_href, \
+    encode_cursor, decode_cursor, get_page_limit, stream_requested, stream_mason, \
+    make_etag, set_validators, not_modified, parse_time, format_time, ItemLayout
 from eventhub import db
-from jsonschema import validate, ValidationError
+from eventhub.cache import cached
+from eventhub.encoding import mason_response, json_accepted
+from jsonschema import ValidationError
 
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
 
@@ -19,10 +22,22 @@ ERROR_PROFILE = "/profiles/error/"
 
 MASON = "application/vnd.mason+json"
 
+# the events in the list, self and profile controls included
+EVENT_ITEM = ItemLayout(
+    ("name", "time", "description", "location", "organization", "follower_count"),
+    "eventitem", EVENT_PROFILE, convert={"time": format_time})
+
+# values of the sort query parameter and the columns of the sort key
+SORT_KEYS = {
+    "id": (Event.id,),
+    "time": (Event.time, Event.id)
+}
+
 class EventCollection(Resource):
     """
     Resource class for events collection
     """
+    @cached("event")
     def get(self):
         """
         get information as follows
@@ -33,51 +48,166 @@ class EventCollection(Resource):
             - description: String, description of event
             - location: String, location of event
             - organization: string, organization that the event belongs to
+        Query parameters:
+            - organization: Integer, only events of this organization
+            - location: String, only events at this location
+            - from: ISO-8601 time, only events at this time or later
+            - to: ISO-8601 time, only events before this time
+            - sort: "id" (default) or "time", the order of the events
+            - limit: Integer, number of events on a page
+            - after: String, cursor of the "next" control, events after it
+            - before: String, cursor of the "prev" control, events before it
+            - stream: "1" to stream all events in one chunked response
+              (same as a stream=1 parameter on the Mason media type in Accept)
         Response:
-            - 200: Return information of all events (as a Mason document)
+            - 400: create_error_response and alert "Invalid query parameter"
+            - 406: create_error_response and alert "Not acceptable" when a stream
+              is asked for in a media type other than Mason JSON
+            - 304: the representation in If-None-Match is still current
+            - 200: Return a page of the matching events in the requested
+              order (as a Mason document)
         """
-        api = Api(current_app)
-        
-        
-        events = Event.query.all()
-        body = InventoryBuilder(event_list=[])
-        
-        #add creator id
-        for item in events:
-            """
-            if (item.creator_id != None):
-                #create a dictionary
-                creator = {}
-                creator["id"] = item.creator_id
-
-                creator_user = User.query.filter_by(id=item.creator_id).first
-                creator_name = creator_user.name
-                creator["name"] = creator_name
-            """
-            event = MasonBuilder(
-                    name=item.name, 
-                    time = item.time,
-                    description=item.description, 
-                    location = item.location, 
-                    organization = item.organization,
-                    #creator = item.creator
-            )
-            event.add_control("self", api.url_for(EventItem, id=item.id))
-            event.add_control("profile", "/profiles/event/")
-            body["event_list"].append(event)
+        # the version is read before the rows, a write in between only makes
+        # the ETag older than the body and the next request gets a new copy
+        version, modified = TableVersion.current("event")
+        etag = make_etag("events", version)
+        response = not_modified(etag, modified)
+        if response is not None:
+            return response
+
+        try:
+            query, columns = self.filter_query()
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        if stream_requested():
+            if not json_accepted():
+                return create_error_response(406, "Not acceptable",
+                                             "Streamed collections are only sent as " + MASON)
+            return set_validators(self.get_stream(query, columns), etag, modified)
+
+        try:
+            limit = get_page_limit()
+            after = request.args.get("after")
+            before = request.args.get("before")
+            if after is not None and before is not None:
+                raise ValueError("after and before can't be used together")
+            types = [column.type.python_type for column in columns]
+            if after is not None:
+                after = decode_cursor(after, *types)
+            if before is not None:
+                before = decode_cursor(before, *types)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # keyset pagination: seek on the sort key instead of using OFFSET,
+        # so every page costs the same no matter how deep the client is.
+        # The sort key ends with the primary key, so it is unique.
+        # One extra row is fetched to find out if there is another page.
+        key = tuple_(*columns) if len(columns) > 1 else columns[0]
+        if before is not None:
+            events = query.filter(key < self.key_value(before)) \
+                .order_by(*(column.desc() for column in columns)).limit(limit + 1).all()
+            has_prev = len(events) > limit
+            events = events[:limit][::-1]
+            has_next = bool(events)
+        else:
+            if after is not None:
+                query = query.filter(key > self.key_value(after))
+            events = query.order_by(*columns).limit(limit + 1).all()
+            has_next = len(events) > limit
+            events = events[:limit]
+            has_prev = after is not None and bool(events)
+
+        body = InventoryBuilder(event_list=list(EVENT_ITEM.items(events)))
 
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
         body.add_control_all_events()
         body.add_control_add_event()
+        if has_next:
+            body.add_control_next_page(encode_cursor(
+                *(getattr(events[-1], column.key) for column in columns)))
+        if has_prev:
+            body.add_control_prev_page(encode_cursor(
+                *(getattr(events[0], column.key) for column in columns)))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return set_validators(mason_response(body), etag, modified)
     
+    @staticmethod
+    def filter_query():
+        """
+        Builds the query of the events matching the filter parameters and
+        returns it with the columns of its sort key. Every filter is a
+        condition on an indexed column, so that SQLite can pick an index for
+        the filter and the order (see the indexes of Event). Raises
+        ValueError for invalid values.
+        """
+        query = Event.query
+        organization = request.args.get("organization")
+        if organization is not None:
+            try:
+                organization = int(organization)
+            except ValueError:
+                raise ValueError("organization must be an integer")
+            query = query.filter(Event.organization == organization)
+        location = request.args.get("location")
+        if location is not None:
+            query = query.filter(Event.location == location)
+        start = request.args.get("from")
+        if start is not None:
+            query = query.filter(Event.time >= parse_time(start))
+        end = request.args.get("to")
+        if end is not None:
+            query = query.filter(Event.time < parse_time(end))
+        sort = request.args.get("sort", "id")
+        if sort not in SORT_KEYS:
+            raise ValueError("sort must be one of {}".format(", ".join(SORT_KEYS)))
+        return query, SORT_KEYS[sort]
+
+    @staticmethod
+    def key_value(values):
+        """
+        Turns the values of a decoded cursor into the value compared with
+        the sort key: a row value for a sort key of several columns
+        """
+        return tuple_(*values) if len(values) > 1 else values[0]
+
+    def get_stream(self, query, columns):
+        """
+        Streams the events of a query as a chunked response. Events are read
+        from the database in batches and encoded one at a time, so memory use
+        doesn't grow with the number of events.
+        Parameters:
+            - query: the filtered query from filter_query
+            - columns: the sort key of the query
+        """
+        body = InventoryBuilder()
+        body.add_namespace("eventhub", LINK_RELATIONS_URL)
+        body.add_control_all_events()
+        body.add_control_add_event()
+
+        rows = query.order_by(*columns).yield_per(
+            current_app.config["STREAM_BATCH_SIZE"])
+        items = EVENT_ITEM.items(rows)
+        return Response(stream_with_context(stream_mason(body, "event_list", items)),
+                        200, mimetype=MASON)
+
+    @staticmethod
+    def serialize_item(item):
+        """
+        Returns the list item of an event in the collection, encoded as the
+        Mason representation of the event
+        Parameters:
+            - item: Event, the event row
+        """
+        return EVENT_ITEM.item(item)
+
     def post(self):
         """
         post information for new event 
         Parameters:
             - name: String, name of the event
-            - time: String, time of the event
+            - time: String, ISO-8601 time of the event
             - description: String, description of event
             - location: String, location of the event
             - organization: Integer, organization that the event belongs to
@@ -87,20 +217,20 @@ class EventCollection(Resource):
             - 400: create_error_response and alert "Invalid JSON document" 
             - 201: success to post
         """
-        api = Api(current_app)
         if not request.json:
             return create_error_response(415, "Unsupported media type","Requests must be JSON")
 
         try:
-            validate(request.json, InventoryBuilder.event_schema())
-        except ValidationError as e:
+            EVENT_VALIDATOR.validate(request.json)
+            time = parse_time(request.json["time"])
+        except (ValidationError, ValueError) as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
         # user = User.query.filter_by(id=request.json["creator_id"]).first()
       
         event = Event(
             name = request.json["name"],
-            time = request.json["time"],
+            time = time,
             description = request.json["description"],
             location = request.json["location"],
             organization = request.json["organization"],
@@ -112,7 +242,7 @@ class EventCollection(Resource):
         db.session.add(event)
         db.session.commit()
 
-        #print(api.url_for(EventItem, id=event.id))
+        #print(event_href(event.id))
 
     
-        return Response(status=201, headers={"Location": api.url_for(EventItem, id=event.id)})
\ No newline at end of file
+        return Response(status=201, headers={"Location": event_href(event.id)})
\ No newline at end of file
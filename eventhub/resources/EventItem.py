@@ -1,14 +1,16 @@
-from flask_restful import Resource, Api, reqparse
+from flask_restful import Resource, reqparse
 from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, jwt_refresh_token_required, get_jwt_identity, get_raw_jwt)
 
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, request, abort, Response, current_app
 from eventhub import db
+from eventhub.cache import cached
 from eventhub.models import Event, User
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-import json
-from jsonschema import validate, ValidationError
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, EVENT_VALIDATOR, event_href, make_etag, set_validators, not_modified, \
+    parse_time, format_time
+from eventhub.encoding import mason_response
+from jsonschema import ValidationError
 from datetime import datetime
 
 
@@ -26,6 +28,7 @@ class EventItem(Resource):
     """
     Resource class for particular event
     """
+    @cached("event")
     def get(self, id):
         """
         get details for particular event 
@@ -33,15 +36,20 @@ class EventItem(Resource):
             - id: Integer, event ID
         Response:(tbc)
             - 404: create_error_response and alert "No event was found with the id {}"
+            - 304: the representation in If-None-Match is still current
             - 200: Return information of the event (returns a Mason document)
         """
-        api = Api(current_app)
         event_db = Event.query.filter_by(id=id).first()
         if event_db is None:
             return create_error_response(404, "Event not found",
                                          "Event ID {} was not found".format(
                                              id)
                                          )
+        # the modification time tells apart a row that got the id of a deleted one
+        etag = make_etag("event", event_db.id, event_db.version, event_db.modified)
+        response = not_modified(etag, event_db.modified)
+        if response is not None:
+            return response
         """
         if event_db.creator is None:
             return create_error_response(404, "Event not found",
@@ -51,19 +59,21 @@ class EventItem(Resource):
         """
         body = InventoryBuilder(
             name=event_db.name,
-            time=event_db.time,
+            time=format_time(event_db.time),
             description=event_db.description,
             location=event_db.location,
-            organization = event_db.organization
+            organization = event_db.organization,
+            follower_count = event_db.follower_count
         )
         
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(EventItem, id=id))
+        body.add_control("self", event_href(id))
         body.add_control("profile", EVENT_PROFILE)
         body.add_control_delete_event(id)
         body.add_control_edit_event(id)
         body.add_control_all_events()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = mason_response(body)
+        return set_validators(response, etag, event_db.modified)
 
     def put(self, id):
         """
@@ -71,7 +81,7 @@ class EventItem(Resource):
         Parameters:
             - id: Integer, id of event
             - name: String, name of event
-            - time: DateTime, time of event
+            - time: String, ISO-8601 time of event
             - description: String, description of event
             - location: String, location of event
             - organization: string, organization that the event belongs to
@@ -81,7 +91,6 @@ class EventItem(Resource):
             - 400: create_error_response and alert "Invalid JSON document"
             - 204: success to edit
         """
-        api = Api(current_app)
         if not request.json:
             return create_error_response(415, "Unsupported media type",
                                          "Requests must be JSON"
@@ -89,7 +98,6 @@ class EventItem(Resource):
 
         body = Event(
             name=request.json["name"],
-            time=request.json["time"],
             description=request.json["description"],
             location=request.json["location"],
             organization=request.json["organization"],
@@ -103,12 +111,13 @@ class EventItem(Resource):
                                          )
 
         try:
-            validate(request.json, InventoryBuilder.event_schema())
-        except ValidationError as e:
+            EVENT_VALIDATOR.validate(request.json)
+            time = parse_time(request.json["time"])
+        except (ValidationError, ValueError) as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
         event_db.name = body.name
-        event_db.time = body.time
+        event_db.time = time
         event_db.location = body.location
         event_db.description = body.description
         event_db.organization = body.organization
@@ -124,7 +133,6 @@ class EventItem(Resource):
             -404: create_error_response and alert "Event not found"
             -204: success to delete
         """
-        api = Api(current_app)
         event_db = Event.query.filter_by(id=id).first()
         if event_db is None:
                 return create_error_response(404, "Event not found",
@@ -0,0 +1,81 @@
+from flask_restful import Resource
+from flask import request, Response, current_app
+import re
+from eventhub.models import TableVersion, match_expression, search_window, search_events, \
+    matches_before
+from eventhub.resources.EventCollection import EventCollection
+from eventhub.utils import InventoryBuilder, create_error_response, encode_cursor, decode_cursor, \
+    get_page_limit, make_etag, set_validators, not_modified
+from eventhub.cache import cached
+from eventhub.encoding import mason_response
+
+LINK_RELATIONS_URL = "/eventhub/link-relations/"
+
+MASON = "application/vnd.mason+json"
+
+WORD = re.compile(r"\w+")
+
+
+class EventSearch(Resource):
+    """
+    Resource class for the full text search of events
+    """
+    @cached("event")
+    def get(self):
+        """
+        search events by name, description and location
+        Query parameters:
+            - q: String, the words to search for, an event must contain all
+              of them. A match in the name counts most, then the location
+              and then the description. If SEARCH_CANDIDATES is set only
+              that many newest matches are ranked and "truncated" is true
+              when older ones are left out.
+            - limit: Integer, number of events on a page
+            - after: String, cursor of the "next" control, events after it
+        Response:
+            - 400: create_error_response and alert "Invalid query parameter"
+            - 304: the representation in If-None-Match is still current
+            - 200: Return a page of matching events, best match first (as a
+              Mason document)
+        """
+        version, modified = TableVersion.current("event")
+        etag = make_etag("events-search", version)
+        response = not_modified(etag, modified)
+        if response is not None:
+            return response
+
+        try:
+            terms = WORD.findall(request.args.get("q", ""))
+            if not terms:
+                raise ValueError("q must contain at least one word")
+            limit = get_page_limit()
+            after = request.args.get("after")
+            if after is not None:
+                rank, id, low, high = decode_cursor(after, float, int, int, int)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # the window of ranked matches travels in the cursor, so that events
+        # created meanwhile don't shift it between pages
+        query = match_expression(terms)
+        if after is not None:
+            window = (low, high)
+            after = (rank, id)
+        else:
+            window = search_window(query, current_app.config["SEARCH_CANDIDATES"])
+        rows = search_events(query, window, limit + 1, after) if window else []
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+
+        body = InventoryBuilder(event_list=[])
+        for row in rows:
+            body["event_list"].append(EventCollection.serialize_item(row))
+        body["truncated"] = window is not None and matches_before(query, window[0])
+
+        body.add_namespace("eventhub", LINK_RELATIONS_URL)
+        body.add_control("self", request.full_path)
+        body.add_control_all_events()
+        if has_next:
+            body.add_control_next_page(encode_cursor(rows[-1].rank, rows[-1].id, *window))
+
+        return set_validators(mason_response(body), etag, modified)
@@ -1,13 +1,14 @@
-from flask_restful import Resource, Api
+from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
-from flask import Flask, request, abort, Response, current_app
-from .OrgItem import OrgItem
-from eventhub.models import Organization
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-import json
+from flask import Flask, request, abort, Response, current_app, stream_with_context
+from eventhub.models import Organization, TableVersion
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, ORG_VALIDATOR, org_href, \
+    stream_requested, stream_mason, make_etag, set_validators, not_modified, ItemLayout
 from eventhub import db
-from jsonschema import validate, ValidationError
+from eventhub.cache import cached
+from eventhub.encoding import mason_response, json_accepted
+from jsonschema import ValidationError
 
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
 
@@ -18,37 +19,65 @@ ERROR_PROFILE = "/profiles/error/"
 
 MASON = "application/vnd.mason+json"
 
+# the organizations in the list, self and profile controls included
+ORG_ITEM = ItemLayout(("name", "member_count"), "orgitem", ORG_PROFILE)
+
 class OrgCollection(Resource):
     """
     Resource class for collection of organizations
     """
+    @cached("organization")
     def get(self):
         """
         get information as follows
         Information:
             - name: name of the organization
+        Query parameters:
+            - stream: "1" to stream the organizations in a chunked response
+              (same as a stream=1 parameter on the Mason media type in Accept)
         Response:
+            - 406: create_error_response and alert "Not acceptable" when a stream
+              is asked for in a media type other than Mason JSON
+            - 304: the representation in If-None-Match is still current
             - 200: Return information of all organizations as a Mason document
         """
-        api = Api(current_app)
-        
-        
-        orgs = Organization.query.all()
-        body = InventoryBuilder(orgs_list=[])
-        
-        for item in orgs:
-            org = MasonBuilder(
-                    name=item.name,
-            )
-            org.add_control("self", api.url_for(OrgItem, id=item.id))
-            org.add_control("profile", "/profiles/org/")
-            body["orgs_list"].append(org)
+        version, modified = TableVersion.current("organization")
+        etag = make_etag("orgs", version)
+        response = not_modified(etag, modified)
+        if response is not None:
+            return response
 
+        body = InventoryBuilder()
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
         body.add_control_all_orgs()
         body.add_control_add_org()
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if stream_requested():
+            if not json_accepted():
+                return create_error_response(406, "Not acceptable",
+                                             "Streamed collections are only sent as " + MASON)
+            rows = Organization.query.order_by(Organization.id).yield_per(
+                current_app.config["STREAM_BATCH_SIZE"])
+            items = ORG_ITEM.items(rows)
+            response = Response(stream_with_context(stream_mason(body, "orgs_list", items)),
+                                200, mimetype=MASON)
+            return set_validators(response, etag, modified)
+
+        orgs = Organization.query.all()
+        body = InventoryBuilder(orgs_list=list(ORG_ITEM.items(orgs)), **body)
+
+        return set_validators(mason_response(body), etag, modified)
+
+    @staticmethod
+    def serialize_item(item):
+        """
+        Returns the list item of an organization in the collection, encoded
+        as the Mason representation of the organization
+        Parameters:
+            - item: Organization, the organization row
+        """
+        return ORG_ITEM.item(item)
+
     def post(self):
         """
         post information for new organization
@@ -61,12 +90,11 @@ class OrgCollection(Resource):
             - 201: succeed to post
             
         """
-        api = Api(current_app)
         if not request.json:
             return create_error_response(415, "Unsupported media type","Requests must be JSON")
 
         try:
-            validate(request.json, InventoryBuilder.org_schema())
+            ORG_VALIDATOR.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
@@ -83,4 +111,4 @@ class OrgCollection(Resource):
                                                "The organization already exists")
 
     
-        return Response(status=201, headers={"Location": api.url_for(OrgItem, id=org.id)})
\ No newline at end of file
+        return Response(status=201, headers={"Location": org_href(org.id)})
\ No newline at end of file
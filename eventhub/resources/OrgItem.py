@@ -1,14 +1,15 @@
-from flask_restful import Resource, Api
+from flask_restful import Resource
 
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, request, abort, Response, current_app
 from eventhub import db
+from eventhub.cache import cached
 # mainly subfunctions
 from eventhub.models import Organization
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-import json
-from jsonschema import validate, ValidationError
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, ORG_VALIDATOR, org_href, make_etag, set_validators, not_modified
+from eventhub.encoding import mason_response
+from jsonschema import ValidationError
 
 
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
@@ -24,6 +25,7 @@ class OrgItem(Resource):
     """
     Resource class for particular organization
     """
+    @cached("organization")
     def get(self, id):
         """
         get details for particular organization
@@ -31,25 +33,32 @@ class OrgItem(Resource):
             - id: Integer, event ID
         Response:(tbc)
             - 404: create_error_response and message "No organization was found with the id {}"
+            - 304: the representation in If-None-Match is still current
             - 200: Return information of the organization (returns a Mason document)
         """
-        api = Api(current_app)
         org_db = Organization.query.filter_by(id=id).first()
         if org_db is None:
             return create_error_response(404, "Not found",
                                          "No organization was found with the id {}".format(id)
                                          )
-        
+        # the modification time tells apart a row that got the id of a deleted one
+        etag = make_etag("organization", org_db.id, org_db.version, org_db.modified)
+        response = not_modified(etag, org_db.modified)
+        if response is not None:
+            return response
+
         body = InventoryBuilder(
-            name=org_db.name
+            name=org_db.name,
+            member_count=org_db.member_count
         )
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(OrgItem, id=id))
+        body.add_control("self", org_href(id))
         body.add_control("profile", ORG_PROFILE)
         body.add_control_delete_org(id)
         body.add_control_edit_org(id)
         body.add_control_all_orgs()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = mason_response(body)
+        return set_validators(response, etag, org_db.modified)
 
         
     def put(self, id):
@@ -65,13 +74,12 @@ class OrgItem(Resource):
             - 409: create_error_response and alert "The organization already exists" 
             - 204: success to edit
         """
-        api = Api(current_app)
         if not request.json:
             return create_error_response(415, "Unsupported media type",
                                          "Requests must be JSON"
                                          )
         try:
-            validate(request.json, InventoryBuilder.org_schema())
+            ORG_VALIDATOR.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -106,7 +114,6 @@ class OrgItem(Resource):
         #     -404: create_error_response and alert "Organization not found"
         #     -204: success to delete
         """
-        api = Api(current_app)
         org_db = Organization.query.filter_by(id=id).first()
         if org_db is None:
                 return create_error_response(404, "Not found",
@@ -1,16 +1,19 @@
-from flask_restful import Resource, Api
+from flask_restful import Resource
 
 from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, jwt_refresh_token_required, get_jwt_identity, get_raw_jwt)
 
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
-from flask import Flask, request, abort, Response, current_app
-from .UserItem import UserItem
-from eventhub.models import Event, User
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, hash_password
-import json
+from flask import Flask, request, abort, Response, current_app, stream_with_context
+from eventhub.models import Event, User, TableVersion
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, USER_VALIDATOR, user_href, \
+    stream_requested, stream_mason, make_etag, set_validators, not_modified, USER_FIELDS, get_fields, \
+    ItemLayout
 from eventhub import db
-from jsonschema import validate, ValidationError
+from eventhub.cache import cached
+from eventhub.hashing import get_password_hasher, HashingBusy
+from eventhub.encoding import mason_response, json_accepted
+from jsonschema import ValidationError
 
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
 
@@ -22,40 +25,75 @@ ERROR_PROFILE = "/profiles/error/"
 MASON = "application/vnd.mason+json"
 
 
+# the users in the list with all of their fields
+USER_ITEM = ItemLayout(USER_FIELDS, "useritem", USER_PROFILE)
+
+
 class UserCollection(Resource):
     # Resource class for representing all users
+    @cached("user")
     def get(self):
         """
         Return information of all users (returns a Mason document) if found otherwise returns 404
         get all users information
+        Query parameters:
+            - stream: "1" to stream the users in a chunked response
+              (same as a stream=1 parameter on the Mason media type in Accept)
+            - fields: comma separated fields of the users to include, only
+              those columns are read (default: all of USER_FIELDS)
         Response:
+            - 400: create_error_response and alert "Invalid query parameter"
+            - 406: create_error_response and alert "Not acceptable" when a stream
+              is asked for in a media type other than Mason JSON
+            - 304: the representation in If-None-Match is still current
             - 200: Return information of all users (returns a Mason document)
         """
-        api = Api(current_app)
+        version, modified = TableVersion.current("user")
+        etag = make_etag("users", version)
+        response = not_modified(etag, modified)
+        if response is not None:
+            return response
 
-        
-        users = User.query.all()
-        body = InventoryBuilder(items=[])
-
-        for i in users:
-            item = MasonBuilder(
-                name = i.name,
-                email = i.email,
-                pwdhash = i.pwdhash,
-                location = i.location,
-                notifications = i.notifications
-            )
-            item.add_control("self", api.url_for(
-                UserItem, id=i.id))
-            item.add_control("profile", "/profiles/user/")
-            body["items"].append(item)
-            
+        try:
+            fields = get_fields(USER_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        query = db.session.query(User.id, *(getattr(User, field) for field in fields)) \
+            .order_by(User.id)
+        layout = USER_ITEM if tuple(fields) == USER_FIELDS else \
+            ItemLayout(fields, "useritem", USER_PROFILE)
+
+        body = InventoryBuilder()
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
         body.add_control_all_users()
         body.add_control_add_user()
-            #print(body)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        if stream_requested():
+            if not json_accepted():
+                return create_error_response(406, "Not acceptable",
+                                             "Streamed collections are only sent as " + MASON)
+            rows = query.yield_per(current_app.config["STREAM_BATCH_SIZE"])
+            items = layout.items(rows)
+            response = Response(stream_with_context(stream_mason(body, "items", items)),
+                                200, mimetype=MASON)
+            return set_validators(response, etag, modified)
+
+        users = query.all()
+        body = InventoryBuilder(items=list(layout.items(users)), **body)
+
+        return set_validators(mason_response(body), etag, modified)
+
+    @staticmethod
+    def serialize_item(i, layout=None):
+        """
+        Returns the list item of a user in the collection, encoded as the
+        Mason representation of the user
+        Parameters:
+            - i: User, the user row or a row with its id and the fields
+            - layout: ItemLayout of the fields to include (default: all of
+              USER_FIELDS)
+        """
+        return (layout or USER_ITEM).item(i)
 
     def post(self):
         """
@@ -70,22 +108,27 @@ class UserCollection(Resource):
             - 415: "Unsupported media type" "Requests must be JSON"
             - 400: "Invalid JSON document"
             - 409: "Already exists" "The email address is already in use."
+            - 503: "Service unavailable" when too many passwords wait to be hashed
             - 201: succeed
         """
     
-        api = Api(current_app)
         if not request.json:
             return create_error_response(415, "Unsupported media type","Requests must be JSON")
         try:
-            validate(request.json, InventoryBuilder.user_schema())
+            USER_VALIDATOR.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         
         password = request.json["password"]
+        try:
+            pwdhash = get_password_hasher().hash(password)
+        except HashingBusy as e:
+            return create_error_response(503, "Service unavailable", str(e))
+
         user = User(
             name=request.json['name'],
             email=request.json['email'],
-            pwdhash=hash_password(password),
+            pwdhash=pwdhash,
             location=request.json["location"],
             notifications=request.json["notifications"]
         )
@@ -98,4 +141,4 @@ class UserCollection(Resource):
             return create_error_response(409, "Already exists",
                                                "The email address {} is already in use.".format(user.email))
     
-        return Response(status=201, headers={"Location": api.url_for(UserItem, id=user.id)})
\ No newline at end of file
+        return Response(status=201, headers={"Location": user_href(user.id)})
\ No newline at end of file
@@ -1,17 +1,17 @@
-from flask_restful import Resource, Api
+from flask_restful import Resource
 
 
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, request, abort, Response, current_app
-from .UserItem import UserItem
 from eventhub import db
-from eventhub.models import Event, User, EventsAndUsers
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-import json
+from eventhub.models import Event, User, EventsAndUsers, missing_users, add_users, remove_users
+from eventhub.cache import mark_changed
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, compact_requested, statement_budget, event_href, user_href, \
+    USER_IDS_VALIDATOR, format_time, USER_FIELDS, get_fields
+from eventhub.encoding import mason_response
 
 from jsonschema import validate, ValidationError
-from .EventItem import EventItem
 
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
 
@@ -23,94 +23,191 @@ ERROR_PROFILE = "/profiles/error/"
 MASON = "application/vnd.mason+json"
 
 class EventsByUser(Resource):
+    @statement_budget(1)
     def get(self, user_id):
         """
         Get all the events information for a user
         Parameters:
             - id: Integer, user id
+        Query parameters:
+            - compact: "1" for item edit controls that refer to their schema
+              with schemaUrl (same as a compact=1 parameter on the Mason
+              media type in Accept)
         Response:
             - 404: "User not found", "User ID {} was not found"
             - 200: Return the events information
         """
-        api = Api(current_app)
+        compact = compact_requested()
         body = InventoryBuilder(items=[])
-        user = User.query.filter_by(id=user_id).first()
-        if user is None:
+        # the user and the followed events in one query, a user without
+        # events gives one row with the event columns as NULL
+        rows = db.session.query(
+            User.id.label("user_id"), User.name.label("user_name"),
+            Event.id, Event.name, Event.time, Event.description,
+            Event.location, Event.organization, Event.follower_count
+        ).outerjoin(EventsAndUsers, EventsAndUsers.user_id == User.id) \
+         .outerjoin(Event, Event.id == EventsAndUsers.event_id) \
+         .filter(User.id == user_id).order_by(Event.id).all()
+        if not rows:
             return create_error_response(404, "Not found",
                                         "User ID {} was not found".format(user_id))
-        body["user"] = {"user_id":user.id,"name":user.name}
+        body["user"] = {"user_id":rows[0].user_id,"name":rows[0].user_name}
 
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserItem, id=user_id))
+        body.add_control("self", user_href(user_id))
         body.add_control("profile", USER_PROFILE)
         body.add_control_delete_user(user_id)
         body.add_control_edit_user(user_id)
         body.add_control_all_users()
 
-        # find all the events
-        followed_events = Event.query.filter(Event.users1.any(user_id=user_id)).all()
         # for each event, find specific information
-        for i in followed_events:
+        for i in rows:
+            if i.id is None:
+                continue
             event = InventoryBuilder()
             event["name"] = i.name
-            event["time"] = i.time
+            event["time"] = format_time(i.time)
             event["description"] = i.description
             event["location"] = i.location
             event["organization"] = i.organization
+            event["follower_count"] = i.follower_count
 
             event.add_namespace("eventhub", LINK_RELATIONS_URL)
-            event.add_control("self", api.url_for(EventItem, id=i.id))
+            event.add_control("self", event_href(i.id))
             event.add_control("profile", EVENT_PROFILE)
             event.add_control_delete_event(i.id)
-            event.add_control_edit_event(i.id)
+            event.add_control_edit_event(i.id, compact)
             event.add_control_all_events()
             body["items"].append(event)  
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
 
 class UsersByEvent(Resource):
+    @statement_budget(1)
     def get(self, event_id):
         """
         Get all the users' details for a event
         Parameters:
             - id: Integer, event id
+        Query parameters:
+            - compact: "1" for item edit controls that refer to their schema
+              with schemaUrl (same as a compact=1 parameter on the Mason
+              media type in Accept)
+            - fields: comma separated fields of the users to include, only
+              those columns are read (default: all of USER_FIELDS)
         Response:
+            - 400: create_error_response and alert "Invalid query parameter"
             - 404: "Event not found", "Event ID {} was not found"
             - 200: Return the users' email addresses
         """
-        api = Api(current_app)
+        try:
+            fields = get_fields(USER_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        compact = compact_requested()
         body = InventoryBuilder(items=[])
-        event = Event.query.filter_by(id=event_id).first()
-        if event is None:
+        # the event and its followers in one query, an event without
+        # followers gives one row with the user columns as NULL
+        rows = db.session.query(
+            Event.id.label("event_id"), Event.name.label("event_name"),
+            User.id, *(getattr(User, field) for field in fields)
+        ).outerjoin(EventsAndUsers, EventsAndUsers.event_id == Event.id) \
+         .outerjoin(User, User.id == EventsAndUsers.user_id) \
+         .filter(Event.id == event_id).order_by(User.id).all()
+        if not rows:
             return create_error_response(404, "Event not found",
                                         "Event ID {} was not found".format(event_id))
-        body["event"] = {"event_id":event.id,"name":event.name}
+        body["event"] = {"event_id":rows[0].event_id,"name":rows[0].event_name}
 
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(EventItem, id=event_id))
+        body.add_control("self", event_href(event_id))
         body.add_control("profile", EVENT_PROFILE)
         body.add_control_delete_event(event_id)
         body.add_control_edit_event(event_id)
         body.add_control_all_events()
+        body.add_control_add_users(request.path)
+        body.add_control_remove_users(request.path)
         
-        # find all the users
-        followers = User.query.filter(User.events.any(event_id=event.id)).all()
         # for each user, find the id and email
-        for i in followers:
+        for i in rows:
+            if i.id is None:
+                continue
             user = InventoryBuilder()
-            user["name"] = i.name
-            user["email"] = i.email
-            user["pwdhash"] = i.pwdhash
-            user["location"] = i.location
-            user["notifications"] = i.notifications
+            for field in fields:
+                user[field] = getattr(i, field)
 
             user.add_namespace("eventhub", LINK_RELATIONS_URL)
-            user.add_control("self", api.url_for(UserItem, id=i.id))
+            user.add_control("self", user_href(i.id))
             user.add_control("profile", USER_PROFILE)
             user.add_control_delete_user(i.id)
-            user.add_control_edit_user(i.id)
+            user.add_control_edit_user(i.id, compact)
             user.add_control_all_users()
             body["items"].append(user)  
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
\ No newline at end of file
+        return mason_response(body)
+
+    def post(self, event_id):
+        """
+        make users follow an event
+        Parameters:
+            - event_id: Integer, event id
+            - users: list of Integer, ids of the users
+        Response:
+            - 415: "Unsupported media type" "Requests must be JSON"
+            - 400: "Invalid JSON document"
+            - 404: "Event not found" or "Users not found" with the unknown ids,
+              nothing is added then
+            - 204: the users follow the event, also if some already were
+        """
+        return self.change_users(event_id, add=True)
+
+    def delete(self, event_id):
+        """
+        make users stop following an event
+        Parameters:
+            - event_id: Integer, event id
+            - users: list of Integer, ids of the users
+        Response:
+            - 415: "Unsupported media type" "Requests must be JSON"
+            - 400: "Invalid JSON document"
+            - 404: "Event not found"
+            - 204: the users don't follow the event anymore
+        """
+        return self.change_users(event_id, add=False)
+
+    @staticmethod
+    def change_users(event_id, add):
+        """
+        Adds or removes the users of the request body with one set-based
+        statement, however many users there are
+        """
+        if not request.is_json:
+            return create_error_response(415, "Unsupported media type",
+                                         "Requests must be JSON")
+        try:
+            USER_IDS_VALIDATOR.validate(request.json)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        owner = db.session.query(Event.id).filter(Event.id == event_id).scalar()
+        if owner is None:
+            return create_error_response(404, "Event not found",
+                                        "Event ID {} was not found".format(event_id))
+        user_ids = request.json["users"]
+        if add:
+            missing = missing_users(user_ids)
+            if missing:
+                return create_error_response(404, "Users not found",
+                                             "No users were found with the ids {}".format(missing))
+            add_users(EventsAndUsers, "event_id", owner, user_ids)
+        else:
+            remove_users(EventsAndUsers, "event_id", owner, user_ids)
+        mark_changed(db.session, EventsAndUsers.__tablename__)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a user was deleted meanwhile
+            db.session.rollback()
+            return create_error_response(409, "Conflict", "The users changed, try again")
+        return Response(status=204)
\ No newline at end of file
@@ -0,0 +1,74 @@
+from flask_restful import Resource
+from sqlalchemy import and_, tuple_
+from flask import request, Response
+from datetime import datetime
+from eventhub import db
+from eventhub.models import Event, User, FeedEntry
+from eventhub.resources.EventCollection import EventCollection
+from eventhub.utils import InventoryBuilder, create_error_response, statement_budget, user_href, \
+    encode_cursor, decode_cursor, get_page_limit
+from eventhub.encoding import mason_response
+
+LINK_RELATIONS_URL = "/eventhub/link-relations/"
+
+MASON = "application/vnd.mason+json"
+
+
+class UserFeed(Resource):
+    """
+    Resource class for the upcoming events of a user
+    """
+    @statement_budget(1)
+    def get(self, user_id):
+        """
+        Get the upcoming events the user follows and the upcoming events of
+        the user's organizations, soonest first
+        Parameters:
+            - user_id: Integer, user id
+        Query parameters:
+            - limit: Integer, number of events on a page
+            - after: String, cursor of the "next" control, events after it
+        Response:
+            - 400: create_error_response and alert "Invalid query parameter"
+            - 404: "User not found", "User ID {} was not found"
+            - 200: Return a page of events (as a Mason document)
+        """
+        try:
+            limit = get_page_limit()
+            after = request.args.get("after")
+            if after is not None:
+                after = decode_cursor(after, datetime, int)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
+        # the feed rows of a user are clustered by time, so the page is one
+        # range scan of the feed table. The outer join gives one row with
+        # the event columns as NULL for a user without upcoming events.
+        if after is not None:
+            seek = tuple_(FeedEntry.time, FeedEntry.event_id) > tuple_(*after)
+        else:
+            seek = FeedEntry.time >= datetime.utcnow()
+        rows = db.session.query(
+            User.id.label("user_id"), Event.id, Event.name, Event.time, Event.description,
+            Event.location, Event.organization, Event.follower_count
+        ).outerjoin(FeedEntry, and_(FeedEntry.user_id == User.id, seek)) \
+         .outerjoin(Event, Event.id == FeedEntry.event_id) \
+         .filter(User.id == user_id) \
+         .order_by(FeedEntry.time, FeedEntry.event_id).limit(limit + 1).all()
+        if not rows:
+            return create_error_response(404, "User not found",
+                                         "User ID {} was not found".format(user_id))
+        rows = [row for row in rows if row.id is not None]
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+
+        body = InventoryBuilder(event_list=[])
+        for row in rows:
+            body["event_list"].append(EventCollection.serialize_item(row))
+
+        body.add_namespace("eventhub", LINK_RELATIONS_URL)
+        body.add_control("up", user_href(user_id), title="The user")
+        body.add_control_all_events()
+        if has_next:
+            body.add_control_next_page(encode_cursor(rows[-1].time, rows[-1].id))
+        return mason_response(body)
@@ -0,0 +1,196 @@
+from flask_restful import Resource
+from flask import request, Response, current_app
+from eventhub import db
+from eventhub.cache import mark_changed
+from eventhub.hashing import get_password_hasher
+from eventhub.models import User
+from eventhub.utils import MasonBuilder, create_error_response, USER_VALIDATOR, user_href, \
+    read_ndjson, NDJSON
+from eventhub.encoding import mason_response
+import click
+import csv
+import io
+from jsonschema import ValidationError
+
+LINK_RELATIONS_URL = "/eventhub/link-relations/"
+
+MASON = "application/vnd.mason+json"
+CSV = "text/csv"
+
+
+class UserImport(Resource):
+    """
+    Resource class for importing many users in one request
+    """
+    def post(self):
+        """
+        import users in bulk. The body is CSV with a header row (name, email,
+        password, location, notifications), an NDJSON stream with one user
+        per line or a JSON array of users. Passwords are hashed in the
+        password hashing pool and the users are inserted in transactions of
+        BATCH_CHUNK_SIZE users. Users whose email address is already in use
+        are reported and skipped, the rest of the batch goes on.
+        Response:
+            - 415: create_error_response and alert "Unsupported media type"
+            - 400: create_error_response and alert "Invalid JSON document" if
+              a JSON body isn't an array
+            - 200: a Mason document with the number of created and failed
+              users and one result per user, in order: status 201 and the
+              location of the user or the status and message of the error
+        """
+        if request.mimetype in NDJSON:
+            documents = read_ndjson(request.stream)
+        elif request.mimetype == CSV:
+            documents = read_users_csv(io.TextIOWrapper(request.stream, encoding="utf-8", newline=""))
+        elif request.is_json:
+            documents = request.get_json(silent=True)
+            if not isinstance(documents, list):
+                return create_error_response(400, "Invalid JSON document",
+                                             "The body must be an array of users")
+        else:
+            return create_error_response(415, "Unsupported media type",
+                                         "Requests must be CSV, NDJSON or JSON")
+
+        results = import_users(documents)
+        body = MasonBuilder(
+            created=sum(1 for result in results if result["status"] == 201),
+            failed=sum(1 for result in results if result["status"] != 201),
+            items=results
+        )
+        body.add_namespace("eventhub", LINK_RELATIONS_URL)
+        body.add_control("self", request.path)
+        body.add_control("eventhub:users-all", "/api/users/", title="All users")
+        return mason_response(body)
+
+
+def read_users_csv(stream):
+    """
+    Yields the users of a CSV file with a header row as documents for the
+    user schema. Notifications are turned into integers and an empty
+    location is left out.
+    Parameters:
+        - stream: text file object
+    """
+    for row in csv.DictReader(stream):
+        document = {key: value for key, value in row.items() if key is not None}
+        if document.get("location") == "":
+            del document["location"]
+        try:
+            document["notifications"] = int(document["notifications"])
+        except (KeyError, TypeError, ValueError):
+            pass
+        yield document
+
+
+def check_user(document):
+    """
+    Returns the error message for a document that isn't a valid new user,
+    or None
+    """
+    if isinstance(document, ValueError):
+        return str(document)
+    try:
+        USER_VALIDATOR.validate(document)
+    except ValidationError as e:
+        return e.message
+    if document["notifications"] not in (0, 1):
+        return "notifications must be 0 or 1"
+    return None
+
+
+def import_users(documents):
+    """
+    Validates, hashes and inserts users and returns one result dict per
+    document, in order. Used by the import endpoint and the import-users
+    command.
+    Parameters:
+        - documents: iterable of user documents
+    """
+    results = []
+    chunk = []
+    chunk_size = current_app.config["BATCH_CHUNK_SIZE"]
+    for document in documents:
+        result = {"index": len(results)}
+        results.append(result)
+        error = check_user(document)
+        if error is not None:
+            result.update(status=400, message=error)
+            continue
+        chunk.append((result, document))
+        if len(chunk) >= chunk_size:
+            insert_users(chunk)
+            chunk = []
+    if chunk:
+        insert_users(chunk)
+    return results
+
+
+def insert_users(chunk):
+    """
+    Inserts a chunk of valid users in one transaction and fills in their
+    results. Email addresses already in the database or earlier in the
+    chunk get a 409 before their passwords are hashed; the insert ignores
+    rows that still collide with a user created meanwhile.
+    Parameters:
+        - chunk: list of (result, document) pairs
+    """
+    emails = [document["email"] for result, document in chunk]
+    taken = {row.email for row in db.session.query(User.email).filter(User.email.in_(emails))}
+    fresh = []
+    for result, document in chunk:
+        if document["email"] in taken:
+            result.update(status=409, message="The email address {} is already in use.".format(
+                document["email"]))
+            continue
+        taken.add(document["email"])
+        fresh.append((result, document))
+    if not fresh:
+        return
+
+    hashes = get_password_hasher().hash_many(document["password"] for result, document in fresh)
+    rows = [{
+        "name": document["name"],
+        "email": document["email"],
+        "pwdhash": pwdhash,
+        "location": document.get("location"),
+        "notifications": document["notifications"],
+    } for (result, document), pwdhash in zip(fresh, hashes)]
+    db.session.execute(User.__table__.insert().prefix_with("OR IGNORE"), rows)
+
+    # every hash has its own salt, so a row with our hash is one we inserted
+    stored = {row.email: row for row in db.session.query(User.id, User.email, User.pwdhash)
+              .filter(User.email.in_([row["email"] for row in rows]))}
+    mark_changed(db.session, User.__tablename__)
+    db.session.commit()
+    for (result, document), row in zip(fresh, rows):
+        user = stored.get(row["email"])
+        if user is not None and user.pwdhash == row["pwdhash"]:
+            result.update(status=201, location=user_href(user.id))
+        else:
+            result.update(status=409, message="The email address {} is already in use.".format(
+                row["email"]))
+
+
+@click.command("import-users")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "source_format", type=click.Choice(["csv", "ndjson"]),
+              help="Format of the file, guessed from its name by default")
+def import_users_command(source, source_format):
+    """
+    Imports users from a CSV or NDJSON file
+    """
+    if source_format is None:
+        source_format = "csv" if source.name.endswith(".csv") else "ndjson"
+    if source_format == "csv":
+        documents = read_users_csv(source)
+    else:
+        documents = read_ndjson(source)
+    results = import_users(documents)
+    created = 0
+    for result in results:
+        if result["status"] == 201:
+            created += 1
+        else:
+            click.echo("item {}: {} {}".format(result["index"], result["status"], result["message"]),
+                       err=True)
+    click.echo("created {} users, {} failed".format(created, len(results) - created))
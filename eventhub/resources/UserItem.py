@@ -1,14 +1,16 @@
-from flask_restful import Resource, Api, reqparse
+from flask_restful import Resource, reqparse
 from flask_jwt_extended import (create_access_token, create_refresh_token, jwt_required, jwt_refresh_token_required, get_jwt_identity, get_raw_jwt)
 
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, request, abort, Response, current_app
 from eventhub.models import Event, User
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, hash_password
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, USER_VALIDATOR, USER_PATCH_VALIDATOR, user_href, make_etag, set_validators, not_modified
 from eventhub import db
-import json
-from jsonschema import validate, ValidationError
+from eventhub.cache import cached
+from eventhub.hashing import get_password_hasher, HashingBusy
+from eventhub.encoding import mason_response
+from jsonschema import ValidationError
 
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
 
@@ -22,8 +24,7 @@ MASON = "application/vnd.mason+json"
 class UserItem(Resource):
     # Resource class for single user
 
-    api = Api(current_app)
-
+    @cached("user")
     def get(self, id):
         """
         get information for one user
@@ -31,11 +32,11 @@ class UserItem(Resource):
             - id: Integer, id of user
         Response:
             - 404: create_error_response and message "User not found" "User ID {} not found."
+            - 304: the representation in If-None-Match is still current
             - 200: Return the user's information (a Mason document).
         """
         
         #id = int(id)
-        api = Api(current_app)
         #User.query.all()
         user_db = User.query.filter_by(id=id).first()
         #print(user_db)
@@ -44,7 +45,12 @@ class UserItem(Resource):
             return create_error_response(404, "User not found",
                                          "User ID {} was not found".format(id)
                                          )
-                                        
+        # the modification time tells apart a row that got the id of a deleted one
+        etag = make_etag("user", user_db.id, user_db.version, user_db.modified)
+        response = not_modified(etag, user_db.modified)
+        if response is not None:
+            return response
+
         body = InventoryBuilder(
             name=user_db.name,
             email=user_db.email,
@@ -52,12 +58,14 @@ class UserItem(Resource):
             notifications=user_db.notifications
         )
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserItem, id=id))
+        body.add_control("self", user_href(id))
         body.add_control("profile", USER_PROFILE)
         body.add_control_delete_user(id)
         body.add_control_edit_user(id)
         body.add_control_all_users()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        body.add_control("eventhub:feed", user_href(id) + "feed/", title="Upcoming events")
+        response = mason_response(body)
+        return set_validators(response, etag, user_db.modified)
 
 
     def put(self, id):
@@ -75,34 +83,38 @@ class UserItem(Resource):
             - 400: create_user_error_response and message "Invalid JSON document"
             - 404: create_user_error_response and message "User not found" "User ID {} not found."
             - 409: create_user_error_response and message "Already exists","The email address {} is already in use."
+            - 503: create_user_error_response and message "Service unavailable" when too many passwords wait to be hashed
             - 204: success to edit
         """
-        api = Api(current_app)
         #print(request.json)
         if not request.json:
             return create_error_response(415, "Unsupported media type",
                                          "Requests must be JSON"
                                          )
         try:
-            validate(request.json, InventoryBuilder.user_schema())
+            USER_VALIDATOR.validate(request.json)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        password = request.json["password"]
+        user_db = User.query.filter_by(id=id).first()
+        if user_db is None:
+            return create_error_response(404, "User not found",
+                                         "User ID {} was not found".format(id)
+                                         )
+
+        try:
+            pwdhash = self.password_hash(user_db, request.json["password"])
+        except HashingBusy as e:
+            return create_error_response(503, "Service unavailable", str(e))
+
         user = User(
             name=request.json["name"],
             email=request.json["email"],
-            pwdhash=hash_password(password),
+            pwdhash=pwdhash,
             location=request.json["location"],
             notifications=request.json["notifications"]
         )
 
-        user_db = User.query.filter_by(id=id).first()
-        if user_db is None:
-            return create_error_response(404, "User not found",
-                                         "User ID {} was not found".format(id)
-                                         )
-
         try:        
             user_db.name = user.name
             user_db.email = user.email
@@ -112,12 +124,80 @@ class UserItem(Resource):
             db.session.commit()
 
         except IntegrityError:
+            db.session.rollback()
             return create_error_response(409, "Already exists",
                                                "The user already exists.")
         
 
         return Response(status=204)
 
+    def patch(self, id):
+        """
+        modify some of the information of a user, the fields that are not in
+        the request are left as they are
+        Parameters:
+            - id: Integer, id of user
+            - name: String, name of user (optional)
+            - email: String, email of user (optional)
+            - password: String, password of user (optional)
+            - location: String, location of user (optional)
+            - notifications: Integer, whether the user choose to receive notifications or not (optional)
+        Response:
+            - 415: create_error_response and message "Unsupported media type Requests must be JSON"
+            - 400: create_error_response and message "Invalid JSON document"
+            - 404: create_error_response and message "User not found" "User ID {} not found."
+            - 409: create_error_response and message "Already exists","The user already exists."
+            - 503: create_error_response and message "Service unavailable" when too many passwords wait to be hashed
+            - 204: success to edit
+        """
+        if not request.is_json:
+            return create_error_response(415, "Unsupported media type",
+                                         "Requests must be JSON"
+                                         )
+        try:
+            USER_PATCH_VALIDATOR.validate(request.json)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        user_db = User.query.filter_by(id=id).first()
+        if user_db is None:
+            return create_error_response(404, "User not found",
+                                         "User ID {} was not found".format(id)
+                                         )
+
+        if "password" in request.json:
+            try:
+                user_db.pwdhash = self.password_hash(user_db, request.json["password"])
+            except HashingBusy as e:
+                return create_error_response(503, "Service unavailable", str(e))
+        for field in ("name", "email", "location", "notifications"):
+            if field in request.json:
+                setattr(user_db, field, request.json[field])
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return create_error_response(409, "Already exists",
+                                               "The user already exists.")
+
+        return Response(status=204)
+
+    @staticmethod
+    def password_hash(user_db, password):
+        """
+        Returns the hash to store for a password. An unchanged password keeps
+        its old hash, so it's checked against the stored one before hashing.
+        Raises HashingBusy if the hashing queue is full.
+        Parameters:
+            - user_db: User, the user being edited
+            - password: String, the password from the request
+        """
+        hasher = get_password_hasher()
+        if hasher.verify(user_db.pwdhash, password):
+            return user_db.pwdhash
+        return hasher.hash(password)
+
     def delete(self, id):
         """
         delete user's informtation
@@ -128,7 +208,6 @@ class UserItem(Resource):
             - 204: delete successfully
         """
        
-        api = Api(current_app)
         user_db = User.query.filter_by(id=id).first()
 
 
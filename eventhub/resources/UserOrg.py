@@ -1,16 +1,16 @@
-from flask_restful import Resource, Api
+from flask_restful import Resource
 
 
 from sqlalchemy.exc import IntegrityError
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask, request, abort, Response, current_app
-from .UserItem import UserItem
-from eventhub.models import User, OrgsAndUsers,Organization
-from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response
-import json
+from eventhub.models import User, OrgsAndUsers,Organization, missing_users, add_users, remove_users
+from eventhub.cache import mark_changed
+from eventhub.utils import InventoryBuilder, MasonBuilder, create_error_response, compact_requested, statement_budget, user_href, org_href, \
+    USER_IDS_VALIDATOR, USER_FIELDS, get_fields
 from eventhub import db
+from eventhub.encoding import mason_response
 from jsonschema import validate, ValidationError
-from .OrgItem import OrgItem
 
 import sys
 
@@ -27,101 +27,187 @@ MASON = "application/vnd.mason+json"
 
 class OrgsByUser(Resource):
     
+    @statement_budget(1)
     def get(self, user_id):
         """
         Get all the assotiated organization info for a user
         Parameters:
             - id: Integer, user id
+        Query parameters:
+            - compact: "1" for item edit controls that refer to their schema
+              with schemaUrl (same as a compact=1 parameter on the Mason
+              media type in Accept)
         Response:
             - 404: "User not found", "User ID {} was not found"
             - 200: Return the events information
         """
-        api = Api(current_app)
+        compact = compact_requested()
         body = InventoryBuilder(items=[])
-        user = User.query.filter_by(id=user_id).first()
-        if user is None:
+        # the user and the organizations in one query, a user without
+        # organizations gives one row with the organization columns as NULL
+        rows = db.session.query(
+            User.name.label("user_name"), Organization.id, Organization.name,
+            Organization.member_count
+        ).outerjoin(OrgsAndUsers, OrgsAndUsers.user_id == User.id) \
+         .outerjoin(Organization, Organization.id == OrgsAndUsers.org_id) \
+         .filter(User.id == user_id).order_by(Organization.id).all()
+        if not rows:
             return create_error_response(404, "Not found",
                                         "User ID {} was not found".format(user_id))
-        body["user"] = {"name":user.name}
+        body["user"] = {"name":rows[0].user_name}
 
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(UserItem, id=user_id))
+        body.add_control("self", user_href(user_id))
         body.add_control("profile", USER_PROFILE)
         body.add_control_delete_user(user_id)
         body.add_control_edit_user(user_id)
         body.add_control_all_users()
         
-        # find all the organizations
-        # orgs= db.session.query(User.related_orgs).filter_by(id=user_id).all()
-        # orgs = User.query.with_entities(User.related_orgs).all()
-        # orgs = associations.organization.query.filter_by(user=user_id).all()
-        """
-        users_dt = User.query.filter_by(id=user_id).first()
-        orgs = users_dt.related_orgs
-        """
-        orgs = Organization.query.filter(Organization.users2.any(user_id=user_id)).all()
-        # orgs = db.session.query(orgs_info.id)
         # for each organization, find specific information
-        for i in orgs:
+        for i in rows:
+            if i.id is None:
+                continue
             org = InventoryBuilder()
             #org_dt = Organization.query.filter_by(id=i).first()
             org["name"]= i.name
+            org["member_count"] = i.member_count
             #org["name"] = organization.name
             org.add_namespace("eventhub", LINK_RELATIONS_URL)
-            org.add_control("self", api.url_for(OrgItem, id=i.id))
+            org.add_control("self", org_href(i.id))
             org.add_control("profile", ORG_PROFILE)
             org.add_control_delete_org(i.id)
-            org.add_control_edit_org(i.id)
+            org.add_control_edit_org(i.id, compact)
             org.add_control_all_orgs()
             body["items"].append(org)  
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
 
 
 class UsersOfOrg(Resource):
+    @statement_budget(1)
     def get(self, org_id):
         """
         Get all the users' email of an organization
         Parameters:
             - id: Integer, organization id
+        Query parameters:
+            - compact: "1" for item edit controls that refer to their schema
+              with schemaUrl (same as a compact=1 parameter on the Mason
+              media type in Accept)
+            - fields: comma separated fields of the users to include, only
+              those columns are read (default: all of USER_FIELDS)
         Response:
+            - 400: create_error_response and alert "Invalid query parameter"
             - 404: "Organization not found", "Organization ID {} was not found"
             - 200: Return the users' email addresses
         """
-        api = Api(current_app)
+        try:
+            fields = get_fields(USER_FIELDS)
+        except ValueError as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+        compact = compact_requested()
         body = InventoryBuilder(items=[])
-        org = Organization.query.filter_by(id=org_id).first()
-        if org is None:
+        # the organization and its users in one query, an organization
+        # without users gives one row with the user columns as NULL
+        rows = db.session.query(
+            Organization.id.label("org_id"), Organization.name.label("org_name"),
+            User.id, *(getattr(User, field) for field in fields)
+        ).outerjoin(OrgsAndUsers, OrgsAndUsers.org_id == Organization.id) \
+         .outerjoin(User, User.id == OrgsAndUsers.user_id) \
+         .filter(Organization.id == org_id).order_by(User.id).all()
+        if not rows:
             return create_error_response(404, "Organization not found",
                                         "Organization ID {} was not found".format(org_id))
-        body["organization"] = {"org_id":org.id,"name":org.name}
+        body["organization"] = {"org_id":rows[0].org_id,"name":rows[0].org_name}
 
         body.add_namespace("eventhub", LINK_RELATIONS_URL)
-        body.add_control("self", api.url_for(OrgItem, id=org_id))
+        body.add_control("self", org_href(org_id))
         body.add_control("profile", ORG_PROFILE)
         body.add_control_delete_org(org_id)
         body.add_control_edit_org(org_id)
         body.add_control_all_orgs()
+        body.add_control_add_users(request.path)
+        body.add_control_remove_users(request.path)
         
-        # find all the users
-        #users= db.session.query(Organization.users2).filter_by(id=org_id).all()
-        related_users = User.query.filter(User.orgs.any(org_id=org.id)).all()
         # for each user, find the id and email
-        for i in related_users:
+        for i in rows:
+            if i.id is None:
+                continue
             user = InventoryBuilder()
-            # user details
-            user["name"] = i.name
-            user["email"] = i.email
-            user["pwdhash"] = i.pwdhash
-            user["location"] = i.location
-            user["notifications"] = i.notifications
+            for field in fields:
+                user[field] = getattr(i, field)
 
             user.add_namespace("eventhub", LINK_RELATIONS_URL)
-            user.add_control("self", api.url_for(UserItem, id=i.id))
+            user.add_control("self", user_href(i.id))
             user.add_control("profile", USER_PROFILE)
-            user.add_control_delete_user(i)
-            user.add_control_edit_user(i)
+            user.add_control_delete_user(i.id)
+            user.add_control_edit_user(i.id, compact)
             user.add_control_all_users()
             body["items"].append(user)  
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body)
+
+    def post(self, org_id):
+        """
+        add members to an organization
+        Parameters:
+            - org_id: Integer, organization id
+            - users: list of Integer, ids of the users
+        Response:
+            - 415: "Unsupported media type" "Requests must be JSON"
+            - 400: "Invalid JSON document"
+            - 404: "Organization not found" or "Users not found" with the unknown ids,
+              nothing is added then
+            - 204: the users are members, also if some already were
+        """
+        return self.change_users(org_id, add=True)
+
+    def delete(self, org_id):
+        """
+        remove members from an organization
+        Parameters:
+            - org_id: Integer, organization id
+            - users: list of Integer, ids of the users
+        Response:
+            - 415: "Unsupported media type" "Requests must be JSON"
+            - 400: "Invalid JSON document"
+            - 404: "Organization not found"
+            - 204: the users aren't members anymore
+        """
+        return self.change_users(org_id, add=False)
+
+    @staticmethod
+    def change_users(org_id, add):
+        """
+        Adds or removes the users of the request body with one set-based
+        statement, however many users there are
+        """
+        if not request.is_json:
+            return create_error_response(415, "Unsupported media type",
+                                         "Requests must be JSON")
+        try:
+            USER_IDS_VALIDATOR.validate(request.json)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        owner = db.session.query(Organization.id).filter(Organization.id == org_id).scalar()
+        if owner is None:
+            return create_error_response(404, "Organization not found",
+                                        "Organization ID {} was not found".format(org_id))
+        user_ids = request.json["users"]
+        if add:
+            missing = missing_users(user_ids)
+            if missing:
+                return create_error_response(404, "Users not found",
+                                             "No users were found with the ids {}".format(missing))
+            add_users(OrgsAndUsers, "org_id", owner, user_ids)
+        else:
+            remove_users(OrgsAndUsers, "org_id", owner, user_ids)
+        mark_changed(db.session, OrgsAndUsers.__tablename__)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a user was deleted meanwhile
+            db.session.rollback()
+            return create_error_response(409, "Conflict", "The users changed, try again")
+        return Response(status=204)
         
\ No newline at end of file
@@ -3,6 +3,7 @@
 const DEBUG = true;
 const MASONJSON = "application/vnd.mason+json";
 const PLAINJSON = "application/json";
+const PICKER_FORMAT = "MM/DD/YYYY h:mm A"; // format of the date pickers of the forms
 
 function renderError(jqxhr) {
     // Display error messages
@@ -43,7 +44,7 @@ $(document).ready(function() {
         let data = {};
         let form = $("form[name='postEventForm']");
         data.name = $("input[name='eventName']").val();
-        data.time = $("input[name='eventTime']").val();
+        data.time = moment($("input[name='eventTime']").val(), PICKER_FORMAT).toISOString(); // the API takes ISO-8601
         data.description = $("textarea[name='eventDesc']").val();
         data.location = $("input[name='eventLocation']").val();
         data.organization = parseInt($("select[name='eventOrg']").val());
@@ -109,7 +110,7 @@ function eventCard(eventItem) {
     return "<div class='card mt-4'>"
               + "<div class='card-body'>"
                 + "<h5 class='card-title'>"+ eventItem.name +"</h5>"
-                + "<h6 class='card-subtitle mb-4 text-muted'>"+ eventItem.time +"</h6>"
+                + "<h6 class='card-subtitle mb-4 text-muted'>"+ moment(eventItem.time).format(PICKER_FORMAT) +"</h6>"
                 + "<p class='card-text'>"+ eventItem.description +"</p>"
                 + "<p class='card-text'><span class='text-muted'>Location:</span> "+ eventItem.location +"</p>"
                 + "<p class='card-text mb-4 text-muted'>Organizer: <a href='#'>"+ eventItem.organization +"</a></p>"
@@ -137,7 +138,7 @@ function deleteEvent(href) {
 function editEventForm(body) {
     $("#updateEventTitle").val(body.name);
     $("#updateEventDesc").val(body.description);
-    $("#updateEventTimeInput").val(body.time);
+    $("#updateEventTimeInput").val(moment(body.time).format(PICKER_FORMAT));
     $("#updateEventLocation").val(body.location);
     $("#updateEventOrganization").val(body.organization);
     $("#deleteEventBtn").attr("onclick", "deleteEvent(\"" + body["@controls"].self.href + "\")");
@@ -150,7 +151,7 @@ $(document).ready(function() {
         let data = {};
         let form = $("form[name='editEventForm']");
         data.name = $("input[name='updateEventTitle']").val();
-        data.time = $("input[name='updateEventTime']").val();
+        data.time = moment($("input[name='updateEventTime']").val(), PICKER_FORMAT).toISOString();
         data.description = $("textarea[name='updateEventDesc']").val();
         data.location = $("input[name='updateEventLocation']").val();
         data.organization = parseInt($("select[name='updateEventOrg']").val());
@@ -202,6 +203,10 @@ function listEvents(body) {
     body.event_list.forEach(function (eventItem) {
         $("#event-list").prepend(eventCard(eventItem));
     });
+    // The event collection is paginated, keep following the next pages
+    if (body["@controls"].next) {
+        getResource("http://localhost:5000" + body["@controls"].next.href, listEvents);
+    }
 }
 
 $(document).ready(function() {
@@ -1,9 +1,22 @@
-from flask import Flask, request, abort, Response, current_app
-from flask_restful import Api
+from flask import request, Response, current_app, g, has_app_context, _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.http import parse_options_header
+from jsonschema import Draft7Validator
+from urllib.parse import urlencode, quote
 import json
+import re
 import hashlib
+import hmac
 import os
 import binascii
+import base64
+import copy
+import functools
+import operator
+import zlib
+from datetime import datetime, timezone
+from eventhub.encoding import mason_response, json_encoder
 
 
 def hash_password(password):
@@ -12,6 +25,20 @@ def hash_password(password):
     pwdhash = binascii.hexlify(pwdhash)
     return (salt + pwdhash).decode('ascii')
 
+def verify_password(stored, password):
+    """
+    Checks a password against a hash created by hash_password. The first 64
+    characters of the hash are the salt.
+    Parameters:
+    stored: String, the stored hash
+    password: String, the password to check
+    """
+    salt, expected = stored[:64], stored[64:]
+    if len(salt) != 64 or len(expected) != 128:
+        return False
+    pwdhash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt.encode('ascii'), 100000)
+    return hmac.compare_digest(binascii.hexlify(pwdhash).decode('ascii'), expected)
+
 class MasonBuilder(dict):
     """
     The class for Mason objects.
@@ -67,21 +94,532 @@ class MasonBuilder(dict):
 LINK_RELATIONS_URL = "/eventhub/link-relations/"
 USER_PROFILE = "/profiles/user/"
 MASON = "application/vnd.mason+json"
+NDJSON = ("application/x-ndjson", "application/jsonl")
 EVENT_PROFILE = "/profiles/event/"
 ORG_PROFILE = "/profiles/organization"
 
 ERROR_PROFILE = "/profiles/error/"
 
+# URL templates of the item resources, keyed by endpoint name. Filled from
+# the app's URL map the first time each endpoint is used.
+_href_templates = {}
+
+def _href_template(endpoint):
+    """
+    Returns the href of an item resource as a format string with the script
+    root of the current request and a {} for the <id> part of the route.
+    The route of the endpoint is turned into a format string once and
+    cached, which is much cheaper than creating an Api and calling url_for
+    for every item.
+    Parameters:
+    endpoint: String, endpoint name of the item resource
+    """
+    try:
+        template = _href_templates[endpoint]
+    except KeyError:
+        rule = next(current_app.url_map.iter_rules(endpoint)).rule
+        rule = rule.replace("{", "{{").replace("}", "}}")
+        template = re.sub(r"<(?:[^>:]+:)?[^>]+>", "{}", rule)
+        _href_templates[endpoint] = template
+    # the request context is looked up once, going through the request
+    # proxy costs more than the rest of the function
+    context = _request_ctx_stack.top
+    root = context.request.script_root if context is not None else ""
+    return root + template
+
+def _href(endpoint, id):
+    """
+    Builds the href of an item resource
+    Parameters:
+    endpoint: String, endpoint name of the item resource
+    id: the value for the <id> part of the route
+    """
+    if type(id) is not int:
+        id = quote(str(id), safe="")
+    return _href_template(endpoint).format(id)
+
+def event_href(id):
+    """Returns the href of the event with the given id"""
+    return _href("eventitem", id)
+
+def user_href(id):
+    """Returns the href of the user with the given id"""
+    return _href("useritem", id)
+
+def org_href(id):
+    """Returns the href of the organization with the given id"""
+    return _href("orgitem", id)
+
 def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return mason_response(body, status_code)
+
+def make_etag(*parts):
+    """
+    Builds a strong ETag for a representation from the versions of the rows
+    or tables it is made of. The query string and the Accept header select
+    the representation (page, compact, stream) so a digest of them is added.
+    Parameters:
+    parts: the name and the versions of the resource
+    """
+    variant = zlib.crc32(request.query_string + b"\n" +
+                         request.headers.get("Accept", "").encode("utf-8"))
+    return "-".join(str(part) for part in parts) + "-{:08x}".format(variant)
+
+def set_validators(response, etag, modified):
+    """
+    Adds the ETag and Last-Modified headers to a response and asks clients
+    to revalidate it on every use.
+    Parameters:
+    response: the Response
+    etag: String, ETag from make_etag
+    modified: Float, modification time in seconds since the epoch
+    """
+    response.set_etag(etag)
+    response.last_modified = datetime.utcfromtimestamp(int(modified))
+    response.cache_control.no_cache = True
+    return response
+
+def not_modified(etag, modified):
+    """
+    Returns a 304 response if the client already has the current
+    representation according to If-None-Match, or If-Modified-Since when
+    there is no If-None-Match. Returns None otherwise. Call it before loading
+    and serializing the rows.
+    Parameters:
+    etag: String, ETag of the current representation
+    modified: Float, modification time in seconds since the epoch
+    """
+    if request.if_none_match:
+        # weak comparison, compression makes the ETag of a response weak
+        if not request.if_none_match.contains_weak(etag):
+            return None
+    elif request.if_modified_since is None or \
+            datetime.utcfromtimestamp(int(modified)) > request.if_modified_since:
+        return None
+    return set_validators(Response(status=304), etag, modified)
+
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and g.get("statement_count") is not None:
+        g.statement_count += 1
+
+def statement_budget(limit):
+    """
+    Decorator for resource methods that must not run more than limit SQL
+    statements, e.g. to catch N+1 queries. Only checked when the app is in
+    testing mode, where going over the budget raises an AssertionError.
+    Parameters:
+    limit: Integer, the maximum number of statements
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not current_app.testing:
+                return func(*args, **kwargs)
+            if not event.contains(Engine, "before_cursor_execute", _count_statement):
+                event.listen(Engine, "before_cursor_execute", _count_statement)
+            outer = g.get("statement_count")
+            g.statement_count = 0
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                count = g.statement_count
+                g.statement_count = None if outer is None else outer + count
+            assert count <= limit, "{} ran {} SQL statements, the budget is {}".format(
+                func.__qualname__, count, limit)
+            return result
+        return wrapper
+    return decorator
+
+def apply_sqlite_profile(engine, pragmas):
+    """
+    Runs the given PRAGMA statements on every new connection of a SQLite
+    engine. Does nothing for other databases.
+    Parameters:
+    engine: the SQLAlchemy engine
+    pragmas: dict of pragma name to value, applied in order
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(name, value))
+        cursor.close()
+
+def parse_time(value):
+    """
+    Parses an ISO-8601 date or date and time into a naive datetime in UTC,
+    the way times are stored. A time without a UTC offset is taken as UTC.
+    Raises ValueError if the value isn't ISO-8601.
+    Parameters:
+    value: String, e.g. "2020-05-05T18:00:00Z" or "2020-05-05"
+    """
+    if not isinstance(value, str):
+        raise ValueError("time must be an ISO-8601 string")
+    try:
+        # fromisoformat only knows the Z suffix from Python 3.11 on
+        time = datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except ValueError:
+        raise ValueError("'{}' is not an ISO-8601 date and time".format(value))
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+def format_time(time):
+    """
+    Formats a stored UTC datetime as ISO-8601 with the Z suffix
+    """
+    return time.isoformat() + "Z"
+
+def encode_cursor(*keys):
+    """
+    Encodes the sort key of a row into an opaque cursor string that can be
+    passed back in the after/before query parameters.
+    Parameters:
+    keys: the values of the sort key, e.g. the id of the row
+    """
+    keys = [format_time(key) if isinstance(key, datetime) else key for key in keys]
+    raw = json.dumps(keys, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, *types):
+    """
+    Decodes a cursor created by encode_cursor back into a list of key values.
+    Raises ValueError if the cursor is malformed.
+    Parameters:
+    cursor: String, the cursor from the query string
+    types: the expected type of each key value, datetime keys are parsed
+    from their ISO-8601 form
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        keys = json.loads(raw.decode("utf-8"))
+        if isinstance(keys, list) and len(keys) == len(types):
+            keys = [parse_time(key) if key_type is datetime else key
+                    for key, key_type in zip(keys, types)]
+    except (ValueError, binascii.Error):
+        raise ValueError("Malformed cursor '{}'".format(cursor))
+    if not isinstance(keys, list) or len(keys) != len(types) or not all(
+            type(key) is key_type for key, key_type in zip(keys, types)):
+        raise ValueError("Malformed cursor '{}'".format(cursor))
+    return keys
+
+def get_page_limit():
+    """
+    Reads the limit query parameter of a paginated collection. Falls back to
+    PAGE_SIZE from the app config and refuses anything above MAX_PAGE_SIZE.
+    Raises ValueError for invalid values.
+    """
+    limit = request.args.get("limit", current_app.config["PAGE_SIZE"])
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError("limit must be an integer")
+    if limit < 1 or limit > current_app.config["MAX_PAGE_SIZE"]:
+        raise ValueError("limit must be between 1 and {}".format(
+            current_app.config["MAX_PAGE_SIZE"]))
+    return limit
+
+def page_href(param, cursor):
+    """
+    Builds the href of a neighbouring page of the current collection. Keeps
+    the other query parameters (limit etc.) and replaces the cursor.
+    Parameters:
+    param: String, "after" for the next page or "before" for the previous one
+    cursor: String, cursor created by encode_cursor
+    """
+    args = request.args.to_dict()
+    args.pop("after", None)
+    args.pop("before", None)
+    args[param] = cursor
+    return request.path + "?" + urlencode(args)
+
+def representation_requested(name):
+    """
+    Checks if the client asked for an optional representation of a resource,
+    either with name=1 in the query string or with a name=1 parameter on the
+    Mason media type in the Accept header.
+    Parameters:
+    name: String, name of the representation, e.g. "stream"
+    """
+    if request.args.get(name) == "1":
+        return True
+    for value, quality in request.accept_mimetypes:
+        mimetype, params = parse_options_header(value)
+        if mimetype == MASON and params.get(name) == "1" and quality > 0:
+            return True
+    return False
+
+def stream_requested():
+    """
+    Checks if the client asked for a streamed collection
+    """
+    return representation_requested("stream")
+
+def compact_requested():
+    """
+    Checks if the client asked for compact item controls that refer to the
+    schemas with schemaUrl instead of including them
+    """
+    return representation_requested("compact")
+
+# the fields of a user in the user listings, in the order they are shown
+USER_FIELDS = ("name", "email", "pwdhash", "location", "notifications")
+
+def get_fields(available):
+    """
+    Reads the fields query parameter of a sparse fieldset, a comma separated
+    list of the fields the items of a listing should have. Returns the
+    requested fields in the order of available, or all of them without the
+    parameter. Raises ValueError for unknown fields.
+    Parameters:
+    available: the names of the fields of an item
+    """
+    fields = request.args.get("fields")
+    if fields is None:
+        return list(available)
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested.difference(available)
+    if unknown:
+        raise ValueError("Unknown fields {}, the fields are {}".format(
+            ", ".join(sorted(unknown)), ", ".join(available)))
+    return [field for field in available if field in requested]
+
+def read_ndjson(stream):
+    """
+    Yields the documents of an NDJSON stream, or a ValueError with the
+    message for lines that are not JSON. Blank lines are skipped.
+    Parameters:
+    stream: file-like object of bytes or text, e.g. request.stream
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError("Invalid JSON: {}".format(e))
+
+def stream_mason(body, list_key, items):
+    """
+    Generates a Mason document piece by piece so that a collection can be
+    sent as a chunked response without building it in memory. The output is
+    the same as dump_json of the body with the items in front.
+    Parameters:
+    body: MasonBuilder, the document without its item list
+    list_key: String, name of the item list in the document
+    items: iterable of MasonBuilders, encoded one at a time
+    """
+    chunk_size = current_app.config["STREAM_CHUNK_SIZE"]
+    encode = json_encoder()
+    chunk = [b"{" + encode(list_key) + b":["]
+    size = 0
+    separator = b""
+    for item in items:
+        encoded = separator + encode(item)
+        separator = b","
+        chunk.append(encoded)
+        size += len(encoded)
+        if size >= chunk_size:
+            yield b"".join(chunk)
+            chunk = []
+            size = 0
+    if body:
+        chunk.append(b"]," + encode(body)[1:])
+    else:
+        chunk.append(b"]}")
+    yield b"".join(chunk)
+
+class FrozenDict(dict):
+    """
+    A dict that can't be modified. The schemas are built once and shared by
+    every control and validator, so they must not be changed by anyone.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("FrozenDict can't be modified")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+class FrozenList(list):
+    """
+    A list that can't be modified, the list counterpart of FrozenDict
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("FrozenList can't be modified")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = remove = pop = clear = sort = reverse = _read_only
+
+def freeze(obj):
+    """
+    Returns a read-only deep copy of a JSON document. The copy is still a
+    dict (or list) for the JSON encoders and jsonschema.
+    """
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return FrozenList(freeze(value) for value in obj)
+    return obj
+
+class ItemLayout(object):
+    """
+    The layout of the list items of a collection: the fields read from the
+    rows, in document order, and the self and profile controls. The profile
+    control is one frozen dict shared by every item.
+    Parameters:
+    fields: sequence of field names, attributes of the rows
+    endpoint: String, endpoint name of the item resource of the rows
+    profile: String, href of the profile of the items
+    convert: dict of functions from a field value to its JSON value, by
+             field name
+    """
+
+    def __init__(self, fields, endpoint, profile, convert=None):
+        self.fields = tuple(fields)
+        self.endpoint = endpoint
+        self.profile = FrozenDict(href=profile)
+        self.convert = tuple((convert or {}).items())
+        self._values = operator.attrgetter(*self.fields, "id")
+        self._href = functools.partial(_href, endpoint)
+
+    def items(self, rows):
+        """
+        Generates the list items of rows. The href template of the items is
+        resolved once for all of them, so the rows must have integer ids.
+        """
+        layout = copy.copy(self)
+        layout._href = _href_template(self.endpoint).format
+        for row in rows:
+            yield MasonItem(layout, row)
+
+    def item(self, row):
+        """
+        Returns the list item of a row
+        """
+        return MasonItem(self, row)
+
+    def document(self, row):
+        """
+        Builds the Mason document of a row, the same as a MasonBuilder with
+        the fields and the self and profile controls
+        """
+        values = self._values(row)
+        document = dict(zip(self.fields, values))
+        for field, convert in self.convert:
+            document[field] = convert(document[field])
+        document["@controls"] = {"self": {"href": self._href(values[-1])}, "profile": self.profile}
+        return document
+
+class MasonItem(object):
+    """
+    A list item of a collection, kept as its row and the layout of the
+    collection until the response is encoded. The JSON encoders build its
+    document when they reach it and drop it right away, so a collection
+    holds one small object per row instead of a dict tree per item.
+    """
+    __slots__ = ("layout", "row")
+
+    def __init__(self, layout, row):
+        self.layout = layout
+        self.row = row
+
+    def mason_document(self):
+        return self.layout.document(self.row)
+
+def frozen_schema(build):
+    """
+    Decorator for the schema methods of InventoryBuilder. The schema is built
+    and checked against the metaschema once when the class is created, and
+    every call returns the same frozen copy.
+    """
+    schema = build()
+    Draft7Validator.check_schema(schema)
+    schema = freeze(schema)
+    return lambda: schema
+
+class FlatSchemaValidator(object):
+    """
+    Validator for the flat object schemas of the API. Valid documents only
+    need a few type checks, which is much cheaper than running the full
+    jsonschema validator. Anything the fast path doesn't accept is handed to
+    the full validator, so the result and the error messages are the same.
+    """
+
+    TYPES = {
+        "string": (str,),
+        "number": (int, float),
+        "integer": (int,),
+        "boolean": (bool,),
+        "null": (type(None),),
+    }
+
+    def __init__(self, schema):
+        self.validator = Draft7Validator(schema)
+        self.required = tuple(schema.get("required", ()))
+        self.types = {
+            name: self.TYPES[prop["type"]]
+            for name, prop in schema.get("properties", {}).items()
+        }
+
+    @classmethod
+    def supports(cls, schema):
+        """
+        Checks that the schema only uses the keywords the fast path checks
+        """
+        if set(schema) - {"type", "required", "properties"} or schema.get("type") != "object":
+            return False
+        for prop in schema.get("properties", {}).values():
+            # format is only an annotation, Draft7Validator doesn't check
+            # it without a format checker either
+            if set(prop) - {"type", "description", "format"}:
+                return False
+            if not isinstance(prop.get("type"), str) or prop["type"] not in cls.TYPES:
+                return False
+        return True
+
+    def is_valid_fast(self, instance):
+        if type(instance) is not dict:
+            return False
+        for name in self.required:
+            if name not in instance:
+                return False
+        for name, value in instance.items():
+            # exact type check, bool is an int in Python but not a JSON number
+            types = self.types.get(name)
+            if types is not None and type(value) not in types:
+                return False
+        return True
+
+    def validate(self, instance):
+        """
+        Raises jsonschema.ValidationError if the instance is not valid
+        """
+        if not self.is_valid_fast(instance):
+            self.validator.validate(instance)
+
+def compile_validator(schema, fast=True):
+    """
+    Creates a reusable validator for a schema. Uses FlatSchemaValidator when
+    fast is set and the schema is simple enough, else the jsonschema one.
+    Both have a validate method that raises jsonschema.ValidationError.
+    """
+    if fast and FlatSchemaValidator.supports(schema):
+        return FlatSchemaValidator(schema)
+    return Draft7Validator(schema)
 
 class InventoryBuilder(MasonBuilder):
     
     @staticmethod
+    @frozen_schema
     def event_schema():
         schema = {
             "type": "object",
@@ -100,8 +638,9 @@ class InventoryBuilder(MasonBuilder):
             "type": "string"
         }
         props["time"] = {
-            "description": "time of the event",
-            "type": "string"
+            "description": "time of the event, ISO-8601 (UTC unless it has an offset)",
+            "type": "string",
+            "format": "date-time"
         }
         props["description"] = {
             "description": "description of the event",
@@ -123,6 +662,7 @@ class InventoryBuilder(MasonBuilder):
         return schema
 
     @staticmethod
+    @frozen_schema
     def user_schema():
         schema = {
             "type": "object",
@@ -160,6 +700,7 @@ class InventoryBuilder(MasonBuilder):
     
 
     @staticmethod
+    @frozen_schema
     def org_schema():
         schema = {
             "type": "object",
@@ -179,132 +720,153 @@ class InventoryBuilder(MasonBuilder):
         }
         return schema
 
+    @staticmethod
+    @frozen_schema
+    def user_ids_schema():
+        schema = {
+            "type": "object",
+            "required": ["users"]
+        }
+        props = schema["properties"] = {}
+        props["users"] = {
+            "description": "ids of the users",
+            "type": "array",
+            "items": {"type": "integer"}
+        }
+        return schema
+
+    def add_shared_control(self, ctrl_name, control, href=None):
+        """
+        Adds a control that was built once and is shared by all documents.
+        Controls with a fixed href are added as they are, the others are
+        copied with the href added last, the same as add_control does.
+        Parameters:
+        ctrl_name: String, name of the control
+        control: dict, the static part of the control
+        href: String, target URI of the control if it's not in the control
+        """
+        if "@controls" not in self:
+            self["@controls"] = {}
+        if href is not None:
+            control = dict(control, href=href)
+        self["@controls"][ctrl_name] = control
+
     # controls for events
     def add_control_delete_event(self, id):
-        from .resources.EventItem import EventItem
-        api = Api(current_app)
-        self.add_control(
-            "delete",
-            href=api.url_for(EventItem, id=id),
-            method="DELETE",
-            title="Delete this event"
-        )
+        self.add_shared_control("delete", DELETE_EVENT, event_href(id))
 
-    def add_control_edit_event(self, id):
-        from .resources.EventItem import EventItem
-        api = Api(current_app)
-        self.add_control(
-            "edit",
-            href=api.url_for(EventItem, id=id),
-            method="Put",
-            encoding="json",
-            title="Edit a event",
-            schema=self.event_schema()
-        )
+    def add_control_edit_event(self, id, compact=False):
+        self.add_shared_control("edit", EDIT_EVENT_COMPACT if compact else EDIT_EVENT,
+                                event_href(id))
 
     def add_control_add_event(self):
+        self.add_shared_control("create-event", ADD_EVENT)
 
+    def add_control_all_events(self):
+        self.add_shared_control("events-all", ALL_EVENTS)
+
+    # controls for paginated collections
+    def add_control_next_page(self, cursor):
         self.add_control(
-            "create-event",
-            "/api/events/",
-            method="POST",
-            encoding="json",
-            title="Create event",
-            schema=self.event_schema()
+            "next",
+            page_href("after", cursor),
+            method="GET",
+            title="Next page"
         )
 
-    def add_control_all_events(self):
+    def add_control_prev_page(self, cursor):
         self.add_control(
-            "events-all",
-            "/api/events/",
+            "prev",
+            page_href("before", cursor),
             method="GET",
-            title="Get all events"
+            title="Previous page"
         )
     
     # controls for users
     def add_control_delete_user(self, id):
-        from .resources.UserItem import UserItem
-        api = Api(current_app)
-        self.add_control(
-            "delete",
-            href=api.url_for(UserItem, id=id),
-            method="DELETE",
-            title="Delete this user"
-        )
-
-    def add_control_edit_user(self, id):
-        from .resources.UserItem import UserItem
+        self.add_shared_control("delete", DELETE_USER, user_href(id))
 
-        api = Api(current_app)
-
-        self.add_control(
-            "edit",
-            href=api.url_for(UserItem, id=id),
-            method="Put",
-            encoding="json",
-            title="Edit a user",
-            schema=self.user_schema()
-        )
+    def add_control_edit_user(self, id, compact=False):
+        self.add_shared_control("edit", EDIT_USER_COMPACT if compact else EDIT_USER,
+                                user_href(id))
     
     def add_control_add_user(self):
-
-        self.add_control(
-            "create-user",
-            "/api/users/",
-            method="POST",
-            encoding="json",
-            title="Add a new user",
-            schema=self.event_schema()
-        )
+        self.add_shared_control("create-user", ADD_USER)
 
     def add_control_all_users(self):
-        self.add_control(
-            "users-all",
-            "/api/users/",
-            method="GET",
-            title="get all users"
-        )
+        self.add_shared_control("users-all", ALL_USERS)
 
     # controls for organizations
     def add_control_delete_org(self, id):
-        from .resources.OrgItem import OrgItem
-        api = Api(current_app)
-        self.add_control(
-            "delete",
-            href=api.url_for(OrgItem, id=id),
-            method="DELETE",
-            title="Delete this organization"
-        )
+        self.add_shared_control("delete", DELETE_ORG, org_href(id))
 
-    def add_control_edit_org(self, id):
-        from .resources.OrgItem import OrgItem
-
-        api = Api(current_app)
-
-        self.add_control(
-            "edit",
-            href=api.url_for(OrgItem, id=id),
-            method="Put",
-            encoding="json",
-            title="Edit an organization",
-            schema=self.org_schema()
-        )
+    def add_control_edit_org(self, id, compact=False):
+        self.add_shared_control("edit", EDIT_ORG_COMPACT if compact else EDIT_ORG,
+                                org_href(id))
     
     def add_control_add_org(self):
-
-        self.add_control(
-            "create-organization",
-            "/api/organizations/",
-            method="POST",
-            encoding="json",
-            title="Add a new organization",
-            schema=self.org_schema()
-        )
+        self.add_shared_control("create-organization", ADD_ORG)
 
     def add_control_all_orgs(self):
-        self.add_control(
-            "orgs-all",
-            "/api/orgs/",
-            method="GET",
-            title="get all organizations"
-        )
\ No newline at end of file
+        self.add_shared_control("orgs-all", ALL_ORGS)
+
+    def add_control_add_users(self, href):
+        self.add_shared_control("eventhub:add-users", ADD_USERS, href)
+
+    def add_control_remove_users(self, href):
+        self.add_shared_control("eventhub:remove-users", REMOVE_USERS, href)
+
+# The schemas by name, served from /schemas/<name>/ for the compact controls
+SCHEMAS = {
+    "event": InventoryBuilder.event_schema(),
+    "user": InventoryBuilder.user_schema(),
+    "org": InventoryBuilder.org_schema(),
+    "user-ids": InventoryBuilder.user_ids_schema(),
+}
+SCHEMA_URL = "/schemas/{}/"
+
+# Static parts of the controls, built once and shared by every document.
+# The compact edit controls refer to the schema with schemaUrl instead of
+# including it.
+DELETE_EVENT = FrozenDict(method="DELETE", title="Delete this event")
+EDIT_EVENT = FrozenDict(method="Put", encoding="json", title="Edit a event",
+                        schema=SCHEMAS["event"])
+EDIT_EVENT_COMPACT = FrozenDict(method="Put", encoding="json", title="Edit a event",
+                                schemaUrl=SCHEMA_URL.format("event"))
+ADD_EVENT = FrozenDict(method="POST", encoding="json", title="Create event",
+                       schema=SCHEMAS["event"], href="/api/events/")
+ALL_EVENTS = FrozenDict(method="GET", title="Get all events", href="/api/events/")
+
+DELETE_USER = FrozenDict(method="DELETE", title="Delete this user")
+EDIT_USER = FrozenDict(method="Put", encoding="json", title="Edit a user",
+                       schema=SCHEMAS["user"])
+EDIT_USER_COMPACT = FrozenDict(method="Put", encoding="json", title="Edit a user",
+                               schemaUrl=SCHEMA_URL.format("user"))
+ADD_USER = FrozenDict(method="POST", encoding="json", title="Add a new user",
+                      schema=SCHEMAS["user"], href="/api/users/")
+ALL_USERS = FrozenDict(method="GET", title="get all users", href="/api/users/")
+
+DELETE_ORG = FrozenDict(method="DELETE", title="Delete this organization")
+EDIT_ORG = FrozenDict(method="Put", encoding="json", title="Edit an organization",
+                      schema=SCHEMAS["org"])
+EDIT_ORG_COMPACT = FrozenDict(method="Put", encoding="json", title="Edit an organization",
+                              schemaUrl=SCHEMA_URL.format("org"))
+ADD_ORG = FrozenDict(method="POST", encoding="json", title="Add a new organization",
+                     schema=SCHEMAS["org"], href="/api/orgs/")
+ALL_ORGS = FrozenDict(method="GET", title="get all organizations", href="/api/orgs/")
+
+ADD_USERS = FrozenDict(method="POST", encoding="json", title="Add users",
+                       schemaUrl=SCHEMA_URL.format("user-ids"))
+REMOVE_USERS = FrozenDict(method="DELETE", encoding="json", title="Remove users",
+                          schemaUrl=SCHEMA_URL.format("user-ids"))
+
+# validators for the request documents, compiled once at startup
+EVENT_VALIDATOR = compile_validator(InventoryBuilder.event_schema())
+USER_VALIDATOR = compile_validator(InventoryBuilder.user_schema())
+ORG_VALIDATOR = compile_validator(InventoryBuilder.org_schema())
+USER_IDS_VALIDATOR = compile_validator(InventoryBuilder.user_ids_schema())
+# partial updates of users accept any subset of the properties
+USER_PATCH_VALIDATOR = compile_validator(freeze({
+    "type": "object",
+    "properties": InventoryBuilder.user_schema()["properties"]
+}))
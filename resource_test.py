@@ -1,3 +1,4 @@
+import gzip
 import json
 import os
 import pytest
@@ -5,8 +6,11 @@ import sys
 import tempfile
 from datetime import datetime
 from jsonschema import validate
-from eventhub import app, db
+from eventhub import app, db, create_app
 from eventhub.models import Event, User, Organization, EventsAndUsers, OrgsAndUsers
+from eventhub.hashing import PasswordHasher
+from eventhub.cache import CacheBackend, MemoryBackend, SQLiteBackend
+from eventhub.utils import verify_password, statement_budget, MasonBuilder, format_time
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
@@ -47,7 +51,7 @@ def _populate_db():
     
     event = Event(
         name="Test event",
-        time="2020-02-02",
+        time=datetime(2020, 2, 2),
         description="Something",
         location="Oulu",
         organization=1
@@ -152,7 +156,7 @@ def _check_control_post_method(ctrl, client, obj):
 def _get_event():
     event_dict = {
         "name": "Karaoke",
-        "time": "9:23",
+        "time": "2020-05-05T09:23:00Z",
         "description": "Something",
         "location": "Routa, Oulu",
         "organization": 1
@@ -193,6 +197,128 @@ class TestEventCollection(object):
             assert "name" in item
             assert "description" in item
 
+    def test_get_pages(self, client):
+        for i in range(4):
+            valid = _get_event()
+            valid["name"] = "Event {}".format(i)
+            client.post(self.RESOURCE_URL, json=valid)
+
+        # walk forward through the pages using the next controls
+        names = []
+        href = self.RESOURCE_URL + "?limit=2"
+        while href:
+            resp = client.get(href)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert len(body["event_list"]) <= 2
+            names += [item["name"] for item in body["event_list"]]
+            last = body
+            href = body["@controls"].get("next", {}).get("href")
+        assert names == ["Test event", "Event 0", "Event 1", "Event 2", "Event 3"]
+
+        # and back again with the prev controls
+        names = []
+        href = last["@controls"]["prev"]["href"]
+        while href:
+            body = json.loads(client.get(href).data)
+            names = [item["name"] for item in body["event_list"]] + names
+            href = body["@controls"].get("prev", {}).get("href")
+        assert names == ["Test event", "Event 0", "Event 1", "Event 2"]
+
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=abc")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=not-a-cursor")
+        assert resp.status_code == 400
+
+    def test_get_filters(self, client):
+        for i, (organization, location) in enumerate([(1, "Oulu"), (2, "Oulu"), (1, "Helsinki"),
+                                                      (1, "Oulu"), (2, "Helsinki")]):
+            valid = _get_event()
+            valid.update(name="Event {}".format(i), organization=organization, location=location,
+                         time="2020-03-0{}T10:00:00".format(5 - i))
+            assert client.post(self.RESOURCE_URL, json=valid).status_code == 201
+
+        def names(query):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 200
+            return [item["name"] for item in json.loads(resp.data)["event_list"]]
+
+        assert names("?organization=2") == ["Event 1", "Event 4"]
+        assert names("?location=Oulu") == ["Test event", "Event 0", "Event 1", "Event 3"]
+        assert names("?organization=1&location=Oulu") == ["Test event", "Event 0", "Event 3"]
+        assert names("?from=2020-03-02&to=2020-03-04") == ["Event 2", "Event 3"]
+        assert names("?sort=time&from=2020-03-01") == ["Event 4", "Event 3", "Event 2", "Event 1",
+                                                    "Event 0"]
+        assert names("?sort=time&organization=1") == ["Test event", "Event 3", "Event 2", "Event 0"]
+
+        # the cursors of filtered pages keep the filters and the order
+        seen = []
+        href = self.RESOURCE_URL + "?sort=time&location=Oulu&limit=1"
+        while href:
+            body = json.loads(client.get(href).data)
+            seen += [item["name"] for item in body["event_list"]]
+            last = body
+            href = body["@controls"].get("next", {}).get("href")
+        assert seen == ["Test event", "Event 3", "Event 1", "Event 0"]
+        body = json.loads(client.get(last["@controls"]["prev"]["href"]).data)
+        assert [item["name"] for item in body["event_list"]] == ["Event 1"]
+
+        resp = client.get(self.RESOURCE_URL + "?sort=time&organization=1&stream=1")
+        assert resp.is_streamed
+        assert [item["name"] for item in json.loads(resp.data)["event_list"]] == \
+            ["Test event", "Event 3", "Event 2", "Event 0"]
+
+        for query in ("?organization=abc", "?sort=name", "?sort=time&after=abc", "?from=soon"):
+            assert client.get(self.RESOURCE_URL + query).status_code == 400
+        # a cursor of the id order doesn't work in the time order
+        id_cursor = json.loads(client.get(self.RESOURCE_URL + "?limit=1").data)["@controls"] \
+            ["next"]["href"].split("after=")[1]
+        assert client.get(self.RESOURCE_URL + "?sort=time&after=" + id_cursor).status_code == 400
+
+    def test_get_stream(self, client):
+        for i in range(3):
+            client.post(self.RESOURCE_URL, json=_get_event())
+        resp = client.get(self.RESOURCE_URL + "?stream=1")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        assert len(body["event_list"]) == 4
+        assert "next" not in body["@controls"]
+        assert body == json.loads(client.get(self.RESOURCE_URL).data)
+
+        resp = client.get(self.RESOURCE_URL,
+                          headers={"Accept": "application/vnd.mason+json; stream=1"})
+        assert resp.is_streamed
+        assert json.loads(resp.data) == body
+
+    def test_get_conditional(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        modified = resp.headers["Last-Modified"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        assert resp.headers["ETag"] == etag
+        resp = client.get(self.RESOURCE_URL, headers={"If-Modified-Since": modified})
+        assert resp.status_code == 304
+
+        # other pages and representations have their own tags
+        resp = client.get(self.RESOURCE_URL + "?stream=1", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+        # any change to the events makes the old tag stale
+        location = client.post(self.RESOURCE_URL, json=_get_event()).headers["Location"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+        etag = resp.headers["ETag"]
+        client.delete(location)
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
     def test_post(self, client):
         valid = _get_event()
 
@@ -211,6 +337,18 @@ class TestEventCollection(object):
         body = json.loads(resp.data)
         assert body["name"] == "Karaoke"
         assert body["description"] == "Something"
+        assert body["time"] == "2020-05-05T09:23:00Z"
+
+        # times are kept in UTC
+        valid["time"] = "2020-05-05T12:23:00+03:00"
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        body = json.loads(client.get(resp.headers["Location"]).data)
+        assert body["time"] == "2020-05-05T09:23:00Z"
+
+        # 400: the time must be ISO-8601
+        valid["time"] = "9:23"
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
 
         # 415: invalid document type, request must be json
         resp = client.post(self.RESOURCE_URL, data=json.dumps(valid))
@@ -221,6 +359,129 @@ class TestEventCollection(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+        # 400: booleans are not numbers in JSON schema
+        valid = _get_event()
+        valid["organization"] = True
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 400
+        body = json.loads(resp.data)
+        assert "is not of type 'number'" in body["@error"]["@messages"][0]
+
+
+class TestEventBatch(object):
+    RESOURCE_URL = "/api/events/batch/"
+
+    def test_post(self, client):
+        client.get("/api/events/")
+        invalid = _get_event()
+        del invalid["name"]
+        unknown_org = _get_event()
+        unknown_org["organization"] = 1000
+        old = app.config["BATCH_CHUNK_SIZE"]
+        app.config["BATCH_CHUNK_SIZE"] = 2
+        try:
+            resp = client.post(self.RESOURCE_URL,
+                               json=[_get_event(), invalid, _get_event(), unknown_org, _get_event()])
+        finally:
+            app.config["BATCH_CHUNK_SIZE"] = old
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["created"] == 3
+        assert body["failed"] == 2
+        statuses = [item["status"] for item in body["items"]]
+        assert statuses == [201, 400, 201, 409, 201]
+        assert [item["index"] for item in body["items"]] == list(range(5))
+        locations = [item["location"] for item in body["items"] if item["status"] == 201]
+        assert len(set(locations)) == 3
+        for location in locations:
+            resp = client.get(location)
+            assert resp.status_code == 200
+            assert json.loads(resp.data)["name"] == "Karaoke"
+        items = json.loads(client.get("/api/events/").data)["event_list"]
+        hrefs = [item["@controls"]["self"]["href"] for item in items]
+        assert set(locations) <= set(hrefs)
+
+    def test_post_ndjson(self, client):
+        lines = [json.dumps(_get_event()), "", "{not json", json.dumps(_get_event())]
+        resp = client.post(self.RESOURCE_URL, data="\n".join(lines) + "\n",
+                           content_type="application/x-ndjson")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 400, 201]
+        assert body["items"][1]["message"].startswith("Invalid JSON")
+
+    def test_post_invalid(self, client):
+        resp = client.post(self.RESOURCE_URL, data="name=x")
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=_get_event())
+        assert resp.status_code == 400
+
+
+class TestEventSearch(object):
+    RESOURCE_URL = "/api/events/search/"
+
+    def test_get(self, client):
+        for name, description, location in (("Karaoke night", "Sing along", "Oulu"),
+                                             ("Board games", "Karaoke after the games", "Oulu"),
+                                             ("Karaoke", "Karaoke karaoke", "Helsinki")):
+            event = _get_event()
+            event.update(name=name, description=description, location=location)
+            assert client.post("/api/events/", json=event).status_code == 201
+        resp = client.get(self.RESOURCE_URL + "?q=karaoke")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        _check_control_get_method("events-all", client, body)
+        names = [item["name"] for item in body["event_list"]]
+        assert names[-1] == "Board games"
+        assert sorted(names[:2]) == ["Karaoke", "Karaoke night"]
+        for item in body["event_list"]:
+            _check_control_get_method("self", client, item)
+
+        # all words have to match, FTS5 syntax is plain text
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=karaoke+OULU").data)
+        assert sorted(item["name"] for item in body["event_list"]) == ["Board games", "Karaoke night"]
+        body = json.loads(client.get(self.RESOURCE_URL + '?q=sing+NOT+"night*').data)
+        assert body["event_list"] == []
+
+        # pages
+        seen = []
+        href = self.RESOURCE_URL + "?q=karaoke&limit=1"
+        while href:
+            body = json.loads(client.get(href).data)
+            seen += [item["name"] for item in body["event_list"]]
+            href = body["@controls"].get("next", {}).get("href")
+        assert seen == names
+        assert body["truncated"] is False
+
+        # with SEARCH_CANDIDATES only the newest matches are ranked and the
+        # results say that some were left out
+        app.config["SEARCH_CANDIDATES"] = 2
+        try:
+            body = json.loads(client.get(self.RESOURCE_URL + "?q=karaoke&limit=10").data)
+            assert [item["name"] for item in body["event_list"]] == ["Karaoke", "Board games"]
+            assert body["truncated"] is True
+            body = json.loads(client.get(self.RESOURCE_URL + "?q=sing").data)
+            assert body["truncated"] is False
+        finally:
+            app.config["SEARCH_CANDIDATES"] = None
+
+    def test_get_changes(self, client):
+        resp = client.get(self.RESOURCE_URL + "?q=test")
+        assert len(json.loads(resp.data)["event_list"]) == 1
+        event = _get_event()
+        event["name"] = "Renamed"
+        assert client.put("/api/events/1/", json=event).status_code == 204
+        assert json.loads(client.get(self.RESOURCE_URL + "?q=test").data)["event_list"] == []
+        assert len(json.loads(client.get(self.RESOURCE_URL + "?q=renamed").data)["event_list"]) == 1
+        assert client.delete("/api/events/1/").status_code == 204
+        assert json.loads(client.get(self.RESOURCE_URL + "?q=renamed").data)["event_list"] == []
+
+    def test_get_invalid(self, client):
+        for query in ("", "?q=", "?q=%22%2A", "?q=test&limit=0", "?q=test&after=abc"):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
 
 class TestEventItem(object):
     RESOURCE_URL = "/api/events/1/"
@@ -234,7 +495,7 @@ class TestEventItem(object):
         body = json.loads(resp.data)
         assert body["name"] == "Test event"
         assert body["description"] == "Something"
-        assert body["time"] == "2020-02-02"
+        assert body["time"] == "2020-02-02T00:00:00Z"
         assert body["location"] == "Oulu"
         assert body["organization"] == 1
         _check_namespace(client, body)
@@ -247,6 +508,24 @@ class TestEventItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_conditional(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": '"other", ' + etag})
+        assert resp.status_code == 304
+
+        # an edit bumps the version of the row
+        valid = _get_event()
+        valid["name"] = "Edited event"
+        client.put(self.RESOURCE_URL, json=valid)
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["name"] == "Edited event"
+        assert resp.headers["ETag"] != etag
+
     def test_put(self, client):
         """
         Tests the PUT method. Checks all of the possible erroe codes, and also
@@ -309,6 +588,12 @@ class TestOrgCollection():
             _check_control_get_method("profile", client, item)
             assert "name" in item
 
+    def test_get_stream(self, client):
+        resp = client.get(self.RESOURCE_URL + "?stream=1")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        assert resp.data == client.get(self.RESOURCE_URL).data
+
     def test_post(self, client):
         # test with wrong content type(must be json)
         resp = client.post(self.RESOURCE_URL, data="happy")#not json
@@ -420,6 +705,7 @@ class TestUserCollection(object):
         body = json.loads(resp.data)
         _check_namespace(client, body)
         _check_control_get_method("users-all", client, body)
+        _check_control_post_method("create-user", client, body)
         assert len(body["items"]) == 2
         for item in body["items"]:
             _check_control_get_method("self", client, item)
@@ -430,6 +716,39 @@ class TestUserCollection(object):
             assert "location" in item
             assert "notifications" in item
 
+    def test_get_fields(self, client):
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            resp = client.get(self.RESOURCE_URL + "?fields=email,name")
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [set(item) for item in body["items"]] == [{"name", "email", "@controls"}] * 2
+        _check_control_get_method("self", client, body["items"][0])
+        # only the requested columns are read
+        assert not any("pwdhash" in statement for statement in statements)
+
+        resp = client.get(self.RESOURCE_URL + "?fields=name&stream=1")
+        assert [list(item) for item in json.loads(resp.data)["items"]] == [["name", "@controls"]] * 2
+        body = json.loads(client.get("/api/events/1/users/?fields=location").data)
+        assert [item["location"] for item in body["items"]] == ["Routa"]
+        assert "name" not in body["items"][0] and "pwdhash" not in body["items"][0]
+        body = json.loads(client.get("/api/orgs/1/users/?fields=").data)
+        assert "name" not in body["items"][0] and "@controls" in body["items"][0]
+        for href in (self.RESOURCE_URL, "/api/events/1/users/", "/api/orgs/1/users/"):
+            resp = client.get(href + "?fields=name,password")
+            assert resp.status_code == 400
+
+    def test_get_stream(self, client):
+        resp = client.get(self.RESOURCE_URL,
+                          headers={"Accept": "application/vnd.mason+json; stream=1"})
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        assert json.loads(resp.data) == json.loads(client.get(self.RESOURCE_URL).data)
+
     def test_post(self, client):
         """
         Tests the POST method. Checks all of the possible error codes, and
@@ -469,6 +788,333 @@ class TestUserCollection(object):
         assert resp.status_code == 409
 
 
+class TestPasswordHashing(object):
+
+    def test_metrics(self, client):
+        resp = client.post("/api/users/", json=_get_user())
+        assert resp.status_code == 201
+        resp = client.get("/metrics/")
+        assert resp.status_code == 200
+        stats = json.loads(resp.data)["password_hashing"]
+        assert stats["completed"] >= 1
+        assert stats["queue_depth"] == 0
+
+    def test_busy(self, client):
+        hasher = PasswordHasher(pool_size=0, max_pending=1, timeout=0)
+        old = app.extensions.pop("password_hasher", None)
+        app.extensions["password_hasher"] = hasher
+        hasher._slots.acquire()
+        try:
+            resp = client.post("/api/users/", json=_get_user())
+            assert resp.status_code == 503
+            assert hasher.stats()["rejected"] == 1
+        finally:
+            hasher._slots.release()
+            del app.extensions["password_hasher"]
+            if old is not None:
+                app.extensions["password_hasher"] = old
+        resp = client.post("/api/users/", json=_get_user())
+        assert resp.status_code == 201
+
+    def test_hash_many(self):
+        hasher = PasswordHasher(pool_size=2, max_pending=2, timeout=1)
+        hashes = list(hasher.hash_many(["a", "b", "c", "d", "e"]))
+        assert len(hashes) == 5
+        assert len(set(hashes)) == 5
+        assert hasher.stats()["completed"] == 5
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache_backend(request):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "cache.sqlite")
+    if request.param == "memory":
+        make = lambda max_bytes, ttl: MemoryBackend(max_bytes, ttl)
+    else:
+        make = lambda max_bytes, ttl: SQLiteBackend(path, max_bytes, ttl)
+    yield make
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+class TestResponseCache(object):
+
+    def test_hit_and_invalidate(self, client, cache_backend):
+        old = app.extensions.pop("response_cache", None)
+        app.extensions["response_cache"] = cache_backend(1024 * 1024, 60)
+        try:
+            self._check_hit_and_invalidate(client)
+        finally:
+            del app.extensions["response_cache"]
+            if old is not None:
+                app.extensions["response_cache"] = old
+
+    def _check_hit_and_invalidate(self, client):
+        stats = lambda: json.loads(client.get("/metrics/").data)["response_cache"]
+        first = client.get("/api/events/1/")
+        hits = stats()["hits"]
+        second = client.get("/api/events/1/")
+        assert second.data == first.data
+        assert second.headers["ETag"] == first.headers["ETag"]
+        assert stats()["hits"] == hits + 1
+        assert stats()["bytes"] > 0
+
+        # a hit answers conditional requests too
+        resp = client.get("/api/events/1/", headers={"If-None-Match": first.headers["ETag"]})
+        assert resp.status_code == 304
+
+        # the commit of an edit drops the cached events
+        client.get("/api/events/")
+        valid = _get_event()
+        valid["name"] = "Cached event"
+        assert client.put("/api/events/1/", json=valid).status_code == 204
+        assert json.loads(client.get("/api/events/1/").data)["name"] == "Cached event"
+        items = json.loads(client.get("/api/events/").data)["event_list"]
+        assert "Cached event" in [item["name"] for item in items]
+
+        # deleting an organization detaches its events
+        client.get("/api/events/1/")
+        assert client.delete("/api/orgs/1/").status_code == 204
+        assert json.loads(client.get("/api/events/1/").data)["organization"] is None
+
+        # a bulk delete cascades in the database, the events go too
+        client.post("/api/orgs/", json={"name": "org3"})
+        valid["organization"] = Organization.query.filter_by(name="org3").first().id
+        client.put("/api/events/1/", json=valid)
+        assert client.get("/api/events/1/").status_code == 200
+        Organization.query.filter_by(name="org3").delete()
+        db.session.commit()
+        assert client.get("/api/events/1/").status_code == 404
+
+    def test_budget(self, cache_backend):
+        cache = cache_backend(3 * (CacheBackend.ENTRY_OVERHEAD + 100), 60)
+        for key in range(4):
+            cache.put(key, ("event",), cache.generation(("event",)), (200, [], b"x" * 100))
+        assert cache.get(0) is None
+        assert cache.get(3) is not None
+        stats = cache.stats()
+        assert stats["entries"] == 3
+        assert stats["evictions"] == 1
+        assert stats["bytes"] <= cache.max_bytes
+
+        # responses built while a write committed are not stored
+        generation = cache.generation(("event",))
+        cache.invalidate(["event"])
+        assert cache.stats()["entries"] == 0
+        cache.put("late", ("event",), generation, (200, [], b"x"))
+        assert cache.get("late") is None
+
+        cache = cache_backend(1000, -1)
+        cache.put("old", ("event",), cache.generation(("event",)), (200, [], b"x"))
+        assert cache.get("old") is None
+
+    def test_shared(self, tmpdir):
+        # two workers using the same file
+        path = str(tmpdir.join("cache.sqlite"))
+        first = SQLiteBackend(path, 1024 * 1024, 60)
+        second = SQLiteBackend(path, 1024 * 1024, 60)
+        value = (200, [("Content-Type", "application/vnd.mason+json")], b"{}")
+        first.put("events", ("event",), first.generation(("event",)), value)
+        assert second.get("events") == value
+        second.invalidate(["event"])
+        assert first.get("events") is None
+        assert first.stats()["invalidations"] == 1
+
+    def test_shared_invalidate(self, client, tmpdir):
+        # a worker that hasn't served a cached GET still invalidates the
+        # responses other workers stored in the file
+        path = str(tmpdir.join("cache.sqlite"))
+        other = SQLiteBackend(path, 1024 * 1024, 60)
+        other.put("event", ("event",), other.generation(("event",)), (200, [], b"{}"))
+        old = app.extensions.pop("response_cache", None)
+        app.config.update(RESPONSE_CACHE_BACKEND="sqlite", RESPONSE_CACHE_PATH=path)
+        try:
+            assert client.put("/api/events/1/", json=_get_event()).status_code == 204
+            assert other.get("event") is None
+        finally:
+            app.config.update(RESPONSE_CACHE_BACKEND="memory", RESPONSE_CACHE_PATH=None)
+            app.extensions.pop("response_cache", None)
+            if old is not None:
+                app.extensions["response_cache"] = old
+
+
+class TestEncodings(object):
+    RESOURCE_URL = "/api/events/"
+
+    def test_gzip(self, client):
+        client.post("/api/events/batch/", json=[_get_event() for i in range(20)])
+        plain = client.get(self.RESOURCE_URL)
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+        assert len(plain.data) >= app.config["COMPRESS_MIN_SIZE"]
+
+        stats = lambda: json.loads(client.get("/metrics/").data)["response_cache"]
+        hits = stats()["hits"]
+        resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip, deflate"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+        assert resp.headers["ETag"] == "W/" + plain.headers["ETag"]
+
+        # the cached response keeps the compressed bytes
+        again = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+        assert again.data == resp.data
+        assert again.headers["Content-Encoding"] == "gzip"
+        assert stats()["hits"] == hits + 1
+
+        # both forms of the ETag revalidate
+        for etag in (resp.headers["ETag"], plain.headers["ETag"]):
+            assert client.get(self.RESOURCE_URL + "?limit=50",
+                              headers={"If-None-Match": etag}).status_code == 200
+            assert client.get(self.RESOURCE_URL,
+                              headers={"If-None-Match": etag}).status_code == 304
+
+        # small responses and clients that don't accept gzip get the body as is
+        resp = client.get("/api/orgs/1/", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+        resp = client.get(self.RESOURCE_URL + "?limit=20", headers={"Accept-Encoding": "identity"})
+        assert "Content-Encoding" not in resp.headers
+
+    def test_gzip_stream(self, client):
+        client.post("/api/events/batch/", json=[_get_event() for i in range(20)])
+        plain = client.get(self.RESOURCE_URL + "?stream=1")
+        resp = client.get(self.RESOURCE_URL + "?stream=1", headers={"Accept-Encoding": "gzip"})
+        assert resp.is_streamed
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+
+    def test_stream_accept(self, client):
+        # collections are only streamed in JSON
+        for url in ("/api/events/", "/api/users/", "/api/orgs/"):
+            resp = client.get(url + "?stream=1",
+                              headers={"Accept": "application/vnd.mason+msgpack"})
+            assert resp.status_code == 406
+            for accept in ("application/vnd.mason+msgpack, application/vnd.mason+json;q=0.5",
+                           "application/vnd.mason+json; stream=1", "*/*"):
+                resp = client.get(url + "?stream=1", headers={"Accept": accept})
+                assert resp.status_code == 200
+                assert resp.mimetype == "application/vnd.mason+json"
+                assert "@controls" in json.loads(resp.data)
+
+    def test_json_encoders(self, client):
+        pytest.importorskip("orjson")
+        event = _get_event()
+        event["name"] = "Karaoke \u00e4\u00e4\u2028 \"\U0001f3a4\"\n"
+        client.post("/api/events/batch/", json=[event, _get_event()])
+        urls = ["/api/events/", "/api/events/?stream=1", "/api/events/1/", "/api/events/2/",
+                "/api/users/", "/api/users/1/", "/api/orgs/", "/api/orgs/1/", "/api/events/1000/"]
+        old = app.config["JSON_ENCODER"], app.config["RESPONSE_CACHE_BYTES"]
+        app.config["RESPONSE_CACHE_BYTES"] = 0
+        try:
+            encoded = {}
+            for encoder in ("json", "orjson"):
+                app.config["JSON_ENCODER"] = encoder
+                encoded[encoder] = [client.get(url).data for url in urls]
+        finally:
+            app.config["JSON_ENCODER"], app.config["RESPONSE_CACHE_BYTES"] = old
+        assert encoded["json"] == encoded["orjson"]
+        assert json.loads(encoded["json"][3])["name"] == event["name"]
+
+    def test_json_encoder_setting(self, monkeypatch):
+        from eventhub.encoding import JSON_ENCODERS
+        # an encoder that isn't installed is refused when the app is created
+        # instead of failing every response
+        with pytest.raises(ValueError):
+            create_app({"JSON_ENCODER": "unknown"})
+        monkeypatch.delitem(JSON_ENCODERS, "orjson", raising=False)
+        with pytest.raises(ValueError):
+            create_app({"JSON_ENCODER": "orjson"})
+        assert create_app({"JSON_ENCODER": "json"}).config["JSON_ENCODER"] == "json"
+
+    def test_items(self, client):
+        from eventhub.encoding import JSON_ENCODERS
+        from eventhub.resources.EventCollection import EVENT_ITEM
+        events = Event.query.all()
+        builders = []
+        for event in events:
+            builder = MasonBuilder(name=event.name, time=format_time(event.time),
+                                   description=event.description, location=event.location,
+                                   organization=event.organization,
+                                   follower_count=event.follower_count)
+            builder.add_control("self", "/api/events/{}/".format(event.id))
+            builder.add_control("profile", "/profiles/event/")
+            builders.append(builder)
+        with app.test_request_context(self.RESOURCE_URL):
+            items = list(EVENT_ITEM.items(events))
+            assert items[0].mason_document() == builders[0]
+            for encode in JSON_ENCODERS.values():
+                assert encode({"event_list": items}) == encode({"event_list": builders})
+                assert encode(EVENT_ITEM.item(events[0])) == encode(builders[0])
+        # the profile control is shared by the items
+        assert items[0].mason_document()["@controls"]["profile"] is EVENT_ITEM.profile
+
+    def test_msgpack(self, client):
+        msgpack = pytest.importorskip("msgpack")
+        accept = {"Accept": "application/vnd.mason+msgpack"}
+        resp = client.get(self.RESOURCE_URL, headers=accept)
+        assert resp.mimetype == "application/vnd.mason+msgpack"
+        assert msgpack.unpackb(resp.data, raw=False) == json.loads(client.get(self.RESOURCE_URL).data)
+        resp = client.get("/api/events/1000/", headers=accept)
+        assert resp.status_code == 404
+        assert msgpack.unpackb(resp.data, raw=False)["@error"]["@message"] == "Event not found"
+
+    def test_brotli(self, client):
+        brotli = pytest.importorskip("brotli")
+        client.post("/api/events/batch/", json=[_get_event() for i in range(20)])
+        plain = client.get(self.RESOURCE_URL)
+        resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip, br"})
+        assert resp.headers["Content-Encoding"] == "br"
+        assert brotli.decompress(resp.data) == plain.data
+
+
+class TestUserImport(object):
+    RESOURCE_URL = "/api/users/import/"
+
+    def test_post_csv(self, client):
+        data = (
+            "name,email,password,location,notifications\n"
+            "Anna,import1@example.com,secret,Oulu,1\n"
+            "Bert,test1@gmail.com,secret,,0\n"
+            "Cecilia,import2@example.com,secret,,0\n"
+            "Anna again,import1@example.com,secret,,0\n"
+            "Dan,import3@example.com,secret,,2\n"
+        )
+        resp = client.post(self.RESOURCE_URL, data=data, content_type="text/csv")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 409, 201, 409, 400]
+        assert body["created"] == 2
+        resp = client.get(body["items"][2]["location"])
+        user = json.loads(resp.data)
+        assert user["name"] == "Cecilia"
+        assert user["location"] is None
+        assert user["notifications"] == 0
+        stored = User.query.filter_by(email="import1@example.com").first()
+        assert verify_password(stored.pwdhash, "secret")
+
+    def test_post_ndjson(self, client):
+        users = [dict(_get_user(), email="import{}@example.org".format(i)) for i in range(3)]
+        data = "\n".join(json.dumps(user) for user in users)
+        resp = client.post(self.RESOURCE_URL, data=data, content_type="application/x-ndjson")
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 201, 201]
+        resp = client.post(self.RESOURCE_URL, json=users[:1])
+        assert json.loads(resp.data)["items"][0]["status"] == 409
+        resp = client.post(self.RESOURCE_URL, data="x", content_type="text/plain")
+        assert resp.status_code == 415
+
+    def test_command(self, client, tmpdir):
+        source = tmpdir.join("users.csv")
+        source.write("name,email,password,location,notifications\n"
+                     "Eve,import@example.net,secret,Oulu,0\n"
+                     "Frank,test2@gmail.com,secret,Oulu,0\n")
+        result = app.test_cli_runner(mix_stderr=False).invoke(args=["import-users", str(source)])
+        assert result.exit_code == 0
+        assert "created 1 users, 1 failed" in result.output
+        assert "item 1: 409" in result.stderr
+        assert User.query.filter_by(email="import@example.net").first().name == "Eve"
+
+
 class TestUserItem(object):
     RESOURCE_URL = "/api/users/1/"
     INVALID_URL = "/api/users/1000/"
@@ -494,6 +1140,17 @@ class TestUserItem(object):
         resp = client.get("api/users/20/")
         assert resp.status_code == 404
 
+    def test_get_conditional_reused_id(self, client):
+        # SQLite gives the id of the deleted last row to the next one
+        url = "/api/users/2/"
+        etag = client.get(url).headers["ETag"]
+        client.delete(url)
+        resp = client.post("/api/users/", json=_get_user())
+        assert resp.headers["Location"].endswith(url)
+        resp = client.get(url, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["name"] == "DanceMonkey"
+
     def test_put(self, client):
         """Test for valid PUT method"""
         valid = _get_user(number=1)
@@ -531,6 +1188,54 @@ class TestUserItem(object):
 
         #valid = _get_user(number=1)
 
+    def test_patch(self, client):
+        """Test for partial updates with PATCH"""
+        # only the supplied fields change, the password hash stays
+        resp = client.patch(self.RESOURCE_URL, json={"location": "Linnanmaa", "notifications": 1})
+        assert resp.status_code == 204
+        user = User.query.filter_by(id=1).first()
+        assert user.location == "Linnanmaa"
+        assert user.notifications == 1
+        assert user.name == "Melody"
+        assert user.pwdhash == "random string"
+
+        # a new password is checked and hashed, the same password again is
+        # only checked against the stored hash and keeps it
+        hasher = PasswordHasher(pool_size=0, max_pending=1, timeout=1)
+        old = app.extensions.pop("password_hasher", None)
+        app.extensions["password_hasher"] = hasher
+        try:
+            resp = client.patch(self.RESOURCE_URL, json={"password": "secret"})
+            assert resp.status_code == 204
+            pwdhash = User.query.filter_by(id=1).first().pwdhash
+            assert verify_password(pwdhash, "secret")
+            assert hasher.stats()["completed"] == 2
+            resp = client.patch(self.RESOURCE_URL, json={"password": "secret"})
+            assert resp.status_code == 204
+            assert User.query.filter_by(id=1).first().pwdhash == pwdhash
+            assert hasher.stats()["completed"] == 3
+
+            # PUT with an unchanged password keeps the hash too
+            valid = _get_user()
+            valid["password"] = "secret"
+            resp = client.put(self.RESOURCE_URL, json=valid)
+            assert resp.status_code == 204
+            assert User.query.filter_by(id=1).first().pwdhash == pwdhash
+            assert hasher.stats()["completed"] == 4
+        finally:
+            del app.extensions["password_hasher"]
+            if old is not None:
+                app.extensions["password_hasher"] = old
+
+        resp = client.patch(self.RESOURCE_URL, data="location=Oulu")
+        assert resp.status_code == 415
+        resp = client.patch(self.RESOURCE_URL, json={"notifications": "yes"})
+        assert resp.status_code == 400
+        resp = client.patch(self.INVALID_URL, json={"location": "Oulu"})
+        assert resp.status_code == 404
+        resp = client.patch("/api/users/2/", json={"email": valid["email"]})
+        assert resp.status_code == 409
+
     def test_delete(self, client):
         """Test for valid DELETE method"""
         resp = client.delete(self.RESOURCE_URL)
@@ -570,6 +1275,47 @@ class TestEventsByUser(object):
             resp = client.get(self.INVALID_URL)
             assert resp.status_code == 404
 
+        def test_get_empty(self, client):
+            resp = client.get("/api/users/2/events/")
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert body["items"] == []
+            assert body["user"]["name"] == "Stacey"
+            resp = client.get("/api/users/2/orgs/")
+            assert json.loads(resp.data)["items"] == []
+            resp = client.get("/api/orgs/2/users/")
+            assert json.loads(resp.data)["items"] == []
+
+        def test_statement_budget(self, client):
+            @statement_budget(1)
+            def two_queries():
+                User.query.all()
+                Event.query.all()
+
+            with app.test_request_context():
+                with pytest.raises(AssertionError):
+                    two_queries()
+
+        def test_get_compact(self, client):
+            full = client.get(self.RESOURCE_URL)
+            resp = client.get(self.RESOURCE_URL + "?compact=1")
+            assert resp.status_code == 200
+            assert len(resp.data) < len(full.data)
+            body = json.loads(resp.data)
+            edit = body["items"][0]["@controls"]["edit"]
+            assert "schema" not in edit
+            resp = client.get(edit["schemaUrl"])
+            assert resp.status_code == 200
+            schema = json.loads(resp.data)
+            assert schema == json.loads(full.data)["items"][0]["@controls"]["edit"]["schema"]
+            validate(_get_event(), schema)
+
+            resp = client.get(self.RESOURCE_URL,
+                              headers={"Accept": "application/vnd.mason+json; compact=1"})
+            assert resp.data == client.get(self.RESOURCE_URL + "?compact=1").data
+            resp = client.get("/schemas/nothing/")
+            assert resp.status_code == 404
+
 class TestUsersByEvent(object):
         RESOURCE_URL = "/api/events/1/users/"
         INVALID_URL = "/api/events/-1/users/"
@@ -599,6 +1345,118 @@ class TestUsersByEvent(object):
             resp = client.get(self.INVALID_URL)
             assert resp.status_code == 404
 
+        def test_post_delete(self, client):
+            resp = client.get(self.RESOURCE_URL)
+            controls = json.loads(resp.data)["@controls"]
+            assert controls["eventhub:add-users"]["method"] == "POST"
+            schema = json.loads(client.get(controls["eventhub:add-users"]["schemaUrl"]).data)
+            validate({"users": [1, 2]}, schema)
+
+            # already following and duplicates are fine
+            resp = client.post(self.RESOURCE_URL, json={"users": [1, 2, 2]})
+            assert resp.status_code == 204
+            body = json.loads(client.get(self.RESOURCE_URL).data)
+            assert [item["name"] for item in body["items"]] == ["Melody", "Stacey"]
+
+            resp = client.delete(self.RESOURCE_URL, json={"users": [1, 1000]})
+            assert resp.status_code == 204
+            body = json.loads(client.get(self.RESOURCE_URL).data)
+            assert [item["name"] for item in body["items"]] == ["Stacey"]
+
+            resp = client.post(self.RESOURCE_URL, json={"users": [1, 1000, 1001]})
+            assert resp.status_code == 404
+            assert "[1000, 1001]" in json.loads(resp.data)["@error"]["@messages"][0]
+            assert len(json.loads(client.get(self.RESOURCE_URL).data)["items"]) == 1
+
+            resp = client.post(self.RESOURCE_URL, json={"users": ["1"]})
+            assert resp.status_code == 400
+            resp = client.post(self.RESOURCE_URL, data="1")
+            assert resp.status_code == 415
+            resp = client.post(self.INVALID_URL, json={"users": [1]})
+            assert resp.status_code == 404
+
+class TestCounters(object):
+
+    def _counts(self, client):
+        events = json.loads(client.get("/api/events/").data)["event_list"]
+        event = json.loads(client.get("/api/events/1/").data)
+        orgs = json.loads(client.get("/api/orgs/").data)["orgs_list"]
+        org = json.loads(client.get("/api/orgs/1/").data)
+        assert events[0]["follower_count"] == event["follower_count"]
+        assert orgs[0]["member_count"] == org["member_count"]
+        return event["follower_count"], org["member_count"]
+
+    def test_counts(self, client):
+        assert self._counts(client) == (1, 1)
+        assert client.post("/api/events/1/users/", json={"users": [1, 2]}).status_code == 204
+        assert client.post("/api/orgs/1/users/", json={"users": [2]}).status_code == 204
+        assert self._counts(client) == (2, 2)
+        body = json.loads(client.get("/api/users/2/events/").data)
+        assert body["items"][0]["follower_count"] == 2
+        body = json.loads(client.get("/api/users/2/orgs/").data)
+        assert body["items"][0]["member_count"] == 2
+
+        assert client.delete("/api/events/1/users/", json={"users": [2]}).status_code == 204
+        assert self._counts(client) == (1, 2)
+        # deleting a user removes its links
+        assert client.delete("/api/users/1/").status_code == 204
+        assert self._counts(client) == (0, 1)
+
+
+class TestUserFeed(object):
+    RESOURCE_URL = "/api/users/1/feed/"
+
+    def _post_event(self, client, name, time, organization):
+        event = _get_event()
+        event.update(name=name, time=time, organization=organization)
+        resp = client.post("/api/events/", json=event)
+        assert resp.status_code == 201
+        return resp.headers["Location"]
+
+    def _names(self, client, href):
+        resp = client.get(href)
+        assert resp.status_code == 200
+        return [item["name"] for item in json.loads(resp.data)["event_list"]]
+
+    def test_get(self, client):
+        # user 1 follows the past event 1 and is a member of organization 1
+        assert self._names(client, self.RESOURCE_URL) == []
+        concert = self._post_event(client, "Concert", "2100-01-02T18:00:00Z", 1)
+        party = self._post_event(client, "Party", "2100-01-01T18:00:00Z", 2)
+        assert self._names(client, self.RESOURCE_URL) == ["Concert"]
+        assert client.post(party + "users/", json={"users": [1]}).status_code == 204
+        assert self._names(client, self.RESOURCE_URL) == ["Party", "Concert"]
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?limit=1").data)
+        _check_namespace(client, body)
+        _check_control_get_method("up", client, body)
+        assert [item["name"] for item in body["event_list"]] == ["Party"]
+        assert self._names(client, body["@controls"]["next"]["href"]) == ["Concert"]
+
+        # moving an event in time moves it in the feed
+        event = _get_event()
+        event.update(name="Concert", time="2099-12-31T18:00:00Z")
+        assert client.put(concert, json=event).status_code == 204
+        assert self._names(client, self.RESOURCE_URL) == ["Concert", "Party"]
+
+        # events of organization 1 leave with the membership, followed ones stay
+        assert client.post(concert + "users/", json={"users": [2]}).status_code == 204
+        assert client.delete("/api/orgs/1/users/", json={"users": [1]}).status_code == 204
+        assert self._names(client, self.RESOURCE_URL) == ["Party"]
+        assert client.delete(party + "users/", json={"users": [1]}).status_code == 204
+        assert self._names(client, self.RESOURCE_URL) == []
+
+        # and the events of a new organization arrive
+        assert self._names(client, "/api/users/2/feed/") == ["Concert"]
+        assert client.post("/api/orgs/2/users/", json={"users": [2]}).status_code == 204
+        assert self._names(client, "/api/users/2/feed/") == ["Concert", "Party"]
+        assert client.delete(party).status_code == 204
+        assert self._names(client, "/api/users/2/feed/") == ["Concert"]
+
+        assert client.get("/api/users/1000/feed/").status_code == 404
+        assert client.get(self.RESOURCE_URL + "?after=abc").status_code == 400
+
+
 class TestOrgsByUser(object):
         RESOURCE_URL = "/api/users/1/orgs/"
         INVALID_URL = "/api/users/-1/orgs/"
@@ -642,6 +1500,8 @@ class TestUsersOfOrg(object):
                 assert "pwdhash" in item
                 assert "location" in item
                 assert "notifications" in item
+                assert item["@controls"]["edit"]["href"] == item["@controls"]["self"]["href"]
+                assert item["@controls"]["delete"]["href"] == item["@controls"]["self"]["href"]
 
             _check_namespace(client, body)
             _check_control_get_method("self", client, body)
@@ -650,3 +1510,18 @@ class TestUsersOfOrg(object):
             _check_control_delete_method("delete", client, body)
             resp = client.get(self.INVALID_URL)
             assert resp.status_code == 404
+
+        def test_post_delete(self, client):
+            resp = client.post(self.RESOURCE_URL, json={"users": [2]})
+            assert resp.status_code == 204
+            body = json.loads(client.get(self.RESOURCE_URL).data)
+            assert len(body["items"]) == 2
+            body = json.loads(client.get("/api/users/2/orgs/").data)
+            assert len(body["items"]) == 1
+
+            resp = client.delete(self.RESOURCE_URL, json={"users": [1, 2]})
+            assert resp.status_code == 204
+            body = json.loads(client.get(self.RESOURCE_URL).data)
+            assert body["items"] == []
+            resp = client.delete(self.INVALID_URL, json={"users": [1]})
+            assert resp.status_code == 404
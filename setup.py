@@ -11,5 +11,9 @@ setup(
         "flask-restful",
         "flask-sqlalchemy",
         "SQLAlchemy",
-    ]
+    ],
+    extras_require={
+        # MessagePack responses and brotli compression
+        "encodings": ["msgpack", "brotli"],
+    }
 )
\ No newline at end of file